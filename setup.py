@@ -13,5 +13,9 @@ setup(
     license='MIT',
     description='SiWei Conditioning experiment.',
     entry_points={'console_scripts':
-                  ['sock_cond=sock_cond.main:run_app']},
+                  ['sock_cond=sock_cond.main:run_app',
+                   'sock_cond_benchmark=sock_cond.benchmark:main',
+                   'sock_cond_headless=sock_cond.headless:main',
+                   'sock_cond_export=sock_cond.export:main',
+                   'sock_cond_barst_mock=sock_cond.barst_mock:main']},
     )
@@ -3,3 +3,8 @@
 
 
 __version__ = '0.1-dev'
+
+exp_classes = ['StdTrain', 'PsdTrain', 'OdorOnly', 'NoOdor']
+'''The names of the protocols an animal can be trained with, see
+:attr:`~sock_cond.stages.VerifyConfigStage.exp_classes`.
+'''
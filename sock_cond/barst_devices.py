@@ -0,0 +1,61 @@
+'''The devices controlled through the Barst server. They, and the cplcom
+Barst modules, are only imported when the devices are created, see
+:func:`~sock_cond.lazy.import_timed`.
+'''
+
+__all__ = ('FTDIOdors', 'FTDIPort', 'RTVChan')
+
+from moa.utils import ConfigPropertyList
+
+from cplcom.device.ftdi import FTDISerializerDevice, FTDIPinDevice
+from cplcom.device.rtv import RTVChan as MoaRTVChan
+
+from cplcom import device_config_name, exp_config_name
+
+from sock_cond.devices import (
+    FTDIOdorsBase, FTDIPortBase, RTVChanBase, get_shocker_name,
+    verify_video_fmt)
+
+
+class FTDIOdors(FTDIOdorsBase, FTDISerializerDevice):
+    '''Device used when using the barst ftdi odor devices.
+    '''
+
+    def __init__(self, N=8, **kwargs):
+        dev_map = {'p{}'.format(i): i for i in range(N)}
+        super(FTDIOdors, self).__init__(dev_map=dev_map, N=N, **kwargs)
+
+
+class FTDIPort(FTDIPortBase, FTDIPinDevice):
+    '''Device used when using the barst ftdi odor devices.
+    '''
+
+    def __init__(self, num_shockers=1, **kwargs):
+        pins = self.shocker_pin
+        if len(pins) < num_shockers:
+            raise Exception('Only {} shocker pins are configured for {} '
+                            'chambers'.format(len(pins), num_shockers))
+        dev_map = {get_shocker_name(i): pins[i] for i in range(num_shockers)}
+        super(FTDIPort, self).__init__(
+            dev_map=dev_map, num_shockers=num_shockers, **kwargs)
+        bitmask = 0
+        for pin in dev_map.values():
+            bitmask |= 1 << pin
+        self.init_vals['bitmask'] = bitmask
+
+    shocker_pin = ConfigPropertyList(
+        0, 'FTDI_pin', 'shocker_pin', device_config_name, val_type=int)
+    '''The pin of the shocker of each chamber. '''
+
+
+class RTVChan(MoaRTVChan, RTVChanBase):
+
+    def __init__(self, **kwargs):
+        super(RTVChan, self).__init__(**kwargs)
+        n = self.idx
+        self.output_img_fmt = self.img_fmt[n]
+        self.output_video_fmt = self.video_fmt[n]
+
+    video_fmt = ConfigPropertyList(
+        'full_NTSC', 'Video', 'video_fmt', exp_config_name,
+        val_type=verify_video_fmt)
@@ -0,0 +1,479 @@
+'''A local stand-in for the Barst server, so that the non-simulated device
+path of the experiment, i.e. ``InitBarstStage.create_devices(sim=False)``,
+can be run and load tested on any platform, without the Barst executable or
+the hardware.
+
+:class:`MockBarstServer` listens on a TCP socket, and each device channel,
+e.g. the FTDI odor serializer, the FTDI pin device, or a RTV camera, opens
+its own connection to it. The requests are lines of json, each answered by a
+line of json, ``{"ok": true, ...}``, or ``{"ok": false, "error": msg}``:
+
+``{"cmd": "open", "kind": kind, "name": name, ...}``: opens the channel
+``name`` of ``kind``, e.g. ``"serializer"``, ``"pin"``, or ``"rtv"``. A rtv
+channel also takes the ``video_fmt`` (see :data:`rtv_frame_sizes`) and the
+``pix_fmt``, ``"gray"`` or ``"rgb24"``, of its frames, and optionally their
+``rate``, which defaults to the server's :attr:`MockBarstServer.rate`, or to
+the rate of the ``video_fmt``. Its response has the ``size`` and ``rate`` of
+the frames.
+
+``{"cmd": "write", "value": value}``: writes the integer ``value`` of the
+bits of a FTDI channel. The response has the time, ``t``, of the write.
+
+``{"cmd": "start"}``: starts streaming the frames of a rtv channel. After the
+response, each frame is sent as a :data:`frame_header_struct` followed by
+its data, at the channel's rate. While streaming, the only request accepted
+is ``{"cmd": "stop"}``, which ends the stream with a header with zero bytes,
+followed by its response.
+
+``{"cmd": "stats"}``: returns the ``stats`` of the server, see
+:meth:`MockBarstServer.get_stats`.
+
+The server, and the load test, only use the standard library, e.g.::
+
+    python -m sock_cond.barst_mock --port 5000
+    python -m sock_cond.barst_mock --load-test 4 --duration 10
+
+The devices connecting to it are :class:`~sock_cond.devices.MockServer` and
+its channels, used when the ``mock_server`` option of the ``Server``
+section of the config is set.
+'''
+
+__all__ = ('frame_header_struct', 'rtv_frame_sizes', 'get_rtv_rate',
+           'parse_address', 'MockBarstServer', 'MockBarstConnection',
+           'run_load_test', 'main')
+
+import os
+import sys
+import json
+import socket
+import argparse
+from struct import Struct
+from threading import Thread, Lock
+from collections import deque
+from time import sleep
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import clock
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+frame_header_struct = Struct('<dQ')
+'''The header of each frame of a rtv stream: its pts, in seconds, and its
+size in bytes. A size of zero ends the stream.
+'''
+
+rtv_frame_sizes = {
+    'full_NTSC': (640, 480), 'full_PAL': (768, 576), 'CIF_NTSC': (320, 240),
+    'CIF_PAL': (384, 288), 'QCIF_NTSC': (160, 120), 'QCIF_PAL': (192, 144)}
+'''The ``(w, h)`` size of the frames of each RTV video format. '''
+
+
+def get_rtv_rate(video_fmt):
+    '''Returns the frame rate of the RTV video format `video_fmt`. '''
+    return 25. if video_fmt.endswith('PAL') else 30000 / 1001.
+
+
+def parse_address(address):
+    '''Returns the ``(host, port)`` tuple of the ``'host:port'`` string
+    `address`. The host defaults to ``127.0.0.1``.
+    '''
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class _ChannelHandler(socketserver.StreamRequestHandler):
+
+    server_mock = None
+    channel = None
+    _stream = None
+    _streaming = False
+
+    def handle(self):
+        self.server_mock = self.server.mock
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd = None
+            try:
+                request = json.loads(line.decode('utf8'))
+                cmd = request.get('cmd')
+                if self._stream is not None and cmd != 'stop':
+                    continue
+                response = self.handle_request(cmd, request)
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            if response is not None:
+                self.send_response(response)
+                if cmd == 'start' and response['ok']:
+                    self.start_stream()
+        self.stop_stream()
+
+    def send_response(self, response):
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+        self.wfile.flush()
+
+    def handle_request(self, cmd, request):
+        server = self.server_mock
+        if cmd == 'open':
+            channel = self.channel = server.open_channel(request)
+            if channel['kind'] == 'rtv':
+                return {'ok': True, 'size': channel['size'],
+                        'rate': channel['rate']}
+            return {'ok': True}
+        if cmd == 'stats':
+            return {'ok': True, 'stats': server.get_stats()}
+        channel = self.channel
+        if channel is None:
+            raise Exception('The channel was not opened')
+
+        if cmd == 'write':
+            return {'ok': True, 't': server.add_write(
+                channel, int(request['value']))}
+        if cmd == 'start':
+            if channel['kind'] != 'rtv':
+                raise Exception('{} is not a rtv channel'.format(
+                    channel['name']))
+            return {'ok': True}
+        if cmd == 'stop':
+            self.stop_stream()
+            return {'ok': True}
+        raise Exception('Unknown request {}'.format(cmd))
+
+    def start_stream(self):
+        self._streaming = True
+        self._stream = Thread(
+            target=self.send_frames,
+            name='Mock Barst {}'.format(self.channel['name']))
+        self._stream.daemon = True
+        self._stream.start()
+
+    def stop_stream(self):
+        thread = self._stream
+        if thread is None:
+            return
+        self._streaming = False
+        thread.join()
+        self._stream = None
+
+    def send_frames(self):
+        server = self.server_mock
+        channel = self.channel
+        w, h = channel['size']
+        size = w * h * channel['bpp']
+        buffers = [os.urandom(size) for _ in range(4)]
+        period = 1. / channel['rate']
+        pack = frame_header_struct.pack
+        wfile = self.wfile
+        start = clock()
+        i = 0
+
+        try:
+            while self._streaming:
+                delay = start + i * period - clock()
+                if delay > 0:
+                    sleep(delay)
+                elif delay < -period:
+                    channel['late_frames'] += 1
+                wfile.write(pack(i * period, size))
+                wfile.write(buffers[i % len(buffers)])
+                channel['frames'] += 1
+                channel['bytes'] += size
+                i += 1
+            wfile.write(pack(0, 0))
+            wfile.flush()
+        except Exception as e:
+            server.add_error(channel, e)
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    mock = None
+
+
+class MockBarstServer(object):
+    '''A server emulating the FTDI and RTV channels of Barst, see the module
+    description.
+    '''
+
+    address = None
+    '''The ``(host, port)`` on which the server listens. '''
+
+    rate = 0
+    '''If not zero, the frame rate of all the rtv channels. '''
+
+    channels = {}
+    '''The state of each opened channel, keyed by its name. '''
+
+    writes = None
+    '''A deque of the last ``(t, name, value)`` writes to the FTDI channels.
+    '''
+
+    errors = []
+    '''The errors encountered while streaming frames. '''
+
+    _server = None
+    _thread = None
+    _lock = None
+
+    def __init__(self, address=('127.0.0.1', 0), rate=0, max_writes=100000,
+                 **kwargs):
+        super(MockBarstServer, self).__init__(**kwargs)
+        self.rate = rate
+        self.channels = {}
+        self.writes = deque(maxlen=max_writes)
+        self.errors = []
+        self._lock = Lock()
+        server = self._server = _ThreadingServer(address, _ChannelHandler)
+        server.mock = self
+        self.address = server.server_address[:2]
+
+    def start(self):
+        '''Starts serving from a background thread. '''
+        if self._thread is not None:
+            return
+        self._thread = Thread(
+            target=self._server.serve_forever, name='Mock Barst server')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stops serving and closes the socket. '''
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def open_channel(self, request):
+        kind = request['kind']
+        channel = {
+            'name': request['name'], 'kind': kind, 'writes': 0, 'value': 0,
+            'frames': 0, 'bytes': 0, 'late_frames': 0}
+        if kind == 'rtv':
+            video_fmt = request.get('video_fmt', 'full_NTSC')
+            if video_fmt not in rtv_frame_sizes:
+                raise Exception('{} is not a valid RTV video format'.format(
+                    video_fmt))
+            pix_fmt = request.get('pix_fmt', 'gray')
+            if pix_fmt not in ('gray', 'rgb24'):
+                raise Exception('{} is not a valid pixel format'.format(
+                    pix_fmt))
+            channel['size'] = rtv_frame_sizes[video_fmt]
+            channel['bpp'] = 1 if pix_fmt == 'gray' else 3
+            channel['rate'] = float(
+                request.get('rate') or self.rate or get_rtv_rate(video_fmt))
+        with self._lock:
+            self.channels[channel['name']] = channel
+        return channel
+
+    def add_write(self, channel, value):
+        t = clock()
+        with self._lock:
+            channel['writes'] += 1
+            channel['value'] = value
+            self.writes.append((t, channel['name'], value))
+        return t
+
+    def add_error(self, channel, e):
+        with self._lock:
+            self.errors.append((channel['name'], str(e)))
+
+    def get_stats(self):
+        '''Returns a dict with the ``kind``, number of ``writes``, last
+        ``value`` written, and number of ``frames``, ``bytes``, and
+        ``late_frames`` sent of each channel, keyed by its name.
+        '''
+        keys = ('kind', 'writes', 'value', 'frames', 'bytes', 'late_frames')
+        with self._lock:
+            return {name: {k: channel[k] for k in keys}
+                    for name, channel in self.channels.items()}
+
+
+class MockBarstConnection(object):
+    '''A connection of a channel to a :class:`MockBarstServer`.
+    '''
+
+    _sock = None
+    _rfile = None
+
+    def __init__(self, address, timeout=10., **kwargs):
+        super(MockBarstConnection, self).__init__(**kwargs)
+        self._sock = socket.create_connection(address, timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfile = self._sock.makefile('rb')
+
+    def send(self, cmd, **kwargs):
+        '''Sends the request `cmd` without reading its response. '''
+        kwargs['cmd'] = cmd
+        self._sock.sendall(json.dumps(kwargs).encode('utf8') + b'\n')
+
+    def read_response(self):
+        '''Reads the response of a request, raising its error if it failed.
+        '''
+        line = self._rfile.readline()
+        if not line:
+            raise Exception('The mock Barst server closed the connection')
+        response = json.loads(line.decode('utf8'))
+        if not response['ok']:
+            raise Exception(response['error'])
+        return response
+
+    def request(self, cmd, **kwargs):
+        '''Sends the request `cmd`, with the `kwargs` fields, and returns its
+        response.
+        '''
+        self.send(cmd, **kwargs)
+        return self.read_response()
+
+    def read_frame(self):
+        '''Reads the next frame of the stream, and returns its ``(pts,
+        data)``, or None when the stream ended.
+        '''
+        header = self._rfile.read(frame_header_struct.size)
+        if len(header) < frame_header_struct.size:
+            raise Exception('The mock Barst server closed the connection')
+        pts, size = frame_header_struct.unpack(header)
+        if not size:
+            return None
+        data = self._rfile.read(size)
+        if len(data) < size:
+            raise Exception('The mock Barst server closed the connection')
+        return pts, data
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
+
+
+def _read_stream(conn, counts):
+    while True:
+        frame = conn.read_frame()
+        if frame is None:
+            return
+        counts[0] += 1
+        counts[1] += len(frame[1])
+
+
+def run_load_test(address, cams=1, duration=10., video_fmt='full_NTSC',
+                  pix_fmt='gray', rate=0, write_rate=100.):
+    '''Streams the frames of `cams` rtv channels from the server at
+    `address`, while writing to a FTDI serializer channel at `write_rate`,
+    for `duration` seconds. It returns a dict with the frames and bytes per
+    second received, and the writes per second and their median and maximum
+    round trip latency, in seconds.
+    '''
+    conns = []
+    readers = []
+    counts = []
+    try:
+        for i in range(cams):
+            conn = MockBarstConnection(address)
+            conns.append(conn)
+            conn.request(
+                'open', kind='rtv', name='player{}'.format(i),
+                video_fmt=video_fmt, pix_fmt=pix_fmt, rate=rate)
+        ftdi = MockBarstConnection(address)
+        conns.append(ftdi)
+        ftdi.request('open', kind='serializer', name='odors')
+
+        ts = clock()
+        for conn in conns[:cams]:
+            conn.request('start')
+            count = [0, 0]
+            reader = Thread(target=_read_stream, args=(conn, count))
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+            counts.append(count)
+
+        latencies = []
+        period = 1. / write_rate if write_rate else duration
+        end = ts + duration
+        i = 0
+        while clock() < end:
+            t = clock()
+            if write_rate:
+                ftdi.request('write', value=i & 0xFF)
+                latencies.append(clock() - t)
+            i += 1
+            sleep(max(ts + i * period - clock(), 0))
+        elapsed = clock() - ts
+        frames = sum(c[0] for c in counts)
+        nbytes = sum(c[1] for c in counts)
+
+        for conn in conns[:cams]:
+            conn.send('stop')
+        for reader, conn in zip(readers, conns):
+            reader.join()
+            conn.read_response()
+    finally:
+        for conn in conns:
+            conn.close()
+
+    latencies.sort()
+    return {
+        'fps': frames / elapsed, 'bytes_per_sec': nbytes / elapsed,
+        'writes_per_sec': len(latencies) / elapsed,
+        'write_latency_median':
+            latencies[len(latencies) // 2] if latencies else 0,
+        'write_latency_max': latencies[-1] if latencies else 0}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in for the Barst server.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='The address to listen on.')
+    parser.add_argument('--port', type=int, default=0,
+                        help='The port to listen on. If zero, any free port.')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='If not zero, the frame rate of all the '
+                        'cameras.')
+    parser.add_argument('--load-test', type=int, default=0, metavar='CAMS',
+                        help='If not zero, instead of serving until '
+                        'interrupted, it runs a load test with this many '
+                        'cameras against the server.')
+    parser.add_argument('--duration', type=float, default=10.,
+                        help='The duration of the load test, in seconds.')
+    parser.add_argument('--video-fmt', default='full_NTSC',
+                        choices=sorted(rtv_frame_sizes),
+                        help='The video format of the load test cameras.')
+    parser.add_argument('--pix-fmt', default='gray',
+                        choices=('gray', 'rgb24'),
+                        help='The pixel format of the load test cameras.')
+    parser.add_argument('--write-rate', type=float, default=100.,
+                        help='The rate of the load test FTDI writes.')
+    args = parser.parse_args(args)
+
+    server = MockBarstServer((args.host, args.port), rate=args.rate)
+    server.start()
+    print('Mock Barst server listening on {}:{}'.format(*server.address))
+    try:
+        if not args.load_test:
+            while True:
+                sleep(1)
+        results = run_load_test(
+            server.address, args.load_test, args.duration, args.video_fmt,
+            args.pix_fmt, args.rate, args.write_rate)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.stop()
+
+    print('{:.1f} frames/s, {:.1f} MB/s, {:.1f} writes/s, write latency '
+          'median {:.3f} ms, max {:.3f} ms'.format(
+              results['fps'], results['bytes_per_sec'] / 1e6,
+              results['writes_per_sec'],
+              results['write_latency_median'] * 1000,
+              results['write_latency_max'] * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+'''A headless benchmark of the recording pipeline.
+
+Synthetic cameras generate frames at a fixed rate, which are passed through
+:meth:`~sock_cond.stages.InitBarstStage.service_input_image` to the
+:class:`~sock_cond.writer_devices.FFPyWriterDevice`, exactly as the frames of
+the players are during an experiment, but without a Barst server, cameras, or
+a window. At the end, the sustained throughput, CPU usage, peak memory, and the
+frame statistics are reported.
+
+Run it e.g. with::
+
+    python -m sock_cond.benchmark --cams 4 --size 720x480 --fmt gray \\
+--fps 30 --duration 30 --codec rawvideo --out /tmp/bench
+'''
+
+__all__ = ('run_benchmark', 'main')
+
+import os
+import sys
+import argparse
+from functools import partial
+from time import sleep
+from os.path import join
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import clock
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from sock_cond.stages import InitBarstStage
+from sock_cond.devices import SyntheticCamera
+
+
+def get_cpu_time():
+    '''Returns the user and system CPU time used by the process so far.
+    '''
+    t = os.times()
+    return t[0] + t[1]
+
+
+def get_peak_rss():
+    '''Returns the peak resident memory of the process, in MB, or None when
+    not available on the platform.
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / (1024. * 1024.)
+    return rss / 1024.
+
+
+def run_benchmark(
+        out_dir, cams=4, size=(720, 480), fmt='gray', fps=30, duration=10.,
+        codec='rawvideo', mux=False, trials=1, stats_interval=1.):
+    '''Records `trials` trials of `duration` seconds each from `cams`
+    :class:`~sock_cond.devices.SyntheticCamera` through an
+    :class:`~sock_cond.stages.InitBarstStage` into `out_dir` and returns a
+    dict with the results.
+    '''
+    stage = InitBarstStage()
+    stage.stats_interval = 0
+    stage.mux_cameras = mux
+    stage.record = [True, ] * cams
+    stage.port_names = [str(i) for i in range(cams)]
+
+    players = [
+        SyntheticCamera(
+            callback=partial(stage.service_input_image, i), size=size,
+            fmt=fmt, fps=fps)
+        for i in range(cams)]
+    stage.players = players
+    stage.displays = [None, ] * cams
+    stage.create_frame_pipeline()
+    for writer in stage.get_unique_writers(stage.cam_writers):
+        writer.codec = [codec]
+
+    filename = join(out_dir, 'BenchTrial{trial}Cam{cam}.avi')
+    stage.create_writers(
+        filename, trials,
+        filedata={'day': '', 'group': '', 'animal': '', 'cycle': ''})
+
+    cpu_start = get_cpu_time()
+    ts = clock()
+    for player in players:
+        player.start()
+    try:
+        for trial in range(trials):
+            stage.set_trial_writers(trial)
+            end = clock() + duration
+            while clock() < end:
+                sleep(min(stats_interval, max(end - clock(), 0)))
+                stage.update_stats()
+            stage.reset_trial_writers()
+    finally:
+        for player in players:
+            player.stop()
+        stage.stop_frame_pipeline(join=True)
+    elapsed = clock() - ts
+    cpu = get_cpu_time() - cpu_start
+    stage.update_stats()
+
+    bpp = 1 if fmt == 'gray' else 3
+    written = sum(stage.frames_written)
+    return {
+        'elapsed': elapsed,
+        'cpu': cpu / elapsed * 100.,
+        'peak_rss': get_peak_rss(),
+        'sent': sum(p.frames_sent for p in players),
+        'late': sum(p.late_frames for p in players),
+        'received': sum(stage.frames_received),
+        'written': written,
+        'dropped': sum(stage.frames_dropped),
+        'gaps': sum(stage.frame_gaps),
+        'fps': written / elapsed,
+        'mbps': written * size[0] * size[1] * bpp / elapsed / (1024. ** 2),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the recording pipeline with synthetic '
+        'cameras.')
+    parser.add_argument('--out', required=True,
+                        help='The directory where the videos are written.')
+    parser.add_argument('--cams', type=int, default=4)
+    parser.add_argument('--size', default='720x480', help='e.g. 720x480')
+    parser.add_argument('--fmt', default='gray', choices=['gray', 'rgb24'])
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--duration', type=float, default=10.,
+                        help='The duration of each trial in seconds.')
+    parser.add_argument('--trials', type=int, default=1)
+    parser.add_argument('--codec', default='rawvideo')
+    parser.add_argument('--mux', action='store_true',
+                        help='Write all the cameras to one file.')
+    args = parser.parse_args(args)
+
+    w, h = [int(v) for v in args.size.lower().split('x')]
+    res = run_benchmark(
+        args.out, cams=args.cams, size=(w, h), fmt=args.fmt, fps=args.fps,
+        duration=args.duration, codec=args.codec, mux=args.mux,
+        trials=args.trials)
+
+    rss = res['peak_rss']
+    print('Elapsed: {:.2f}s, CPU: {:.1f}%, peak RSS: {}'.format(
+        res['elapsed'], res['cpu'],
+        'n/a' if rss is None else '{:.1f}MB'.format(rss)))
+    print('Frames sent: {}, received: {}, written: {}, dropped: {}, '
+          'gaps: {}, sent late: {}'.format(
+              res['sent'], res['received'], res['written'], res['dropped'],
+              res['gaps'], res['late']))
+    print('Throughput: {:.1f} frames/s, {:.1f} MB/s'.format(
+        res['fps'], res['mbps']))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,44 +2,100 @@
 '''
 
 
-__all__ = ('DeviceStageInterface', 'Server', 'FTDIDevChannel', 'FTDIOdorsBase',
-           'FTDIOdorsSim', 'FTDIOdors', 'DAQInDeviceBase', 'DAQInDeviceSim',
-           'DAQInDevice', 'DAQOutDeviceBase', 'DAQOutDeviceSim',
-           'DAQOutDevice', 'MassFlowControllerBase', 'MassFlowControllerSim',
-           'MFCSafe', 'MassFlowController', 'FFpyPlayer')
+__all__ = ('Server', 'FTDIDevChannel', 'FTDIOdorsBase', 'FTDIOdorsSim',
+           'DAQInDeviceBase', 'DAQInDeviceSim', 'DAQInDevice',
+           'DAQOutDeviceBase', 'DAQOutDeviceSim', 'DAQOutDevice',
+           'MassFlowControllerBase', 'MassFlowControllerSim', 'MFCSafe',
+           'MassFlowController', 'FFpyPlayer')
 
-from threading import Thread
+import os
+from struct import Struct
+from threading import Thread, Lock, Condition
+from collections import deque
+from heapq import heappush, heappop
+from time import time, sleep
 try:
-    from Queue import Queue
-except:
-    from queue import Queue
+    from time import perf_counter as clock
+except ImportError:
+    from time import clock
 
-from ffpyplayer.writer import MediaWriter
-
-from moa.compat import unicode_type
 from moa.base import MoaBase
-from moa.device.digital import ButtonPort
+from moa.device.digital import ButtonPort, DigitalPort, DigitalChannel
 from moa.utils import ConfigPropertyList
 from moa.logger import Logger
 
-from cplcom.device.ftdi import FTDISerializerDevice, FTDIPinDevice
-from cplcom.device.rtv import RTVChan as MoaRTVChan
-from cplcom.device.ffplayer import FFPyPlayerDevice
-
 from kivy.properties import (
-    ConfigParserProperty, BooleanProperty, ListProperty, ObjectProperty,
-    NumericProperty, StringProperty)
-from kivy.resources import resource_find
+    BooleanProperty, ObjectProperty, NumericProperty)
+from kivy.clock import Clock
+
+from sock_cond.timing import clock as exp_clock, get_time_source
+from sock_cond.lazy import import_timed
 
 from cplcom import device_config_name, exp_config_name
-from cplcom.device import DeviceStageInterface
 
 
-class FTDIOdorsBase(object):
+class ValveMaskBehavior(object):
+    '''Adds control of the ``p0``, ..., ``pN`` odor valves using integer
+    bitmasks, where bit ``i`` is valve ``pi``.
+
+    Sets of valves are compiled once into masks with :meth:`compile_mask`,
+    then :meth:`set_mask` changes the valves of a mask with a per-board table
+    lookup, rather than per-valve name processing.
+    '''
+
+    num_valves = 0
+    '''The number of valves, ``N``. '''
+
+    # for each board, the names of the valves set in each of the 256 bytes
+    _board_names = []
+
+    def init_valve_masks(self, N):
+        '''Builds the lookup tables for `N` valves.
+        '''
+        self.num_valves = N
+        boards = []
+        for b in range((N + 7) // 8):
+            names = ['p{}'.format(i) for i in range(8 * b, min(N, 8 * b + 8))]
+            boards.append([
+                tuple(name for i, name in enumerate(names) if byte & (1 << i))
+                for byte in range(256)])
+        self._board_names = boards
+
+    def compile_mask(self, names):
+        '''Returns the mask of the valves named in `names`.
+        '''
+        mask = 0
+        for name in names:
+            i = int(name[1:])
+            if i >= self.num_valves:
+                raise Exception('Valve {} is out of bounds'.format(name))
+            mask |= 1 << i
+        return mask
+
+    def mask_names(self, mask):
+        '''Returns the names of the valves in `mask`.
+        '''
+        names = []
+        for b, table in enumerate(self._board_names):
+            byte = (mask >> (8 * b)) & 0xFF
+            if byte:
+                names.extend(table[byte])
+        return names
+
+    def set_mask(self, high_mask=0, low_mask=0):
+        '''Sets the valves in `high_mask` high and the valves in `low_mask`
+        low.
+        '''
+        self.set_state(
+            high=self.mask_names(high_mask), low=self.mask_names(low_mask))
+
+
+class FTDIOdorsBase(ValveMaskBehavior):
     '''Base class for the FTDI odor devices.
     '''
 
     def __init__(self, odor_btns=None, N=8, **kwargs):
+        self.init_valve_masks(N)
         Nb = len(odor_btns)
         for i in range(N):
             self.create_property('p{}'.format(i), value=False, allownone=True)
@@ -55,18 +111,23 @@ class FTDIOdorsSim(FTDIOdorsBase, ButtonPort):
     pass
 
 
-class FTDIOdors(FTDIOdorsBase, FTDISerializerDevice):
-    '''Device used when using the barst ftdi odor devices.
+def get_shocker_name(chamber):
+    '''Returns the name of the pin device channel of the shocker of
+    `chamber`. The first chamber's is ``'shocker'``.
     '''
-
-    def __init__(self, N=8, **kwargs):
-        dev_map = {'p{}'.format(i): i for i in range(N)}
-        super(FTDIOdors, self).__init__(dev_map=dev_map, N=N, **kwargs)
+    return 'shocker{}'.format(chamber) if chamber else 'shocker'
 
 
 class FTDIPortBase(object):
+    '''Base class for the FTDI pin devices. It has a shocker channel for
+    each of `num_shockers` chambers, see :func:`get_shocker_name`. Only the
+    first is backed by the `shocker_btn` button.
+    '''
 
-    def __init__(self, shocker_btn=None, **kwargs):
+    def __init__(self, shocker_btn=None, num_shockers=1, **kwargs):
+        for i in range(1, num_shockers):
+            self.create_property(
+                get_shocker_name(i), value=False, allownone=True)
         attr_map = {'shocker': shocker_btn}
         super(FTDIPortBase, self).__init__(
             attr_map=attr_map, direction='o', **kwargs)
@@ -80,17 +141,743 @@ class FTDIPortSim(FTDIPortBase, ButtonPort):
     pass
 
 
-class FTDIPort(FTDIPortBase, FTDIPinDevice):
-    '''Device used when using the barst ftdi odor devices.
+class VirtualDeviceBase(object):
+    '''Base class for the devices used instead of the simulation devices
+    when running headless, i.e. without any widgets.
+
+    Instead of mirroring their state in buttons, they record every state
+    change in :attr:`events`.
+    '''
+
+    events = None
+    '''A list of ``(t, name, state)`` tuples, one for each state change, where
+    ``t`` is the time of the change as returned by :attr:`clock`.
     '''
 
+    clock = None
+    '''The function that returns the time of each event. Defaults to
+    :func:`sock_cond.timing.clock`.
+    '''
+
+    def __init__(self, clock=exp_clock, **kwargs):
+        self.events = []
+        self.clock = clock
+        super(VirtualDeviceBase, self).__init__(**kwargs)
+
+    def _set_attrs(self, high=(), low=()):
+        t = self.clock()
+        events = self.events
+        for name in high:
+            setattr(self, name, True)
+            events.append((t, name, True))
+        for name in low:
+            setattr(self, name, False)
+            events.append((t, name, False))
+
+
+class VirtualChannel(VirtualDeviceBase, DigitalChannel):
+    '''A single channel device, e.g. used instead of the next animal button.
+    '''
+
+    def set_state(self, state, **kwargs):
+        if state:
+            self._set_attrs(high=['state'])
+        else:
+            self._set_attrs(low=['state'])
+
+
+class FTDIOdorsVirtual(ValveMaskBehavior, VirtualDeviceBase, DigitalPort):
+    '''Device used instead of :class:`FTDIOdorsSim` when running headless.
+    '''
+
+    def __init__(self, N=8, **kwargs):
+        self.init_valve_masks(N)
+        for i in range(N):
+            self.create_property('p{}'.format(i), value=False, allownone=True)
+        super(FTDIOdorsVirtual, self).__init__(**kwargs)
+
+    def set_state(self, high=[], low=[], **kwargs):
+        self._set_attrs(high=high, low=low)
+
+
+class FTDIPortVirtual(VirtualDeviceBase, DigitalPort):
+    '''Device used instead of :class:`FTDIPortSim` when running headless.
+    '''
+
+    shocker = BooleanProperty(False, allownone=True)
+
+    def __init__(self, num_shockers=1, **kwargs):
+        for i in range(1, num_shockers):
+            self.create_property(
+                get_shocker_name(i), value=False, allownone=True)
+        super(FTDIPortVirtual, self).__init__(**kwargs)
+
+    def set_state(self, high=[], low=[], **kwargs):
+        self._set_attrs(high=high, low=low)
+
+
+class DeviceStateBatcher(object):
+    '''Coalesces all the ``set_state`` requests made for a device during the
+    same clock tick into a single ``set_state`` call of the device, e.g. a
+    single FTDI write for all the odor valves changed in that tick.
+
+    The requests are made with :meth:`set_state`, or :meth:`set_mask` for
+    devices with a :class:`ValveMaskBehavior`, and are sent at the end of the
+    tick. If a channel is requested both high and low in the same tick, the
+    last request wins.
+
+    Requests made with a `name` are recorded in their `timing_log`, or
+    :attr:`timing_log`, once sent.
+    '''
+
+    timing_log = None
+    '''If not None, the default :class:`StimulusTimingLog` in which the named
+    requests are recorded.
+    '''
+
+    lock = None
+    '''The lock held while the batched states are sent to the devices. Other
+    threads writing to the same devices, e.g. the
+    :class:`StimulusSequencer`, must hold it while writing.
+    '''
+
+    _pending = None
+    _trigger = None
+
     def __init__(self, **kwargs):
-        dev_map = {'shocker': self.shocker_pin}
-        super(FTDIPort, self).__init__(dev_map=dev_map, **kwargs)
-        self.init_vals['bitmask'] = 1 << self.shocker_pin
+        super(DeviceStateBatcher, self).__init__(**kwargs)
+        # the pending states of each device, in the order first requested
+        self._pending = []
+        self.lock = Lock()
+        # -1 runs it at the end of the current tick, not the next one
+        self._trigger = Clock.create_trigger(self.flush, -1)
+
+    def _get_pending(self, dev):
+        for pending in self._pending:
+            if pending[0] is dev:
+                return pending
+        # the device, the channel states, the high and low masks, and the
+        # timings of the named requests
+        pending = [dev, {}, 0, 0, []]
+        self._pending.append(pending)
+        return pending
+
+    def _add_timing(self, pending, name, requested, timing_log):
+        timing_log = timing_log or self.timing_log
+        if name is None or timing_log is None:
+            return
+        t = exp_clock()
+        pending[4].append(
+            (timing_log, name, t if requested is None else requested, t))
+
+    def set_state(self, dev, high=[], low=[], name=None, requested=None,
+                  timing_log=None):
+        '''Requests that the channels in `high` and `low` of `dev` be set to
+        high and low, respectively.
+
+        If `name` is not None, the request is recorded under that name in
+        `timing_log`, or :attr:`timing_log` if None, with `requested` as the
+        time the change was intended for. If `requested` is None, it's the
+        time of the request.
+        '''
+        pending = self._get_pending(dev)
+        states = pending[1]
+        for channel in high:
+            states[channel] = True
+        for channel in low:
+            states[channel] = False
+        self._add_timing(pending, name, requested, timing_log)
+        self._trigger()
+
+    def set_mask(self, dev, high_mask=0, low_mask=0, name=None,
+                 requested=None, timing_log=None):
+        '''Requests that the valves in the masks `high_mask` and `low_mask` of
+        `dev` be set to high and low, respectively. `name`, `requested`, and
+        `timing_log` are as in :meth:`set_state`.
+        '''
+        pending = self._get_pending(dev)
+        pending[2] = (pending[2] & ~low_mask) | high_mask
+        pending[3] = (pending[3] & ~high_mask) | low_mask
+        self._add_timing(pending, name, requested, timing_log)
+        self._trigger()
+
+    def flush(self, *largs):
+        '''Sends the pending requests now, one ``set_state`` or ``set_mask``
+        call per device.
+        '''
+        pending = self._pending
+        self._pending = []
+        for dev, states, high_mask, low_mask, timings in pending:
+            with self.lock:
+                if high_mask or low_mask:
+                    dev.set_mask(high_mask, low_mask)
+                if states:
+                    dev.set_state(
+                        high=[name for name, val in states.items() if val],
+                        low=[name for name, val in states.items() if not val])
+            if timings:
+                returned = exp_clock()
+                for timing_log, name, requested, issued in timings:
+                    timing_log.add(name, requested, issued, returned)
+
+    def clear(self):
+        '''Drops the pending requests.
+        '''
+        self._pending = []
+        Clock.unschedule(self._trigger)
+
+
+class StimulusTimingLog(object):
+    '''Records the timing of the odor and shock state changes, and reports
+    their jitter.
+
+    For each change, it records the time it was intended for (requested), the
+    time it was issued to the device (issued), the time the device call
+    returned (returned), and the camera pts nearest to the returned time. For
+    the barst devices, the call returns once the request is queued to the
+    server.
+    '''
+
+    pts_source = None
+    '''If not None, a function that returns the camera pts nearest to the
+    time it's called with, or None.
+    '''
+
+    records = []
+    '''A list of ``(name, requested, issued, returned, pts)`` tuples, one for
+    each state change.
+    '''
+
+    def __init__(self, pts_source=None, **kwargs):
+        super(StimulusTimingLog, self).__init__(**kwargs)
+        self.pts_source = pts_source
+        self.records = []
+
+    def add(self, name, requested, issued, returned):
+        '''Records a state change of `name`. It may be called from any
+        thread.
+        '''
+        source = self.pts_source
+        pts = source(returned) if source is not None else None
+        self.records.append((name, requested, issued, returned, pts))
+
+    def clear(self):
+        self.records = []
+
+    def get_report(self, bin_width=0.001):
+        '''Returns a dict, keyed by the names of the state changes, of the
+        jitter of the state changes of that name. Each value is a dict with
+        the ``count``, the ``sched`` and ``send`` 50, 90, 99, and 100
+        percentiles, in seconds, of the issued minus requested, and returned
+        minus issued times, respectively, and the ``histogram`` of the
+        returned minus requested times, a sorted list of ``(bin start,
+        count)`` tuples, with bins of `bin_width` seconds.
+        '''
+        names = {}
+        for name, requested, issued, returned, _ in self.records:
+            names.setdefault(name, []).append((requested, issued, returned))
+
+        pcts = [50, 90, 99, 100]
+        report = {}
+        for name, times in names.items():
+            bins = {}
+            for requested, _, returned in times:
+                i = int((returned - requested) // bin_width)
+                bins[i] = bins.get(i, 0) + 1
+            report[name] = {
+                'count': len(times),
+                'sched': percentiles([i - r for r, i, _ in times], pcts),
+                'send': percentiles([t - i for _, i, t in times], pcts),
+                'histogram': [(i * bin_width, bins[i]) for i in sorted(bins)]}
+        return report
+
+    def write_report(self, filename, bin_width=0.001):
+        '''Writes the :meth:`get_report` of the state changes to the csv
+        file `filename`, followed by each of the :attr:`records`. The times
+        are in ms.
+        '''
+        report = self.get_report(bin_width)
+        with open(filename, 'w') as fd:
+            fd.write('Stimulus,Count,Sched 50%,Sched 90%,Sched 99%,'
+                     'Sched max,Send 50%,Send 90%,Send 99%,Send max,'
+                     'Histogram (bin:count)\n')
+            for name in sorted(report):
+                res = report[name]
+                fd.write('{},{},{},{},{}\n'.format(
+                    name, res['count'],
+                    ','.join('{:.3f}'.format(v * 1000.)
+                             for v in res['sched']),
+                    ','.join('{:.3f}'.format(v * 1000.)
+                             for v in res['send']),
+                    ' '.join('{:.0f}:{}'.format(t * 1000., count)
+                             for t, count in res['histogram'])))
+
+            fd.write('\nStimulus,Requested,Issued,Returned,Pts\n')
+            for name, requested, issued, returned, pts in self.records:
+                fd.write('{},{:.6f},{:.6f},{:.6f},{}\n'.format(
+                    name, requested, issued, returned,
+                    '' if pts is None else '{:.6f}'.format(pts)))
+
+
+def raise_thread_priority():
+    '''Raises the priority of the calling thread to time critical, where
+    supported (Windows). Returns whether it succeeded.
+    '''
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+    except (ImportError, AttributeError):
+        return False
+    # THREAD_PRIORITY_TIME_CRITICAL
+    return bool(kernel32.SetThreadPriority(kernel32.GetCurrentThread(), 15))
+
+
+class StimulusSequencer(object):
+    '''Executes timelines of device state changes from its own high priority
+    thread, so that their timing doesn't depend on the load of the kivy
+    thread.
+
+    Each event of a timeline is called at its requested time of
+    :attr:`clock`. The thread sleeps until :attr:`spin_time` before the
+    event, and busy waits the rest of the time, since sleeping isn't precise
+    enough. The requested, achieved, and returned times of each event are
+    recorded in its timing log, or :attr:`timing_log`, if set. An event that
+    executes later, e.g. from another thread, uses :meth:`defer` so that
+    it's recorded once executed.
+    '''
+
+    clock = None
+    '''The function returning the time of the events. '''
+
+    spin_time = 0.002
+    '''The time, in seconds, before each event during which the thread busy
+    waits rather than sleeps.
+    '''
+
+    max_sleep = 0.01
+    '''The longest time the thread sleeps before checking the time again.
+    '''
+
+    exception_callback = None
+    '''If not None, called with the exception raised by an event.
+    '''
+
+    timing_log = None
+    '''If not None, the default :class:`StimulusTimingLog` in which each
+    event executed is recorded.
+    '''
+
+    _events = []
+    _count = 0
+    _cond = None
+    _thread = None
+    _stop = False
+    # the name, requested time, and timing log of the event being called
+    _current = None
+    _deferred = False
+    # incremented when the events are dropped, so deferred events are too
+    _generation = 0
+
+    def __init__(self, clock=exp_clock, exception_callback=None, **kwargs):
+        super(StimulusSequencer, self).__init__(**kwargs)
+        self.clock = clock
+        self.exception_callback = exception_callback
+        self._events = []
+        self._cond = Condition()
+
+    def start(self):
+        '''Starts the sequencer's thread, if it's not running.
+        '''
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stop = False
+            self._thread = Thread(
+                target=self._run_events, name='Stimulus sequencer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, join=False):
+        '''Stops the sequencer's thread, dropping the pending events, including
+        the deferred events not yet executed. The caller must turn off the
+        stimuli whose off events were dropped.
+        '''
+        with self._cond:
+            thread = self._thread
+            self._thread = None
+            self._stop = True
+            self._events = []
+            self._generation += 1
+            self._cond.notify()
+        if join and thread is not None:
+            thread.join()
+
+    def schedule(self, timeline, timing_log=None):
+        '''Adds the events of `timeline`, a list of ``(t, name, callback)``
+        tuples, where ``callback`` is called with no arguments at time ``t``.
+        They are recorded in `timing_log`, or :attr:`timing_log` if None.
+        '''
+        timing_log = timing_log or self.timing_log
+        self.start()
+        with self._cond:
+            for t, name, callback in timeline:
+                # the count keeps events of the same time in order
+                heappush(self._events, (
+                    t, self._count, name, callback, timing_log))
+                self._count += 1
+            self._cond.notify()
+
+    def cancel(self):
+        '''Drops the pending events, like :meth:`stop`, without stopping the
+        thread.
+        '''
+        with self._cond:
+            self._events = []
+            self._generation += 1
+            self._cond.notify()
+
+    def defer(self, f, *largs, **kwargs):
+        '''Called from the callback of an event to execute the event later,
+        e.g. from the kivy thread. Returns a function which calls `f` with
+        the arguments, and records the times of the event when called,
+        rather than when the callback returned.
+        '''
+        name, t, timing_log = self._current
+        self._deferred = True
+        clock = self.clock
+        generation = self._generation
+
+        def call(*l):
+            if generation != self._generation:
+                return
+            achieved = clock()
+            f(*largs, **kwargs)
+            if timing_log is not None:
+                timing_log.add(name, t, achieved, clock())
+        return call
+
+    def _run_events(self):
+        raise_thread_priority()
+        cond = self._cond
+        clock = self.clock
+        spin_time = self.spin_time
+        while True:
+            with cond:
+                while not self._stop and not self._events:
+                    cond.wait()
+                if self._stop:
+                    return
+
+                t = self._events[0][0]
+                remaining = t - clock()
+                if remaining > spin_time:
+                    # wake up early in case an earlier event is scheduled
+                    source = get_time_source()
+                    speed = source.speed if source is not None else 1.
+                    cond.wait(
+                        min((remaining - spin_time) / speed, self.max_sleep))
+                    continue
+                t, _, name, callback, timing_log = heappop(self._events)
+
+            while clock() < t:
+                pass
+            self._current = name, t, timing_log
+            self._deferred = False
+            achieved = clock()
+            try:
+                callback()
+            except Exception as e:
+                if self.exception_callback is not None:
+                    self.exception_callback(e)
+            if timing_log is not None and not self._deferred:
+                timing_log.add(name, t, achieved, clock())
+            Logger.debug('Sequencer: {} requested at {:.6f}, achieved at '
+                         '{:.6f}'.format(name, t, achieved))
+
+
+class DeviceCallResult(object):
+    '''The outcome of calling a method of a device with
+    :func:`call_devices_parallel`.
+    '''
+
+    __slots__ = ('device', 'latency', 'attempts', 'exception')
+
+    def __init__(self, device):
+        self.device = device
+        self.latency = None
+        self.attempts = 0
+        self.exception = None
+
+    @property
+    def name(self):
+        '''The name of the device, or its class name if unnamed. '''
+        return getattr(self.device, 'name', '') or \
+            self.device.__class__.__name__
+
+
+def _call_device(result, method, retries, retry_delay):
+    f = getattr(result.device, method)
+    ts = clock()
+    while True:
+        result.attempts += 1
+        try:
+            f()
+            result.exception = None
+            break
+        except Exception as e:
+            result.exception = e
+            if result.attempts > retries:
+                break
+            Logger.warning('Devices: {}.{} failed ({}), retrying'.format(
+                result.name, method, e))
+            sleep(retry_delay)
+    result.latency = clock() - ts
+
+
+def call_devices_parallel(devices, method, timeout=None, retries=0,
+                          retry_delay=0.5):
+    '''Calls the method named `method` of each of `devices`, each from its
+    own thread, and waits until all returned or `timeout` seconds passed.
+    A call that raises is retried up to `retries` times, `retry_delay`
+    seconds apart.
+
+    It returns a list with the :class:`DeviceCallResult` of each device. A
+    call that didn't return within `timeout` gets a timeout exception; its
+    thread, which can't be interrupted, is left to finish on its own. None
+    devices are skipped.
+    '''
+    results = [DeviceCallResult(dev) for dev in devices if dev is not None]
+    threads = []
+    for result in results:
+        thread = Thread(
+            target=_call_device, args=(result, method, retries, retry_delay),
+            name='{} {}'.format(method, result.name))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    end = None if timeout is None else clock() + timeout
+    for result, thread in zip(results, threads):
+        thread.join(None if end is None else max(end - clock(), 0))
+        if thread.is_alive():
+            result.exception = Exception(
+                '{}.{} did not return within {}s'.format(
+                    result.name, method, timeout))
+    for result in results:
+        if result.latency is None:
+            Logger.info('Devices: {}.{} timed out'.format(result.name, method))
+        else:
+            Logger.info('Devices: {}.{} took {:.3f}s ({} attempts)'.format(
+                result.name, method, result.latency, result.attempts))
+    return results
+
+
+class MockChannelBase(object):
+    '''Base class for the devices that connect to a
+    :class:`~sock_cond.barst_mock.MockBarstServer` instead of Barst. Each
+    device opens its own channel to the server.
+    '''
+
+    mock_kind = ''
+    '''The kind of the channel opened. '''
+
+    _conn = None
+    _conn_lock = None
+
+    def open_channel(self, address, **params):
+        '''Opens the channel to the server at `address`, and returns the
+        response.
+        '''
+        self.close_channel()
+        if self._conn_lock is None:
+            self._conn_lock = Lock()
+        conn = import_timed('sock_cond.barst_mock').MockBarstConnection(
+            address)
+        try:
+            response = conn.request(
+                'open', kind=self.mock_kind, name=self.name, **params)
+        except Exception:
+            conn.close()
+            raise
+        self._conn = conn
+        return response
+
+    def close_channel(self):
+        conn = self._conn
+        if conn is not None:
+            self._conn = None
+            conn.close()
+
+    def stop_channel(self):
+        self.close_channel()
+
+    def stop_device(self):
+        pass
+
+
+class MockServer(object):
+    '''Used instead of :class:`~cplcom.device.barst_server.Server` when the
+    devices connect to a mock Barst server, see :attr:`address`.
+    '''
+
+    name = 'server'
+
+    address = None
+    '''The ``(host, port)`` of the mock server. '''
+
+    local_server = None
+    '''The :class:`~sock_cond.barst_mock.MockBarstServer` started by
+    :meth:`create_device`, if any.
+    '''
+
+    def __init__(self, address='local', **kwargs):
+        super(MockServer, self).__init__(**kwargs)
+        self._address = address
+
+    def create_device(self):
+        '''Starts a :class:`~sock_cond.barst_mock.MockBarstServer` in the
+        process if the address is ``'local'``, otherwise it's the
+        ``'host:port'`` of a running server.
+        '''
+        barst_mock = import_timed('sock_cond.barst_mock')
+        if self._address == 'local':
+            server = self.local_server = barst_mock.MockBarstServer()
+            server.start()
+            self.address = server.address
+        else:
+            self.address = barst_mock.parse_address(self._address)
+
+    def start_channel(self):
+        conn = import_timed('sock_cond.barst_mock').MockBarstConnection(
+            self.address)
+        try:
+            conn.request('stats')
+        finally:
+            conn.close()
+
+    def stop_channel(self):
+        pass
+
+    def stop_device(self):
+        server = self.local_server
+        if server is not None:
+            self.local_server = None
+            server.stop()
+
 
-    shocker_pin = ConfigParserProperty(
+class MockFTDIDevChannel(object):
+    '''Used instead of :class:`~cplcom.device.ftdi.FTDIDevChannel` when the
+    devices connect to a mock Barst server. It opens the channels of its
+    devices.
+    '''
+
+    name = 'ftdi'
+
+    devs = []
+
+    server = None
+
+    def create_device(self, devs, server):
+        self.devs = devs
+        self.server = server
+
+    def start_channel(self):
+        for dev in self.devs:
+            dev.open_channel(self.server.address)
+
+    def stop_channel(self):
+        for dev in self.devs:
+            dev.close_channel()
+
+    def stop_device(self):
+        pass
+
+
+class MockFTDIWriterBase(MockChannelBase):
+    '''Writes the bits of the channels set high to the server whenever the
+    state is set, like the FTDI devices write to the board.
+    '''
+
+    dev_map = {}
+    '''The bit of each channel. '''
+
+    _value = 0
+
+    def set_state(self, high=[], low=[], **kwargs):
+        dev_map = self.dev_map
+        with self._conn_lock:
+            value = self._value
+            for name in high:
+                value |= 1 << dev_map[name]
+            for name in low:
+                value &= ~(1 << dev_map[name])
+            self._conn.request('write', value=value)
+            self._value = value
+        self._set_attrs(high=high, low=low)
+
+
+class MockFTDIOdors(MockFTDIWriterBase, FTDIOdorsVirtual):
+    '''Used instead of :class:`~sock_cond.barst_devices.FTDIOdors` with a
+    mock Barst server.
+    '''
+
+    mock_kind = 'serializer'
+
+    def __init__(self, odor_btns=None, N=8, **kwargs):
+        self.dev_map = {'p{}'.format(i): i for i in range(N)}
+        super(MockFTDIOdors, self).__init__(N=N, **kwargs)
+
+
+class MockFTDIPort(MockFTDIWriterBase, FTDIPortVirtual):
+    '''Used instead of :class:`~sock_cond.barst_devices.FTDIPort` with a
+    mock Barst server.
+    '''
+
+    mock_kind = 'pin'
+
+    def __init__(self, shocker_btn=None, num_shockers=1, **kwargs):
+        pins = self.shocker_pin
+        if len(pins) < num_shockers:
+            raise Exception('Only {} shocker pins are configured for {} '
+                            'chambers'.format(len(pins), num_shockers))
+        self.dev_map = {
+            get_shocker_name(i): pins[i] for i in range(num_shockers)}
+        super(MockFTDIPort, self).__init__(
+            num_shockers=num_shockers, **kwargs)
+
+    shocker_pin = ConfigPropertyList(
         0, 'FTDI_pin', 'shocker_pin', device_config_name, val_type=int)
+    '''See :attr:`~sock_cond.barst_devices.FTDIPort.shocker_pin`. '''
+
+
+def get_cam_value(values, idx):
+    '''Returns the value for camera `idx` from the per-camera config list
+    `values`. The last value is used for cameras beyond the list.
+    '''
+    if idx >= len(values):
+        return values[-1]
+    return values[idx]
+
+
+def percentiles(values, pcts):
+    '''Returns the nearest-rank percentiles `pcts` (0-100) of `values`, or
+    zeros if `values` is empty.
+    '''
+    if not values:
+        return [0, ] * len(pcts)
+    values = sorted(values)
+    n = len(values)
+    return [values[min(n - 1, max(0, int(round(p / 100. * n)) - 1))]
+            for p in pcts]
+
+
+def get_rate(rate):
+    '''Returns the frame rate as a float, from either a number or a
+    ``(num, den)`` tuple as used by the players.
+    '''
+    if isinstance(rate, (tuple, list)):
+        return rate[0] / float(rate[1])
+    return float(rate)
 
 
 def verify_out_fmt(fmt):
@@ -110,24 +897,106 @@ class RTVChanBase(object):
         val_type=verify_out_fmt)
 
 
-class RTVChanSim(FFPyPlayerDevice, RTVChanBase):
+class SyntheticCamera(object):
+    '''A camera that calls :attr:`callback` with frames of random noise at
+    :attr:`rate`, from its own thread, like the players do.
 
-    def __init__(self, **kwargs):
-        super(RTVChanSim, self).__init__(**kwargs)
-        names = self.video_name
-        if self.idx >= len(names):
-            self.filename = resource_find(names[-1])
-        else:
-            self.filename = resource_find(names[self.idx])
-        fmts = self.img_fmt
-        if self.idx >= fmts:
-            self.output_img_fmt = fmts[-1]
+    It has the ``size``, ``rate``, and ``output_img_fmt`` attributes read by
+    :class:`~sock_cond.writer_devices.FFPyWriterDevice`. It's used instead of
+    the players by the benchmark and when running headless.
+    '''
+
+    size = None
+    '''The ``(w, h)`` size of the frames. '''
+
+    rate = None
+    '''The frame rate, as a ``(num, den)`` tuple. '''
+
+    output_img_fmt = 'gray'
+    '''The pixel format of the frames, either ``'gray'`` or ``'rgb24'``. '''
+
+    callback = None
+    '''Called with ``(image, pts)`` for each frame. '''
+
+    frames_sent = 0
+    '''The number of frames passed to :attr:`callback`. '''
+
+    late_frames = 0
+    '''The number of frames sent more than a frame late, because the
+    callback could not keep up.
+    '''
+
+    _thread = None
+    _stop = False
+
+    name = ''
+    '''The name of the camera. '''
+
+    def __init__(self, callback, size=(720, 480), fmt='gray', fps=30,
+                 num_buffers=8, name='', **kwargs):
+        super(SyntheticCamera, self).__init__(**kwargs)
+        self.name = name
+        self.callback = callback
+        self.size = size
+        self.rate = (int(round(fps * 1000)), 1000)
+        self.output_img_fmt = fmt
+        bpp = 1 if fmt == 'gray' else 3
+        # noise, so that compressed codecs do as much work as with real video
+        self._buffers = [
+            bytearray(os.urandom(size[0] * size[1] * bpp))
+            for _ in range(num_buffers)]
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop = False
+        self._thread = Thread(target=self._run, name='Synthetic camera')
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def set_state(self, state):
+        '''Starts or stops the camera, like the players' ``set_state``.
+        '''
+        if state:
+            self.start()
         else:
-            self.output_img_fmt = fmts[self.idx]
+            self.stop()
+
+    def activate(self, identifier, **kwargs):
+        pass
+
+    def deactivate(self, identifier, clear=False, **kwargs):
+        self.stop()
 
-    video_name = ConfigPropertyList(
-        'Wildlife.mp4', 'Video', 'video_name', exp_config_name,
-        val_type=unicode_type)
+    def _run(self):
+        Image = import_timed('ffpyplayer.pic').Image
+        buffers = self._buffers
+        size = self.size
+        fmt = self.output_img_fmt
+        period = self.rate[1] / float(self.rate[0])
+        callback = self.callback
+        start = clock()
+        i = 0
+
+        while not self._stop:
+            t = start + i * period
+            delay = t - clock()
+            if delay > 0:
+                sleep(delay)
+            elif delay < -period:
+                self.late_frames += 1
+
+            img = Image(
+                plane_buffers=[buffers[i % len(buffers)]], pix_fmt=fmt,
+                size=size)
+            callback(img, i * period)
+            self.frames_sent += 1
+            i += 1
 
 
 def verify_video_fmt(fmt):
@@ -137,58 +1006,420 @@ def verify_video_fmt(fmt):
     return fmt
 
 
-class RTVChan(MoaRTVChan, RTVChanBase):
+class MockRTVChan(MockChannelBase, MoaBase, RTVChanBase):
+    '''Used instead of :class:`~sock_cond.barst_devices.RTVChan` with a
+    mock Barst server. It calls :attr:`callback` with the frames streamed by
+    the server from its own thread, like the players do.
+    '''
 
-    def __init__(self, **kwargs):
-        super(RTVChan, self).__init__(**kwargs)
+    mock_kind = 'rtv'
+
+    size = None
+    '''The ``(w, h)`` size of the frames. '''
+
+    rate = None
+    '''The frame rate, as a ``(num, den)`` tuple. '''
+
+    output_img_fmt = 'gray'
+
+    _server = None
+    _thread = None
+
+    def __init__(self, button=None, port=0, **kwargs):
+        super(MockRTVChan, self).__init__(**kwargs)
         n = self.idx
-        self.output_img_fmt = self.img_fmt[n]
-        self.output_video_fmt = self.video_fmt[n]
+        self.output_img_fmt = get_cam_value(self.img_fmt, n)
+        self.output_video_fmt = get_cam_value(self.video_fmt, n)
+
+    def create_device(self, server):
+        self._server = server
+
+    def start_channel(self):
+        response = self.open_channel(
+            self._server.address, video_fmt=self.output_video_fmt,
+            pix_fmt=self.output_img_fmt)
+        self.size = tuple(response['size'])
+        self.rate = (int(round(response['rate'] * 1000)), 1000)
+
+    def stop_channel(self):
+        self.set_state(False)
+        self.close_channel()
+
+    def set_state(self, state):
+        '''Starts or stops the stream of frames.
+        '''
+        if self._conn is None:
+            return
+        with self._conn_lock:
+            if bool(state) == (self._thread is not None):
+                return
+            if state:
+                self._conn.request('start')
+                self._thread = Thread(
+                    target=self._read_frames, name='Mock RTV {}'.format(
+                        self.name))
+                self._thread.daemon = True
+                self._thread.start()
+                return
+            self._conn.send('stop')
+            self._thread.join()
+            self._thread = None
+
+    def activate(self, identifier, **kwargs):
+        pass
+
+    def deactivate(self, identifier, clear=False, **kwargs):
+        self.set_state(False)
+
+    def _read_frames(self):
+        Image = import_timed('ffpyplayer.pic').Image
+        conn = self._conn
+        callback = self.callback
+        size = self.size
+        fmt = self.output_img_fmt
+        try:
+            while True:
+                frame = conn.read_frame()
+                if frame is None:
+                    break
+                pts, data = frame
+                callback(
+                    Image(plane_buffers=[data], pix_fmt=fmt, size=size), pts)
+            conn.read_response()
+        except Exception as e:
+            Logger.error('Mock RTV {}: {}'.format(self.name, e))
 
     video_fmt = ConfigPropertyList(
         'full_NTSC', 'Video', 'video_fmt', exp_config_name,
         val_type=verify_video_fmt)
+    '''See :attr:`~sock_cond.barst_devices.RTVChan.video_fmt`. '''
+
+
+def verify_queue_unit(unit):
+    if unit not in ('frames', 'bytes'):
+        raise Exception('{} is not a valid queue size unit'.format(unit))
+    return unit
+
+
+def verify_queue_overflow(policy):
+    if policy not in ('drop_oldest', 'drop_newest', 'block'):
+        raise Exception('{} is not a valid queue overflow policy'.
+                        format(policy))
+    return policy
+
+
+class FrameQueue(object):
+    '''A bounded ring buffer of frames shared between the thread that
+    receives the frames and the thread that writes them to disk.
+
+    The capacity is either a number of frames or a number of bytes, depending
+    on :attr:`unit`. When full, :attr:`overflow` decides whether the oldest
+    queued frame is dropped, the new frame is dropped, or whether the producer
+    is blocked for up to :attr:`timeout` seconds, after which the new frame is
+    dropped.
+
+    Items are tuples whose first element names the item, e.g.
+    ``('frame', frame, pts)``, where ``frame`` is a :class:`SharedFrame`.
+    Items put with `force` (e.g. the ``'open'`` or ``'eof'`` commands) are
+    never dropped and do not count against the capacity. The frames of dropped
+    items are released.
+    '''
+
+    max_size = 0
+    '''The capacity of the queue. If zero, the queue is unbounded. '''
+
+    unit = 'frames'
+    '''Whether :attr:`max_size` is in ``'frames'`` or ``'bytes'``. '''
+
+    overflow = 'drop_oldest'
+    '''What to do when the queue is full. One of ``'drop_oldest'``,
+    ``'drop_newest'``, or ``'block'``.
+    '''
+
+    timeout = 1.
+    '''The maximum time the producer is blocked when :attr:`overflow` is
+    ``'block'``.
+    '''
+
+    size = 0
+    '''The current size of the queue in :attr:`unit`. '''
+
+    enqueued = 0
+    '''The number of frames added to the queue so far. '''
+
+    dropped = 0
+    '''The number of frames dropped so far due to a full queue. '''
+
+    high_water = 0
+    '''The largest :attr:`size` the queue has reached so far. '''
+
+    def __init__(self, max_size=0, unit='frames', overflow='drop_oldest',
+                 timeout=1., **kwargs):
+        super(FrameQueue, self).__init__(**kwargs)
+        self.max_size = max_size
+        self.unit = unit
+        self.overflow = overflow
+        self.timeout = timeout
+        self._items = deque()
+        lock = self._lock = Lock()
+        self._not_empty = Condition(lock)
+        self._not_full = Condition(lock)
+
+    def item_size(self, item):
+        '''Returns the size of a frame item in :attr:`unit`.
+        '''
+        if self.unit == 'frames':
+            return 1
+        return sum(item[1].image.get_buffer_size())
+
+    def _is_full(self, size):
+        max_size = self.max_size
+        # a single item larger than the queue is accepted when it's empty
+        return max_size and self.size and self.size + size > max_size
+
+    def put(self, item, force=False):
+        '''Adds the item to the queue and returns the number of frames that
+        were dropped as a result.
+        '''
+        size = 0 if force else self.item_size(item)
+        dropped = []
+        with self._lock:
+            overflow = None
+            if not force and self._is_full(size):
+                overflow = self.overflow
+                if overflow == 'block':
+                    end = time() + self.timeout
+                    while self._is_full(size):
+                        remaining = end - time()
+                        if remaining <= 0:
+                            break
+                        self._not_full.wait(remaining)
+
+                    overflow = 'drop_newest' if self._is_full(size) else None
+
+            if overflow == 'drop_newest':
+                dropped.append(item)
+            else:
+                items = self._items
+                while overflow and self._is_full(size):
+                    # markers are never dropped, so drop the oldest frame
+                    # queued, which may be behind them
+                    i = next(
+                        (i for i, (_, _, old_force) in enumerate(items)
+                         if not old_force), None)
+                    if i is None:
+                        break
+                    old_size, old_item, _ = items[i]
+                    del items[i]
+                    self.size -= old_size
+                    dropped.append(old_item)
+
+                items.append((size, item, force))
+                if not force:
+                    self.enqueued += 1
+                    self.size += size
+                    self.high_water = max(self.high_water, self.size)
+                self._not_empty.notify()
+            self.dropped += len(dropped)
+
+        for old_item in dropped:
+            old_item[1].release()
+        return len(dropped)
+
+    def get(self):
+        '''Removes and returns the next item from the queue, blocking until
+        one is available.
+        '''
+        with self._lock:
+            items = self._items
+            while not items:
+                self._not_empty.wait()
+            size, item, _ = items.popleft()
+            self.size -= size
+            self._not_full.notify()
+        return item
+
+
+class SharedFrame(object):
+    '''A frame shared by reference between the capture callback, the writer
+    thread, and the display, instead of being copied for each of them.
+
+    The frame is reference counted. Each consumer that holds on to it calls
+    :meth:`acquire`, and :meth:`release` when done with it. When the last
+    reference is released, the frame returns to its :class:`FramePool` to be
+    reused for a later frame.
+    '''
+
+    __slots__ = ('image', 'pts', 't', 'index', 'refs', 'pool')
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.image = None
+        self.pts = 0
+        # the time the frame was received, and its index in the camera
+        self.t = 0
+        self.index = 0
+        self.refs = 0
 
+    def acquire(self):
+        '''Adds a reference to the frame.
+        '''
+        self.pool.acquire(self)
 
-class FFPyWriterDevice(MoaBase, DeviceStageInterface):
+    def release(self):
+        '''Removes a reference to the frame.
+        '''
+        self.pool.release(self)
+
+
+class FramePool(object):
+    '''A per-camera pool of preallocated :class:`SharedFrame` that wrap the
+    images of a camera.
+
+    The images are never copied, the same image is referenced by all the
+    consumers of the frame, and the frame is recycled once released by all of
+    them. The pool also bounds the number of frames in flight to
+    :attr:`max_frames`, so that memory stays flat when a consumer falls behind.
+    '''
+
+    max_frames = 0
+    '''The number of frames preallocated. If zero, the pool grows as needed.
+    '''
+
+    outstanding = 0
+    '''The number of frames currently referenced by a consumer. '''
+
+    high_water = 0
+    '''The largest :attr:`outstanding` reached so far. '''
+
+    exhausted = 0
+    '''The number of images that were dropped because all the frames were in
+    use.
+    '''
+
+    def __init__(self, max_frames=0, **kwargs):
+        super(FramePool, self).__init__(**kwargs)
+        self.max_frames = max_frames
+        self._free = [SharedFrame(self) for _ in range(max_frames)]
+        self._lock = Lock()
+
+    def wrap(self, image, pts, t=0, index=0):
+        '''Returns a :class:`SharedFrame` referencing `image`, with one
+        reference held by the caller. `t` is the time the image was received,
+        and `index` its number in the camera. If the pool is exhausted, None
+        is returned.
+        '''
+        with self._lock:
+            free = self._free
+            if free:
+                frame = free.pop()
+            elif not self.max_frames:
+                frame = SharedFrame(self)
+            else:
+                self.exhausted += 1
+                return None
+
+            frame.image = image
+            frame.pts = pts
+            frame.t = t
+            frame.index = index
+            frame.refs = 1
+            self.outstanding += 1
+            self.high_water = max(self.high_water, self.outstanding)
+        return frame
+
+    def acquire(self, frame):
+        with self._lock:
+            frame.refs += 1
+
+    def release(self, frame):
+        with self._lock:
+            frame.refs -= 1
+            if frame.refs:
+                return
+            frame.image = None
+            self.outstanding -= 1
+            self._free.append(frame)
+
+
+class FrameDispatcher(object):
+    '''Calls :attr:`callback` with each :class:`SharedFrame` of a camera
+    from the dispatcher's own thread, so that frames are handled independently
+    of the load on the thread that receives them.
+
+    The dispatcher holds a reference to each frame added with
+    :meth:`add_frame` and releases it once :attr:`callback` returns.
+    '''
+
+    callback = None
+    '''The function called with each frame from the dispatcher's thread.
+    '''
 
     _frame_queue = None
     _thread = None
-    _writer = None
-
-    def __init__(self, filename, size, rate, ifmt, ofmt=None, **kwargs):
-        super(FFPyWriterDevice, self).__init__(**kwargs)
-        self._frame_queue = Queue()
-        if ofmt is None:
-            ofmt = 'gray' if ifmt == 'gray' else 'yuv420p'
-        self._writer = MediaWriter(
-            filename, [{
-                'pix_fmt_in': ifmt, 'width_in': size[0], 'height_in': size[1],
-                'codec':'rawvideo', 'frame_rate': rate, 'pix_fmt_out': ofmt}])
-        self._thread = Thread(
-            target=self._record_frames, name='Save frames')
+
+    def __init__(self, callback, name='Dispatch frames', **kwargs):
+        super(FrameDispatcher, self).__init__(**kwargs)
+        self.callback = callback
+        # the frame pool already bounds the number of frames in flight
+        self._frame_queue = FrameQueue()
+        self._thread = Thread(target=self._dispatch_frames, name=name)
         self._thread.start()
 
-    def add_frame(self, frame=None, pts=0):
+    def add_frame(self, frame=None):
+        '''Adds a frame to be dispatched. If `frame` is None, the
+        dispatcher's thread exits once the previous frames are dispatched.
+        '''
         if frame is None:
-            self._frame_queue.put('eof', block=False)
-        else:
-            self._frame_queue.put((frame, pts), block=False)
+            self._frame_queue.put(('eof', ), force=True)
+            return
+        frame.acquire()
+        self._frame_queue.put(('frame', frame))
 
-    def _record_frames(self):
+    def join(self, timeout=None):
+        '''Waits for the dispatcher's thread to exit after :meth:`add_frame`
+        was called with None.
+        '''
+        self._thread.join(timeout)
+
+    def _dispatch_frames(self):
         queue = self._frame_queue
-        writer = self._writer
+        callback = self.callback
+        while True:
+            item = queue.get()
+            if item[0] == 'eof':
+                return
+            frame = item[1]
+            try:
+                callback(frame)
+            finally:
+                frame.release()
+
+
+frame_timestamp_struct = Struct('<QqQQ')
+'''The little endian row of a timestamp file written by
+:class:`~sock_cond.writer_devices.FFPyWriterDevice` for each frame: the time
+the frame was received (ns, unsigned), its pts in the file (ns, signed), its
+index in the camera, and its stream in the file.
+'''
+
+
+def verify_codec(codec):
+    if codec not in ('rawvideo', 'libx264', 'ffv1', 'mjpeg'):
+        raise Exception('{} is not a supported video codec'.format(codec))
+    return codec
+
+
+def default_codec_fmt(codec, ifmt):
+    '''Returns the output pixel format to use for the codec when it's not
+    given, for frames whose input pixel format is `ifmt`.
+    '''
+    gray = ifmt == 'gray'
+    if codec == 'libx264':
+        return 'yuv420p'
+    if codec == 'ffv1':
+        return 'gray' if gray else 'bgr0'
+    if codec == 'mjpeg':
+        return 'yuvj420p'
+    return 'gray' if gray else 'yuv420p'
 
-        try:
-            while True:
-                frame = queue.get(block=True)
-                if frame == 'eof':
-                    self._writer = None
-                    return
-                img, pts = frame
-                try:
-                    writer.write_frame(img, pts, 0)
-                except Exception as e:
-                    Logger.warning('{}: {}'.format(e, pts))
-        except Exception as e:
-            self.handle_exception(e)
@@ -0,0 +1,200 @@
+'''Exports the trial records of sessions to compact columnar files for
+analysis.
+
+The json records written to the
+:attr:`~sock_cond.stages.VerifyConfigStage.record_filename` logs are
+consolidated into a numpy ``.npz`` file of tables, each a dict of equal length
+column arrays, so that a whole cohort can be loaded with a few vectorized
+reads rather than parsing text, e.g.::
+
+    python -m sock_cond.export --out cohort.npz data/*Records.jsonl
+
+The tables, named by the prefix of their columns, are:
+
+``trial_``: one row per trial, with the ``session`` index of the log it came
+from, and the ``animal``, ``cls``, ``trial``, ``odor``, ``shock``, ``ts``,
+``end`` and ``time`` of the record.
+
+``event_``: one row per stimulus state change (see
+:class:`~sock_cond.devices.StimulusTimingLog`), with the ``row`` of its trial
+in the trial table, and its ``name``, ``requested``, ``issued``,
+``returned`` and ``pts`` (NaN if unknown) times.
+
+``video_``: one row per video file of a trial, with the ``row`` of its trial,
+its ``filename``, and the index of its timestamps ``file`` in the file table,
+or -1 if it has none.
+
+``file_``: one row per frame timestamps file (see
+:class:`~sock_cond.writer_devices.FFPyWriterDevice`) found next to the videos,
+with its ``name``.
+
+``frame_``: one row per frame of the timestamps files, with the index of its
+``file``, and its ``time`` and ``pts``, in seconds, and its camera ``index``
+and ``stream``.
+
+``cam_``: one row per camera of a trial, with the ``row`` of its trial, and
+its ``name`` and the number of ``frames`` received.
+
+numpy is only required by this module.
+'''
+
+__all__ = ('frame_timestamp_dtype', 'load_frame_timestamps',
+           'get_session_tables', 'export_sessions', 'load_sessions', 'main')
+
+import sys
+import argparse
+from os.path import isfile, getsize
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from sock_cond.trial_log import read_trial_records
+
+trial_columns = (
+    ('session', 'int32'), ('animal', 'int32'), ('cls', 'U'),
+    ('trial', 'int32'), ('odor', 'bool'), ('shock', 'bool'),
+    ('ts', 'float64'), ('end', 'float64'), ('time', 'float64'))
+
+event_columns = (
+    ('row', 'int32'), ('name', 'U'), ('requested', 'float64'),
+    ('issued', 'float64'), ('returned', 'float64'), ('pts', 'float64'))
+
+video_columns = (('row', 'int32'), ('filename', 'U'), ('file', 'int32'))
+
+cam_columns = (('row', 'int32'), ('name', 'U'), ('frames', 'int64'))
+
+
+frame_timestamp_dtype = [
+    ('time', '<u8'), ('pts', '<i8'), ('index', '<u8'), ('stream', '<u8')]
+'''The numpy dtype of the rows of the frame timestamps files, see
+:data:`~sock_cond.devices.frame_timestamp_struct`. The times are in ns.
+'''
+
+
+def _check_numpy():
+    if np is None:
+        raise ImportError('numpy is required to export the sessions')
+
+
+def load_frame_timestamps(filename):
+    '''Returns a read only, memory mapped, structured array of the rows of
+    the frame timestamps file `filename`, with the
+    :data:`frame_timestamp_dtype` fields.
+    '''
+    _check_numpy()
+    dtype = np.dtype(frame_timestamp_dtype)
+    n = getsize(filename) // dtype.itemsize
+    if not n:
+        return np.zeros(0, dtype=dtype)
+    # a row truncated by a crash is skipped
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(n, ))
+
+
+def _make_table(prefix, columns, rows):
+    values = list(zip(*rows)) if rows else [[] for _ in columns]
+    return {'{}_{}'.format(prefix, name): np.array(vals, dtype=dtype)
+            for (name, dtype), vals in zip(columns, values)}
+
+
+def get_session_tables(filenames, timestamps_suffix='.timestamps'):
+    '''Returns a dict of the column arrays of the tables of the trial
+    records logged in each of `filenames`, see the module description. The
+    frame timestamps files are the video filenames with `timestamps_suffix`
+    appended.
+    '''
+    _check_numpy()
+    trials, events, videos, cams = [], [], [], []
+    files = []
+    frames = []
+    for session, filename in enumerate(filenames):
+        for record in read_trial_records(filename):
+            if record.get('type', 'trial') != 'trial':
+                continue
+            row = len(trials)
+            trials.append((
+                session, record['animal'], record['cls'], record['trial'],
+                record['odor'], record['shock'], record['ts'],
+                record['end'], record['time']))
+            for name, requested, issued, returned, pts in record['events']:
+                events.append((
+                    row, name, requested, issued, returned,
+                    float('nan') if pts is None else pts))
+            for video in record['videos']:
+                # the same file is shared by all the trials when continuous
+                name = video + timestamps_suffix
+                if name in files:
+                    videos.append((row, video, files.index(name)))
+                elif timestamps_suffix and isfile(name):
+                    videos.append((row, video, len(files)))
+                    files.append(name)
+                    frames.append(load_frame_timestamps(name))
+                else:
+                    videos.append((row, video, -1))
+            for name, count in zip(record['cams'], record['frames']):
+                cams.append((row, name, count))
+
+    tables = {}
+    tables.update(_make_table('trial', trial_columns, trials))
+    tables.update(_make_table('event', event_columns, events))
+    tables.update(_make_table('video', video_columns, videos))
+    tables.update(_make_table('cam', cam_columns, cams))
+
+    tables['file_name'] = np.array(files, dtype='U')
+    tables['frame_file'] = np.concatenate(
+        [np.full(len(f), i, dtype='int32') for i, f in enumerate(frames)] +
+        [np.zeros(0, dtype='int32')])
+    for name, dtype in frame_timestamp_dtype:
+        values = np.concatenate(
+            [f[name] for f in frames] + [np.zeros(0, dtype=dtype)])
+        if name in ('time', 'pts'):
+            values = values / 1e9
+        tables['frame_{}'.format(name)] = values
+    return tables
+
+
+def export_sessions(filenames, out, timestamps_suffix='.timestamps'):
+    '''Exports the tables of the trial records logged in each of `filenames`
+    to the compressed npz file `out`. The sessions are numbered in the order
+    of `filenames`. See :func:`get_session_tables`.
+    '''
+    tables = get_session_tables(filenames, timestamps_suffix)
+    tables['session_filename'] = np.array(list(filenames), dtype='U')
+    np.savez_compressed(out, **tables)
+
+
+def load_sessions(filename):
+    '''Returns a dict of the tables of the npz file `filename` written by
+    :func:`export_sessions`, keyed by the table prefix, e.g. ``'trial'``,
+    each a dict of its column arrays.
+    '''
+    _check_numpy()
+    tables = {}
+    with np.load(filename) as data:
+        for key in data.files:
+            prefix, name = key.split('_', 1)
+            tables.setdefault(prefix, {})[name] = data[key]
+    return tables
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Export the trial records of sessions to a npz file.')
+    parser.add_argument('--out', required=True,
+                        help='The npz file to create.')
+    parser.add_argument('--timestamps-suffix', default='.timestamps',
+                        help='The suffix of the frame timestamps files of '
+                        'the videos. If empty, they are not exported.')
+    parser.add_argument('records', nargs='+',
+                        help='The trial record logs of the sessions.')
+    args = parser.parse_args(args)
+
+    export_sessions(args.records, args.out, args.timestamps_suffix)
+    tables = load_sessions(args.out)
+    print('Exported {} trials, {} events, and {} frames of {} sessions'.format(
+        len(tables['trial']['trial']), len(tables['event']['name']),
+        len(tables['frame']['file']), len(args.records)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
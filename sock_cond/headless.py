@@ -0,0 +1,344 @@
+'''Runs the experiment headless, i.e. without a window or any widgets.
+
+The stage tree of ``Experiment.kv`` is run as is, but the app, the timer, the
+next animal buttons and the devices are replaced by non-widget stand-ins, and
+the animals of each chamber are started automatically one after the other.
+It's used to validate a config, or to soak test long sessions on a server,
+e.g.::
+
+    python -m sock_cond.headless --config data/config.ini --step 0.05
+
+The state changes of the odor and shock devices are recorded in their
+``events`` list, see :class:`~sock_cond.devices.VirtualDeviceBase`.
+'''
+
+__all__ = ('HeadlessTimer', 'HeadlessAnimalButton', 'HeadlessApp',
+           'check_pulse_durations', 'run_headless', 'main')
+
+import sys
+import argparse
+from os.path import join, dirname, abspath
+
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.config import ConfigParser
+from kivy.event import EventDispatcher
+from kivy.factory import Factory
+from kivy.lang import Builder
+from kivy.properties import (
+    NumericProperty, StringProperty, ObjectProperty, ListProperty)
+from kivy.resources import resource_add_path
+
+from moa.base import named_moas as moas
+from moa.compat import unicode_type
+from moa.logger import Logger
+
+from cplcom import exp_config_name, device_config_name
+
+import sock_cond.stages
+from sock_cond.timing import clock, real_clock, VirtualClock
+from sock_cond.devices import get_shocker_name
+
+
+class HeadlessTimer(object):
+    '''Stand-in for the timeline widget of the app. It records the slices
+    activated by the stages in :attr:`active_slices`.
+    '''
+
+    slices = {}
+    '''The attributes of each slice, keyed by the slice name. '''
+
+    active_slices = []
+    '''A list of ``(t, name)`` tuples, one for each slice activated. '''
+
+    def __init__(self, **kwargs):
+        super(HeadlessTimer, self).__init__(**kwargs)
+        self.slices = {}
+        self.active_slices = []
+
+    def clear_slices(self):
+        self.slices = {}
+
+    def add_slice(self, name, duration=0, **kwargs):
+        kwargs['duration'] = duration
+        self.slices[name] = kwargs
+
+    def smear_slices(self):
+        pass
+
+    def update_slice_attrs(self, name, **kwargs):
+        self.slices.setdefault(name, {}).update(kwargs)
+
+    def set_active_slice(self, name):
+        self.active_slices.append((clock(), name))
+
+
+class HeadlessAnimalButton(EventDispatcher):
+    '''Stand-in for the next animal button of the app. It holds the
+    description of the next animal to run in its :attr:`chamber`.
+    '''
+
+    chamber = NumericProperty(0)
+
+    animal_id = NumericProperty(-1)
+
+    cls = StringProperty('')
+
+    day = StringProperty('')
+
+    group = StringProperty('')
+
+    cycle = NumericProperty(-1)
+
+
+class HeadlessApp(App):
+    '''The app used when running headless. It is never run, it's only the
+    running app that the stages and ``Experiment.kv`` refer to.
+    '''
+
+    headless = True
+
+    simulate = True
+
+    simulation_devices = None
+
+    app_state = StringProperty('clear')
+
+    timer = ObjectProperty(None)
+
+    next_animal_btn = ObjectProperty(None)
+    '''The :attr:`next_animal_btns` of the first chamber. '''
+
+    next_animal_btns = ListProperty([])
+    '''The :class:`HeadlessAnimalButton` of each chamber. '''
+
+    animals = ListProperty([])
+    '''The :class:`HeadlessAnimals` of each chamber. '''
+
+    root_stage = ObjectProperty(None, allownone=True)
+    '''The root stage of the experiment. '''
+
+    errors = ListProperty([])
+    '''The exceptions encountered while running the experiment. '''
+
+    def __init__(self, **kwargs):
+        super(HeadlessApp, self).__init__(**kwargs)
+        self.timer = HeadlessTimer()
+        self.next_animal_btns = [HeadlessAnimalButton()]
+        self.next_animal_btn = self.next_animal_btns[0]
+
+    def device_exception(self, exception, event=None):
+        Logger.error('Headless: {}'.format(exception))
+        self.errors.append(exception)
+        root = self.root_stage
+        if root is not None and root.started and not root.finished:
+            root.stop()
+
+
+def load_configs(config_path):
+    '''Loads the device config from `config_path`, and the experiment config
+    from the ``exp_config_path`` in its ``Experiment`` section.
+    '''
+    config = ConfigParser.get_configparser(device_config_name)
+    if config is None:
+        config = ConfigParser(name=device_config_name)
+    config.read(config_path)
+    if exp_config_name == device_config_name:
+        return
+
+    exp_path = config.getdefault('Experiment', 'exp_config_path', '')
+    if not exp_path:
+        return
+    exp_path = join(dirname(abspath(config_path)), exp_path.replace('\\', '/'))
+    exp_config = ConfigParser.get_configparser(exp_config_name)
+    if exp_config is None:
+        exp_config = ConfigParser(name=exp_config_name)
+    exp_config.read(exp_path)
+
+
+def get_default_schedule():
+    '''Returns the list of animals to run, as ``(animal, cls, day, group,
+    cycle)`` tuples: every class of every animal in
+    :attr:`~sock_cond.stages.VerifyConfigStage.animal_cls`, on the first day,
+    group, and cycle of the config.
+    '''
+    verify = moas.verify
+    day, group, cycle = verify.days[0], verify.groups[0], verify.cycles[0]
+    animal_cls = verify.animal_cls
+    return [(animal, cls, day, group, cycle)
+            for animal in sorted(animal_cls.keys())
+            for cls in animal_cls[animal]]
+
+
+class HeadlessAnimals(object):
+    '''Starts the animals of :attr:`schedule` one after the other in
+    :attr:`chamber`, by setting the chamber's next animal button and device
+    whenever its ``animal_wait`` stage waits for the next animal. When all
+    the chambers are done, the root stage is stopped.
+    '''
+
+    schedule = []
+
+    app = None
+
+    chamber = None
+    '''The :class:`~sock_cond.stages.ChamberStage`. '''
+
+    done = False
+    '''Whether all the animals of :attr:`schedule` were started. '''
+
+    def __init__(self, app, schedule, chamber, **kwargs):
+        super(HeadlessAnimals, self).__init__(**kwargs)
+        self.app = app
+        self.schedule = list(schedule)
+        self.chamber = chamber
+        wait = getattr(moas, chamber.get_moa_name('animal_wait'))
+        wait.fbind('started', self._wait_started)
+        wait.fbind('finished', self._wait_finished)
+
+    def _wait_started(self, stage, started):
+        if not started:
+            return
+        app = self.app
+        if not self.schedule:
+            self.done = True
+            if all(animals.done for animals in app.animals):
+                Clock.schedule_once(lambda *l: app.root_stage.stop())
+            return
+
+        animal, cls, day, group, cycle = self.schedule.pop(0)
+        chamber = self.chamber.chamber_id
+        btn = app.next_animal_btns[chamber]
+        btn.animal_id = animal
+        btn.cls = cls
+        btn.day = unicode_type(day)
+        btn.group = unicode_type(group)
+        btn.cycle = cycle
+        Logger.info('Headless: starting animal {} ({}) in chamber {}'.
+                    format(animal, cls, chamber))
+        Clock.schedule_once(
+            lambda *l: moas.barst.next_animal_devs[chamber].set_state(True))
+
+    def _wait_finished(self, stage, finished):
+        if finished:
+            chamber = self.chamber.chamber_id
+            moas.barst.next_animal_devs[chamber].set_state(False)
+
+
+def check_pulse_durations(events, name, duration, tolerance):
+    '''Checks that each time `name` was set high in the device `events` (see
+    :attr:`~sock_cond.devices.VirtualDeviceBase.events`), it was set low
+    `duration` seconds later, within `tolerance`. It returns a list of the
+    errors found.
+    '''
+    errors = []
+    start = None
+    for t, attr, state in events:
+        if attr != name:
+            continue
+        if state:
+            start = t
+        elif start is not None:
+            if abs(t - start - duration) > tolerance:
+                errors.append(Exception(
+                    '{} was high for {:.3f}s at {:.3f}, expected {:.3f}s'.
+                    format(name, t - start, start, duration)))
+            start = None
+    if start is not None:
+        errors.append(Exception('{} was left high'.format(name)))
+    return errors
+
+
+def run_headless(config_path, schedule=None, timeout=None, speed=1.,
+                 step=0.):
+    '''Runs the experiment headless with the configs loaded from
+    `config_path` (see :func:`load_configs`), for the animals in `schedule`
+    (see :func:`get_default_schedule`, which is used if None). With multiple
+    chambers, the animals are distributed among them in turn.
+
+    If `speed` is not 1 or `step` is non-zero, a
+    :class:`~sock_cond.timing.VirtualClock` with these parameters is used
+    while running, so the session runs faster than real time.
+
+    It returns the :class:`HeadlessApp` once all the animals ran, an error
+    occurred, or `timeout` seconds (of real time) passed.
+    '''
+    app = HeadlessApp()
+    load_configs(config_path)
+    resource_add_path(join(dirname(dirname(abspath(__file__))), 'data'))
+    resource_add_path(dirname(abspath(config_path)))
+    Builder.load_file(join(dirname(abspath(__file__)), 'Experiment.kv'))
+
+    root = app.root_stage = Factory.RootStage()
+    if schedule is None:
+        schedule = get_default_schedule()
+    chambers = moas.chambers.stages
+    n = len(chambers)
+    app.next_animal_btns = [HeadlessAnimalButton(chamber=i) for i in range(n)]
+    app.next_animal_btn = app.next_animal_btns[0]
+    app.animals = [
+        HeadlessAnimals(app, schedule[i::n], chamber)
+        for i, chamber in enumerate(chambers)]
+
+    virtual_clock = None
+    if speed != 1. or step:
+        virtual_clock = VirtualClock(speed=speed, step=step)
+        virtual_clock.install()
+
+    try:
+        app.app_state = 'running'
+        root.step_stage()
+        end = None if timeout is None else real_clock() + timeout
+        while not root.finished and (end is None or real_clock() < end):
+            if virtual_clock is not None:
+                virtual_clock.advance()
+            Clock.tick()
+        if not root.finished:
+            root.stop()
+            app.errors.append(
+                Exception('Timed out after {}s'.format(timeout)))
+    finally:
+        if virtual_clock is not None:
+            virtual_clock.uninstall()
+    return app
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run the experiment without a window.')
+    parser.add_argument('--config', required=True,
+                        help='The path to the config file.')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='The maximum time, in seconds, to run.')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='How many times faster than real time to run.')
+    parser.add_argument('--step', type=float, default=0.,
+                        help='If non-zero, the time is advanced by this many '
+                        'seconds each clock tick instead, regardless of the '
+                        'real time.')
+    args = parser.parse_args(args)
+
+    app = run_headless(
+        args.config, timeout=args.timeout, speed=args.speed, step=args.step)
+    odor_dev = moas.barst.odor_dev
+    pin_dev = moas.barst.ftdi_pin_dev
+    errors = list(app.errors)
+    if pin_dev is not None:
+        # the delays can be late by up to a clock tick, or a step
+        tolerance = max(2 * args.step, 0.05)
+        for i in range(len(moas.chambers.stages)):
+            errors.extend(check_pulse_durations(
+                pin_dev.events, get_shocker_name(i),
+                moas.verify.shock_duration, tolerance))
+
+    print('Slices: {}, odor events: {}, shock events: {}'.format(
+        len(app.timer.active_slices),
+        len(odor_dev.events) if odor_dev is not None else 0,
+        len(pin_dev.events) if pin_dev is not None else 0))
+    for error in errors:
+        print('Error: {}'.format(error))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
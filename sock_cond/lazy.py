@@ -0,0 +1,78 @@
+'''Lazy loading of the heavy dependencies, e.g. ffpyplayer and the Barst
+devices, so that they are only imported once they are needed, rather than
+when the app starts.
+
+The modules are imported with :func:`import_timed`, which records how long
+each import took, and :func:`log_import_report` logs these times, e.g.::
+
+    SWScale = import_timed('ffpyplayer.pic').SWScale
+'''
+
+__all__ = ('import_timed', 'get_import_times', 'format_import_report',
+           'log_import_report')
+
+import sys
+from importlib import import_module
+from threading import Lock
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import clock
+
+from moa.logger import Logger
+
+_import_times = []
+_lock = Lock()
+_reported = 0
+
+
+def import_timed(name):
+    '''Imports and returns the module `name`. If it was not yet imported, the
+    time the import took is recorded, see :func:`get_import_times`.
+    '''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    with _lock:
+        ts = clock()
+        module = import_module(name)
+        t = clock() - ts
+        # it may have been imported by another thread meanwhile
+        if not any(item[0] == name for item in _import_times):
+            _import_times.append((name, t))
+    return module
+
+
+def get_import_times():
+    '''Returns a list of ``(name, seconds)`` tuples, one for each module
+    imported by :func:`import_timed`, in the order they were imported. The
+    time of a module includes the modules it imported.
+    '''
+    with _lock:
+        return list(_import_times)
+
+
+def format_import_report(times=None):
+    '''Returns the text of the report of `times`, as returned by
+    :func:`get_import_times`, which is used if None, slowest first.
+    '''
+    if times is None:
+        times = get_import_times()
+    lines = ['{:8.1f} ms  {}'.format(t * 1000, name)
+             for name, t in sorted(times, key=lambda item: -item[1])]
+    lines.append('{:8.1f} ms  total'.format(
+        sum(t for _, t in times) * 1000))
+    return '\n'.join(lines)
+
+
+def log_import_report(title='Imports'):
+    '''Logs the import times of the modules imported since the last report.
+    '''
+    global _reported
+    with _lock:
+        times = _import_times[_reported:]
+        _reported = len(_import_times)
+    if not times:
+        return
+    for line in format_import_report(times).splitlines():
+        Logger.info('{}: {}'.format(title, line.strip()))
@@ -12,8 +12,9 @@ from cplcom.app import ExperimentApp, run_app as run_cpl_app
 from kivy.properties import ObjectProperty
 from kivy.resources import resource_add_path
 from kivy.lang import Builder
+from kivy.clock import Clock
 
-import sock_cond.stages
+from sock_cond.lazy import import_timed, log_import_report
 
 
 class ConditioningApp(ExperimentApp):
@@ -22,12 +23,30 @@ class ConditioningApp(ExperimentApp):
 
     timer = ObjectProperty(None)
 
+    headless = False
+    '''Whether the experiment runs without any widgets, see
+    :mod:`sock_cond.headless`. It's always False for this app.
+    '''
+
     def __init__(self, **kwargs):
         super(ConditioningApp, self).__init__(**kwargs)
         resource_add_path(join(dirname(dirname(__file__)), 'data'))
         Builder.load_file(join(dirname(__file__), 'Experiment.kv'))
         Builder.load_file(join(dirname(__file__), 'display.kv'))
 
+    def on_start(self):
+        super(ConditioningApp, self).on_start()
+        # the stages are only needed once the experiment is started, so
+        # they're imported after the first frame is shown
+        Clock.schedule_once(self.import_stages, 0)
+
+    def import_stages(self, *largs):
+        '''Imports :mod:`sock_cond.stages`, registering the stages created
+        by the kv rules, and logs the startup imports.
+        '''
+        import_timed('sock_cond.stages')
+        log_import_report('Startup')
+
 run_app = partial(run_cpl_app, ConditioningApp)
 
 if __name__ == '__main__':
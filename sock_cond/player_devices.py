@@ -0,0 +1,30 @@
+'''The players used when simulating the cameras. They, and ffpyplayer, are
+only imported when the players are created, see
+:func:`~sock_cond.lazy.import_timed`.
+'''
+
+__all__ = ('RTVChanSim', )
+
+from moa.compat import unicode_type
+from moa.utils import ConfigPropertyList
+
+from cplcom.device.ffplayer import FFPyPlayerDevice
+
+from kivy.resources import resource_find
+
+from cplcom import exp_config_name
+
+from sock_cond.devices import RTVChanBase, get_cam_value
+
+
+class RTVChanSim(FFPyPlayerDevice, RTVChanBase):
+
+    def __init__(self, **kwargs):
+        super(RTVChanSim, self).__init__(**kwargs)
+        self.filename = resource_find(
+            get_cam_value(self.video_name, self.idx))
+        self.output_img_fmt = get_cam_value(self.img_fmt, self.idx)
+
+    video_name = ConfigPropertyList(
+        'Wildlife.mp4', 'Video', 'video_name', exp_config_name,
+        val_type=unicode_type)
@@ -4,11 +4,12 @@
 
 from functools import partial
 import traceback
-from time import clock, strftime, sleep
+from time import strftime, time
 from re import match, compile
-from os.path import join, isfile
+from os.path import join, isfile, dirname
 import csv
-from random import randint, shuffle
+from threading import RLock
+from random import randint, shuffle, Random, SystemRandom
 
 from moa.stage import MoaStage
 from moa.threads import ScheduledEventLoop
@@ -18,6 +19,7 @@ from moa.compat import unicode_type
 from moa.device.digital import ButtonChannel
 from moa.base import named_moas as moas
 from moa.stage.delay import Delay
+from moa.logger import Logger
 
 from kivy.app import App
 from kivy.properties import (
@@ -27,14 +29,18 @@ from kivy.clock import Clock
 from kivy.factory import Factory
 from kivy import resources
 
+from sock_cond import exp_classes
+from sock_cond.timing import clock
+from sock_cond.trial_log import TrialLogWriter, get_log_filename
+from sock_cond.lazy import import_timed, log_import_report
 from sock_cond.devices import (
-    FTDIOdors, FTDIOdorsSim, FTDIPortSim, FTDIPort, RTVChanSim, RTVChan,
-    FFPyWriterDevice)
+    FTDIOdorsSim, FTDIPortSim,
+    FramePool, FrameDispatcher, get_cam_value, get_rate,
+    VirtualChannel, FTDIOdorsVirtual, FTDIPortVirtual, SyntheticCamera,
+    DeviceStateBatcher, StimulusSequencer, StimulusTimingLog,
+    get_shocker_name, call_devices_parallel, MockServer, MockFTDIDevChannel,
+    MockFTDIOdors, MockFTDIPort, MockRTVChan)
 from cplcom import exp_config_name, device_config_name
-from cplcom.device.barst_server import Server
-from cplcom.device.ftdi import FTDIDevChannel
-from cplcom.graphics import FFImage
-
 odor_name_pat = compile('p[0-9]+')
 
 
@@ -44,6 +50,277 @@ def verify_valve_name(val):
     return unicode_type(val)
 
 
+class NullTimer(object):
+    '''Stand-in for the app's timeline widget for the chambers other than
+    the first, which is the only one shown in the timeline.
+    '''
+
+    def clear_slices(self):
+        pass
+
+    def add_slice(self, name, duration=0, **kwargs):
+        pass
+
+    def smear_slices(self):
+        pass
+
+    def update_slice_attrs(self, name, **kwargs):
+        pass
+
+    def set_active_slice(self, name):
+        pass
+
+
+class ChamberRecorder(object):
+    '''The recording state of the animal of a chamber: the files opened in
+    the writers of its :attr:`cams`, the pts of its trials, and its stats file
+    and :attr:`timing_log`.
+
+    All the chambers share the players, dispatchers, and writers of the
+    :class:`InitBarstStage`, which has a recorder for each chamber.
+    '''
+
+    stage = None
+    '''The :class:`InitBarstStage`. '''
+
+    chamber = 0
+    '''The index of the chamber. '''
+
+    cams = []
+    '''The indices of the cameras of the chamber. '''
+
+    base_pts = 0
+
+    last_pts = 0
+    '''The pts, relative to :attr:`base_pts`, of the last frame written. '''
+
+    trial_filenames = []
+    '''The video files of the trial currently or last recorded. '''
+
+    trial_frames = []
+    '''The number of frames received from each camera of :attr:`cams`
+    during the last trial recorded.
+    '''
+
+    trial_log = None
+    '''The :attr:`VerifyConfigStage.trial_log` of the chamber, from which the
+    odor and shock of the trials are indexed.
+    '''
+
+    timing_log = None
+    '''The :class:`StimulusTimingLog` in which the odor and shock state
+    changes of the animal are recorded.
+    '''
+
+    _writer_filename = ''
+    _writer_filedata = {}
+    # the files opened by open_trial_writers
+    _opened_filenames = []
+    # the frames received from each camera when the trial started
+    _trial_received = []
+    _num_trials = 0
+    # the trial whose files are currently opened in the writers
+    _opened_trial = None
+    # the trial number and start pts of the current trial when continuous
+    _trial_start = None
+    _stats_fd = None
+
+    def __init__(self, stage, chamber, cams, **kwargs):
+        super(ChamberRecorder, self).__init__(**kwargs)
+        self.stage = stage
+        self.chamber = chamber
+        self.cams = cams
+        self.trial_filenames = []
+        self.trial_frames = []
+        self.timing_log = StimulusTimingLog(pts_source=self.get_nearest_pts)
+
+    def get_writers(self):
+        '''Returns the unique :attr:`InitBarstStage.cam_writers` of
+        :attr:`cams`.
+        '''
+        stage = self.stage
+        return stage.get_unique_writers(
+            [stage.cam_writers[i] for i in self.cams])
+
+    def set_writers(self, record):
+        '''Sets the :attr:`InitBarstStage.writers` of :attr:`cams` to their
+        writers if `record`, otherwise to None.
+        '''
+        stage = self.stage
+        writers = stage.writers
+        for i in self.cams:
+            writers[i] = stage.cam_writers[i] if record else None
+
+    def write_stats(self, t, written, dropped, depths, latencies):
+        '''Logs the frame statistics of :attr:`cams` to the stats file, if
+        open.
+        '''
+        fd = self._stats_fd
+        if fd is None:
+            return
+        stage = self.stage
+        names = stage.port_names
+        for i in self.cams:
+            fd.write('{},{},{},{},{},{},{},{:.2f},{:.2f},{:.2f}\n'.format(
+                t, names[i], stage.frames_received[i], written[i],
+                dropped[i], stage.frame_gaps[i], depths[i], *latencies[i]))
+        fd.flush()
+
+    def open_stats_file(self, filedata):
+        '''Opens the stats file of the animal described by `filedata`, in the
+        directory of the video files.
+        '''
+        self.close_stats_file()
+        stage = self.stage
+        if not stage.stats_filename or not stage.stats_interval:
+            return
+        fname = join(
+            dirname(self._writer_filename),
+            stage.stats_filename.format(**filedata))
+        fd = self._stats_fd = open(fname, 'a')
+        fd.write('Date,Cam,Received,Written,Dropped,Gaps,Queue depth,'
+                 'Latency 50% (ms),Latency 90% (ms),Latency 99% (ms)\n')
+
+    def close_stats_file(self):
+        fd = self._stats_fd
+        if fd is not None:
+            self._stats_fd = None
+            fd.close()
+
+    def get_nearest_pts(self, t):
+        '''Returns the pts of the frame of the first camera of :attr:`cams`
+        nearest to the time `t`, extrapolated from the last frame received,
+        or None if none was received. While recording, it's relative to
+        :attr:`base_pts`.
+        '''
+        if not self.cams:
+            return None
+        stage = self.stage
+        cam = self.cams[0]
+        frames = stage._last_cam_frame
+        if len(frames) <= cam or frames[cam] is None:
+            return None
+        frame_t, pts = frames[cam]
+        rate = stage.players[cam].rate
+        if rate:
+            rate = get_rate(rate)
+            pts += round((t - frame_t) * rate) / rate
+        base_pts = self.base_pts
+        return pts if base_pts is None else pts - base_pts
+
+    def write_timing_report(self):
+        '''Writes the report of the :attr:`timing_log` of the animal to the
+        :attr:`InitBarstStage.timing_filename` file.
+        '''
+        stage = self.stage
+        if not stage.timing_filename or not self._writer_filename:
+            return
+        fname = join(
+            dirname(self._writer_filename),
+            stage.timing_filename.format(**self._writer_filedata))
+        try:
+            self.timing_log.write_report(fname)
+        except Exception as e:
+            stage.handle_exception(e)
+
+    def create_writers(self, filename, num_trials, filedata):
+        '''See :meth:`InitBarstStage.create_writers`.
+        '''
+        stage = self.stage
+        self._writer_filename = filename
+        self._writer_filedata = dict(filedata)
+        self._writer_filedata.update({'trial': '', 'cam': ''})
+        self._num_trials = num_trials
+        self._opened_trial = None
+        self._trial_start = None
+        self.timing_log.clear()
+        try:
+            self.open_stats_file(self._writer_filedata)
+        except Exception as e:
+            stage.handle_exception(e)
+        if stage.continuous_record:
+            with stage._writers_lock:
+                self.open_trial_writers('')
+                self.set_writers(True)
+                self.base_pts = None
+                self.last_pts = 0
+        elif num_trials:
+            self.open_trial_writers(0)
+
+    def open_trial_writers(self, trial):
+        '''Opens the files of `trial` in the writers of :attr:`cams`.
+        '''
+        names = self.stage.port_names
+        filedata = self._writer_filedata
+        filedata['trial'] = trial
+        filenames = self._opened_filenames = []
+        try:
+            for writer in self.get_writers():
+                filedata['cam'] = ''.join([names[i] for i in writer.cam_ids])
+                filename = self._writer_filename.format(**filedata)
+                writer.open_file(filename)
+                filenames.append(filename)
+        except Exception as e:
+            self.stage.handle_exception(e)
+        self._opened_trial = trial
+
+    def set_trial_writers(self, trial):
+        stage = self.stage
+        self._trial_received = [stage._received[i] for i in self.cams]
+        with stage._writers_lock:
+            if stage.continuous_record:
+                self.trial_filenames = list(self._opened_filenames)
+                self._trial_start = trial, self.last_pts
+                return
+
+            if self._opened_trial != trial:
+                self.open_trial_writers(trial)
+            self.trial_filenames = list(self._opened_filenames)
+            self.set_writers(True)
+            self.base_pts = None
+
+    def reset_trial_writers(self):
+        stage = self.stage
+        self.trial_frames = [
+            stage._received[i] - start
+            for i, start in zip(self.cams, self._trial_received)]
+        with stage._writers_lock:
+            if stage.continuous_record:
+                if self._trial_start is None:
+                    return
+                trial, start = self._trial_start
+                log = self.trial_log or {'odor': False, 'shock': False}
+                for writer in self.get_writers():
+                    writer.add_index(
+                        trial, start, self.last_pts, log['odor'],
+                        log['shock'])
+                self._trial_start = None
+                return
+
+            # no frames can be added to the writers after they are closed
+            for writer in self.get_writers():
+                writer.close_file()
+            self.set_writers(False)
+
+            trial = self._opened_trial
+            if trial is not None and trial + 1 < self._num_trials:
+                self.open_trial_writers(trial + 1)
+            else:
+                self._opened_trial = None
+
+    def close_session_writers(self):
+        '''See :meth:`InitBarstStage.close_session_writers`.
+        '''
+        stage = self.stage
+        if not stage.continuous_record:
+            return
+        with stage._writers_lock:
+            for writer in self.get_writers():
+                writer.close_file()
+            self.set_writers(False)
+            self._trial_start = None
+
+
 class InitBarstStage(MoaStage, ScheduledEventLoop):
     '''The stage that creates and initializes all the Barst devices (or
     simulation devices if :attr:`ExperimentApp.simulate`).
@@ -63,8 +340,8 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
     '''
 
     odor_dev = ObjectProperty(None, allownone=True)
-    '''The :class:`FTDIOdors` instance, or :class:`FTDIOdorsSim` instance when
-    :attr:`simulate`.
+    '''The :class:`~sock_cond.barst_devices.FTDIOdors` instance, or
+    :class:`FTDIOdorsSim` instance when :attr:`simulate`.
     '''
 
     ftdi_pin_dev = ObjectProperty(None, allownone=True)
@@ -72,14 +349,115 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
     players = ListProperty([])
 
     writers = ListProperty([])
+    '''The writers of the cameras currently being recorded, or None for
+    cameras not being recorded.
+    '''
 
-    exp_writers = None
+    cam_writers = ListProperty([])
+    '''The :class:`~sock_cond.writer_devices.FFPyWriterDevice` of each
+    camera, or None for cameras that are not recorded. They are reused for
+    all the trials. When :attr:`mux_cameras`, all the recorded cameras share
+    the same writer.
+    '''
 
-    base_pts = 0
+    cam_streams = ListProperty([])
+    '''The stream index of each camera in its writer in :attr:`cam_writers`.
+    '''
+
+    recorders = ListProperty([])
+    '''The :class:`ChamberRecorder` of each chamber. '''
+
+    cam_recorders = ListProperty([])
+    '''The :class:`ChamberRecorder` of the chamber of each camera. '''
 
     displays = ListProperty([])
 
+    # for each camera, the pts of the last frame displayed, and the scaler
+    # and the input (w, h, fmt) it was created for
+    _display_state = []
+
+    frame_pools = ListProperty([])
+    '''The :class:`FramePool` of each camera, through which its frames are
+    shared with the writers and displays.
+    '''
+
+    dispatchers = ListProperty([])
+    '''The :class:`FrameDispatcher` of each camera, which passes its frames to
+    the writers and displays from a secondary thread.
+    '''
+
+    frames_received = ListProperty([])
+    '''The number of frames received from each camera. '''
+
+    frames_written = ListProperty([])
+    '''The number of frames of each camera written to disk. '''
+
+    frames_dropped = ListProperty([])
+    '''The number of frames of each camera dropped because its
+    :class:`FramePool` was exhausted, plus the frames dropped by its writer.
+    With :attr:`mux_cameras`, the writer's drops are included for all the
+    cameras.
+    '''
+
+    frame_gaps = ListProperty([])
+    '''The number of frames of each camera missing, estimated from the pts
+    difference between frames and the player's rate.
+    '''
+
+    queue_depths = ListProperty([])
+    '''The size of the queue of the writer of each camera. '''
+
+    write_latencies = ListProperty([])
+    '''The :attr:`~sock_cond.writer_devices.FFPyWriterDevice.write_latency`
+    of the writer of each camera.
+    '''
+
+    stats_interval = ConfigParserProperty(
+        1., 'Video', 'stats_interval', exp_config_name, val_type=float)
+    '''How often, in seconds, the frame statistics, e.g.
+    :attr:`frames_received` are updated and logged to the stats file. If
+    zero, they are not updated.
+    '''
+
+    stats_filename = ConfigParserProperty(
+        'RatO1D{day}G{group}R{animal}C{cycle}Stats.csv', 'Video',
+        'stats_filename', exp_config_name, val_type=unicode_type)
+    '''The filename of the csv file to which the frame statistics are logged
+    while an animal is recorded. It's created in the directory of the video
+    files. If empty, they are not logged.
+    '''
+
+    timing_filename = ConfigParserProperty(
+        'RatO1D{day}G{group}R{animal}C{cycle}Timing.csv', 'Video',
+        'timing_filename', exp_config_name, val_type=unicode_type)
+    '''The filename of the csv file to which the
+    :attr:`ChamberRecorder.timing_log` report is written at the end of each
+    animal, in the directory of the video files. If empty, it's not written.
+    '''
+
+    _received = []
+    _gaps = []
+    # the pts of the last frame of each camera, used to detect gaps
+    _last_cam_pts = []
+    # the time each camera's last frame was received, and its pts
+    _last_cam_frame = []
+
+    # the last image of each camera waiting to be displayed
+    _display_images = []
+    _display_trigger = None
+    # protects the writers, and the recorders' base_pts and last_pts, which
+    # are used by the dispatchers' threads
+    _writers_lock = None
+
     next_animal_dev = ObjectProperty(None, allownone=True)
+    '''The next animal device of the first chamber. '''
+
+    next_animal_devs = ListProperty([])
+    '''The device of each chamber that is set high to start its next animal.
+    '''
+
+    # the next animal button whose state is routed to the chamber selected
+    _routed_btn = None
 
     ports = ConfigPropertyList(
         0, 'Video', 'ports', exp_config_name, val_type=int, autofill=False)
@@ -90,9 +468,99 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
     record = ConfigPropertyList(
         False, 'Video', 'record', exp_config_name, val_type=to_bool)
 
+    continuous_record = ConfigParserProperty(
+        False, 'Video', 'continuous_record', exp_config_name,
+        val_type=to_bool)
+    '''Whether each camera is recorded to a single file for the whole animal
+    session, including the ITIs, rather than a file per trial. The start and
+    end pts of each trial are then written to an index file next to the video
+    file, see :meth:`~sock_cond.writer_devices.FFPyWriterDevice.add_index`.
+    '''
+
+    display_rate = ConfigPropertyList(
+        0, 'Video', 'display_rate', exp_config_name, val_type=float)
+    '''The maximum rate at which the frames of each camera are displayed. If
+    zero, all the frames are displayed. All the frames are still recorded.
+    '''
+
+    display_scale = ConfigPropertyList(
+        1, 'Video', 'display_scale', exp_config_name, val_type=float)
+    '''The factor by which the frames of each camera are downscaled before
+    they are displayed.
+    '''
+
+    display_gray = ConfigPropertyList(
+        False, 'Video', 'display_gray', exp_config_name, val_type=to_bool)
+    '''Whether the frames of each camera are displayed in grayscale. '''
+
+    frame_pool_size = ConfigParserProperty(
+        300, 'Video', 'frame_pool_size', exp_config_name, val_type=int)
+    '''The number of frames preallocated in the :class:`FramePool` of each
+    camera. Frames arriving when all are in use are dropped, so it should be
+    larger than :attr:`~sock_cond.writer_devices.FFPyWriterDevice.queue_size`.
+    If zero, the pools are unbounded.
+    '''
+
+    mux_cameras = ConfigParserProperty(
+        False, 'Video', 'mux_cameras', exp_config_name, val_type=to_bool)
+    '''Whether all the recorded cameras of a trial are written as separate
+    streams of a single file, rather than a file per camera. The ``cam`` field
+    of the filename is then the names of all the recorded cameras.
+    '''
+
     num_boards = ConfigPropertyList(
         1, 'FTDI_odor', 'num_boards', device_config_name, val_type=int)
 
+    mock_server = ConfigParserProperty(
+        '', 'Server', 'mock_server', device_config_name,
+        val_type=unicode_type)
+    '''If not empty, the barst devices connect to a
+    :class:`~sock_cond.barst_mock.MockBarstServer` instead of Barst. It's
+    either ``'local'``, to run one in the process, or the ``'host:port'`` of
+    a running one.
+    '''
+
+    device_timeout = ConfigParserProperty(
+        10., 'Server', 'device_timeout', device_config_name, val_type=float)
+    '''The time, in seconds, each device may take to start or stop. If zero,
+    there's no limit.
+    '''
+
+    device_retries = ConfigParserProperty(
+        1, 'Server', 'device_retries', device_config_name, val_type=int)
+    '''How many more times starting or stopping a device is tried when it
+    fails.
+    '''
+
+    device_latencies = {}
+    '''The time, in seconds, each device, by name, last took to start or
+    stop, or None if it timed out.
+    '''
+
+    chamber_boards = ConfigPropertyList(
+        0, 'FTDI_odor', 'chamber_boards', device_config_name, val_type=int)
+    '''The number of odor boards of each chamber, in their order along the
+    FTDI chain, when running multiple chambers from one process. If zero,
+    there's a single chamber with all the :attr:`num_boards` boards. See
+    :meth:`get_chamber_boards`.
+    '''
+
+    cam_chambers = ConfigPropertyList(
+        0, 'Video', 'cam_chambers', exp_config_name, val_type=int)
+    '''The chamber of each camera. '''
+
+    state_batcher = None
+    '''The :class:`DeviceStateBatcher` through which the stages set the
+    state of the odor and shocker devices, so that all the changes of a
+    device in a clock tick are sent together.
+    '''
+
+    sequencer = None
+    '''The :class:`StimulusSequencer` that executes the odor and shock
+    timeline of each trial when
+    :attr:`VerifyConfigStage.sequence_stimuli`.
+    '''
+
     exception_callback = None
     '''The partial function that has been scheduled to be called by the kivy
     thread when an exception occurs. This function must be unscheduled when
@@ -103,6 +571,11 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
     def __init__(self, **kw):
         super(InitBarstStage, self).__init__(**kw)
         self.exclude_attrs = ['finished']
+        self._writers_lock = RLock()
+        self.state_batcher = DeviceStateBatcher()
+        self.sequencer = StimulusSequencer(
+            exception_callback=self.handle_exception)
+        self._display_trigger = Clock.create_trigger(self.update_displays)
 
     def clear(self, *largs, **kwargs):
         self._finished_init = False
@@ -124,16 +597,142 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
             return False
         return super(InitBarstStage, self).stop(*largs, **kwargs)
 
-    def service_input_image(self, idx, frame, pts):
-        writer = self.writers[idx]
-        if writer is not None:
-            base_pts = self.base_pts
-            if base_pts is None:
-                base_pts = self.base_pts = pts
-            writer.add_frame(frame, pts - base_pts)
-        display = self.displays[idx]
-        if display is not None:
-            display.display(frame)
+    def service_input_image(self, idx, image, pts):
+        '''Called by the players with each frame. The frame is passed on to
+        the camera's :class:`FrameDispatcher`, which calls
+        :meth:`dispatch_frame` from its thread.
+        '''
+        index = self._received[idx]
+        self._received[idx] += 1
+        t = clock()
+        self._last_cam_frame[idx] = t, pts
+        frame = self.frame_pools[idx].wrap(image, pts, t, index)
+        if frame is None:
+            return
+        self.dispatchers[idx].add_frame(frame)
+        frame.release()
+
+    def dispatch_frame(self, idx, frame):
+        '''Called from the thread of the :class:`FrameDispatcher` of camera
+        `idx` with each of its frames. It passes the frame to the camera's
+        writer, if recording, and posts the frame to be displayed by
+        :meth:`update_displays` from the kivy thread.
+        '''
+        try:
+            last_pts = self._last_cam_pts[idx]
+            self._last_cam_pts[idx] = frame.pts
+            rate = self.players[idx].rate
+            if last_pts is not None and rate:
+                # the number of frames missing between the two frames
+                missing = int(round(
+                    (frame.pts - last_pts) * get_rate(rate))) - 1
+                if missing > 0:
+                    self._gaps[idx] += missing
+
+            with self._writers_lock:
+                writer = self.writers[idx]
+                if writer is not None:
+                    recorder = self.cam_recorders[idx]
+                    base_pts = recorder.base_pts
+                    if base_pts is None:
+                        base_pts = recorder.base_pts = frame.pts
+                    pts = recorder.last_pts = frame.pts - base_pts
+                    file_id = writer.file_id
+            # adding the frame may block when the queue is full, so it's added
+            # without the lock. The file id drops it if the file was closed
+            # in the meantime
+            if writer is not None:
+                writer.add_frame(frame, pts, self.cam_streams[idx], file_id)
+
+            if self.displays[idx] is not None:
+                image = self.get_display_image(idx, frame)
+                if image is not None:
+                    # only the last frame is displayed if the kivy thread is
+                    # behind
+                    self._display_images[idx] = image
+                    self._display_trigger()
+        except Exception as e:
+            self.handle_exception(e)
+
+    def update_stats(self, *largs):
+        '''Updates the frame statistics properties, e.g.
+        :attr:`frames_received`, and logs them to the stats file, if open.
+        '''
+        writers = self.cam_writers
+        for writer in self.get_unique_writers(writers):
+            writer.update_stats()
+
+        n = len(self.players)
+        written = [0, ] * n
+        dropped = [pool.exhausted for pool in self.frame_pools]
+        depths = [0, ] * n
+        latencies = [[0, 0, 0] for _ in range(n)]
+        for i, writer in enumerate(writers):
+            if writer is None:
+                continue
+            written[i] = writer.get_stream_written(self.cam_streams[i])
+            dropped[i] += writer.frames_dropped
+            depths[i] = writer.queue_depth
+            latencies[i] = writer.write_latency
+
+        self.frames_received = list(self._received)
+        self.frames_written = written
+        self.frames_dropped = dropped
+        self.frame_gaps = list(self._gaps)
+        self.queue_depths = depths
+        self.write_latencies = latencies
+
+        t = strftime('%m/%d/%Y %I:%M:%S %p')
+        for recorder in self.recorders:
+            recorder.write_stats(t, written, dropped, depths, latencies)
+
+    def write_timing_report(self, chamber=0):
+        '''Writes the report of the stimulus timing of the animal of
+        `chamber`, see :meth:`ChamberRecorder.write_timing_report`.
+        '''
+        self.recorders[chamber].write_timing_report()
+
+    def update_displays(self, *largs):
+        '''Displays the last frame posted by :meth:`dispatch_frame` for each
+        camera.
+        '''
+        images = self._display_images
+        self._display_images = [None, ] * len(images)
+        for display, image in zip(self.displays, images):
+            if display is not None and image is not None:
+                display.display(image)
+
+    def get_display_image(self, idx, frame):
+        '''Returns the image of camera `idx` to display for `frame`, according
+        to :attr:`display_rate`, :attr:`display_scale`, and
+        :attr:`display_gray`, or None if the frame should not be displayed.
+        The frame itself, which is recorded, is not modified.
+        '''
+        state = self._display_state[idx]
+        rate = get_cam_value(self.display_rate, idx)
+        if rate > 0:
+            last_pts = state['pts']
+            if last_pts is not None and frame.pts - last_pts < 1. / rate:
+                return None
+        state['pts'] = frame.pts
+
+        image = frame.image
+        scale = get_cam_value(self.display_scale, idx)
+        gray = get_cam_value(self.display_gray, idx)
+        ifmt = image.get_pixel_format()
+        if scale <= 1 and (not gray or ifmt == 'gray'):
+            return image
+
+        w, h = image.get_size()
+        key = w, h, ifmt
+        if state['key'] != key:
+            ofmt = 'gray' if gray else ifmt
+            ow = max(int(w / scale), 1) if scale > 1 else w
+            oh = max(int(h / scale), 1) if scale > 1 else h
+            SWScale = import_timed('ffpyplayer.pic').SWScale
+            state['sws'] = SWScale(w, h, ifmt, ow, oh, ofmt)
+            state['key'] = key
+        return state['sws'].scale(image)
 
     def step_stage(self, *largs, **kwargs):
         if not super(InitBarstStage, self).step_stage(*largs, **kwargs):
@@ -141,7 +740,11 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
 
         # if we simulate, create them and step immediately
         try:
-            if App.get_running_app().simulate:
+            app = App.get_running_app()
+            if app.headless:
+                self.create_headless_devices()
+                self.step_stage()
+            elif app.simulate:
                 self.create_devices()
                 self.step_stage()
             else:
@@ -154,19 +757,40 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
         return True
 
     def create_devices(self, sim=True):
-        '''Creates simulated versions of the barst devices.
+        '''Creates simulated versions of the barst devices, or, if not `sim`,
+        the barst devices. When :attr:`mock_server` is set, the barst devices
+        connect to a mock Barst server instead.
         '''
+        mock = not sim and self.mock_server
         if sim:
             pincls = FTDIPortSim
             odorcls = FTDIOdorsSim
+            playercls = import_timed('sock_cond.player_devices').RTVChanSim
+        elif mock:
+            pincls = MockFTDIPort
+            odorcls = MockFTDIOdors
+            playercls = MockRTVChan
         else:
-            pincls = FTDIPort
-            odorcls = FTDIOdors
+            barst_devices = import_timed('sock_cond.barst_devices')
+            pincls = barst_devices.FTDIPort
+            odorcls = barst_devices.FTDIOdors
+            playercls = barst_devices.RTVChan
         app = App.get_running_app()
         ids = app.simulation_devices.ids
+        num_chambers = len(self.get_chamber_boards())
 
-        self.next_animal_dev = ButtonChannel(
-            button=app.next_animal_btn.__self__, name='next_animal')
+        btn = app.next_animal_btn.__self__
+        if num_chambers == 1:
+            self.next_animal_devs = [
+                ButtonChannel(button=btn, name='next_animal')]
+        else:
+            # the button starts the animal of the chamber selected with it
+            self.next_animal_devs = [
+                VirtualChannel(name='next_animal{}'.format(i))
+                for i in range(num_chambers)]
+            btn.fbind('state', self._route_next_animal)
+            self._routed_btn = btn
+        self.next_animal_dev = self.next_animal_devs[0]
 
         dev_cls = [Factory.get('ToggleDevice'), Factory.get('DarkDevice')]
         odor_btns = ids.odors
@@ -178,11 +802,19 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
             N=self.num_boards[0] * 8)
 
         pin = self.ftdi_pin_dev = pincls(
-            name='pin_dev', shocker_btn=ids.shocker.__self__)
-        if not sim:
-            server = self.server = Server()
+            name='pin_dev', shocker_btn=ids.shocker.__self__,
+            num_shockers=num_chambers)
+        if mock:
+            server = self.server = MockServer(address=self.mock_server)
             server.create_device()
-            ftdi = self.ftdi_chan = FTDIDevChannel()
+            ftdi = self.ftdi_chan = MockFTDIDevChannel()
+            ftdi.create_device([odors, pin], server)
+        elif not sim:
+            server = self.server = import_timed(
+                'cplcom.device.barst_server').Server()
+            server.create_device()
+            ftdi = self.ftdi_chan = import_timed(
+                'cplcom.device.ftdi').FTDIDevChannel()
             ftdi.create_device([odors, pin], server)
 
         players = []
@@ -195,11 +827,11 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
         for i, p in enumerate(self.ports):
             port = 'player{}'.format(p)
             if sim:
-                player = RTVChanSim(
+                player = playercls(
                     button=cam_btns.children[N - 1 - i].__self__, name=port,
                     idx=i, callback=partial(self.service_input_image, i))
             else:
-                player = RTVChan(
+                player = playercls(
                     button=cam_btns.children[N - 1 - i].__self__, name=port,
                     idx=i, callback=partial(self.service_input_image, i),
                     port=p)
@@ -207,12 +839,14 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
                 player.create_device(server)
             players.append(player)
         self.players = players
-        self.writers = [None, ] * len(players)
         displays = app.root.ids.displays
         displays.clear_widgets()
+        FFImage = import_timed('cplcom.graphics').FFImage
         self.displays = [FFImage() for _ in range(len(players))]
         for display in self.displays:
             displays.add_widget(display)
+        self.create_frame_pipeline()
+        log_import_report('Barst')
 
         if sim:
             self.odor_dev.activate(self)
@@ -220,9 +854,148 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
             for player in self.players:
                 player.activate(self)
 
+    def create_headless_devices(self):
+        '''Creates the virtual devices used when the app is headless. They
+        are not backed by widgets, and the cameras are
+        :class:`SyntheticCamera`.
+        '''
+        num_chambers = len(self.get_chamber_boards())
+        self.next_animal_devs = [
+            VirtualChannel(name='next_animal{}'.format(i) if i else
+                           'next_animal') for i in range(num_chambers)]
+        self.next_animal_dev = self.next_animal_devs[0]
+        n = self.num_boards[0] * 8
+        self.odor_dev = FTDIOdorsVirtual(name='odors', N=n)
+        self.ftdi_pin_dev = FTDIPortVirtual(
+            name='pin_dev', num_shockers=num_chambers)
+
+        self.players = [
+            SyntheticCamera(
+                name='player{}'.format(p),
+                callback=partial(self.service_input_image, i))
+            for i, p in enumerate(self.ports)]
+        self.displays = [None, ] * len(self.players)
+        self.create_frame_pipeline()
+
+        self.odor_dev.activate(self)
+        self.ftdi_pin_dev.activate(self)
+
+    def _route_next_animal(self, btn, state):
+        self.next_animal_devs[btn.chamber].set_state(state == 'down')
+
+    def get_chamber_boards(self):
+        '''Returns a list with the index of the first odor board and the
+        number of boards of each chamber, see :attr:`chamber_boards`.
+        '''
+        total = self.num_boards[0]
+        boards = [n for n in self.chamber_boards if n > 0]
+        if not boards:
+            return [(0, total)]
+        if sum(boards) > total:
+            raise Exception('The chambers have {} odor boards, but only {} '
+                            'are connected'.format(sum(boards), total))
+        chambers = []
+        offset = 0
+        for n in boards:
+            chambers.append((offset, n))
+            offset += n
+        return chambers
+
+    def create_frame_pipeline(self):
+        '''Creates the frame pools, dispatchers, and writers that carry the
+        frames of the :attr:`players` to the :attr:`displays` and to disk,
+        and the :attr:`recorders` of the chambers. :attr:`players` and
+        :attr:`displays` must already be set.
+        '''
+        n = len(self.players)
+        num_chambers = len(self.get_chamber_boards())
+        cam_chambers = [get_cam_value(self.cam_chambers, i) for i in range(n)]
+        for chamber in cam_chambers:
+            if not 0 <= chamber < num_chambers:
+                raise Exception('Camera chamber {} is not one of the {} '
+                                'chambers'.format(chamber, num_chambers))
+        self.recorders = [
+            ChamberRecorder(
+                self, chamber,
+                [i for i in range(n) if cam_chambers[i] == chamber])
+            for chamber in range(num_chambers)]
+        self.cam_recorders = [self.recorders[c] for c in cam_chambers]
+        self.writers = [None, ] * n
+        self.frame_pools = [
+            FramePool(max_frames=self.frame_pool_size) for _ in range(n)]
+        self._display_state = [
+            {'pts': None, 'sws': None, 'key': None} for _ in range(n)]
+        self._display_images = [None, ] * n
+        self._received = [0, ] * n
+        self._gaps = [0, ] * n
+        self._last_cam_pts = [None, ] * n
+        self._last_cam_frame = [None, ] * n
+        self.dispatchers = [
+            FrameDispatcher(
+                partial(self.dispatch_frame, i),
+                name='Dispatch frames {}'.format(i))
+            for i in range(n)]
+        self.create_cam_writers()
+        self.update_stats()
+        if self.stats_interval > 0:
+            Clock.schedule_interval(self.update_stats, self.stats_interval)
+
+    def stop_frame_pipeline(self, join=False):
+        '''Stops the threads of the dispatchers and writers created by
+        :meth:`create_frame_pipeline`, closing any open files. If `join`, it
+        waits until all the queued frames were written.
+        '''
+        dispatchers = self.dispatchers
+        for dispatcher in dispatchers:
+            dispatcher.add_frame()
+        self.dispatchers = []
+        Clock.unschedule(self._display_trigger)
+        Clock.unschedule(self.update_stats)
+        if join:
+            for dispatcher in dispatchers:
+                dispatcher.join()
+
+        with self._writers_lock:
+            writers = self.get_unique_writers(self.cam_writers)
+            for writer in writers:
+                writer.add_frame()
+            self.writers = [None, ] * len(self.players)
+            self.cam_writers = []
+            for recorder in self.recorders:
+                recorder._opened_trial = None
+        if join:
+            for writer in writers:
+                writer.join()
+        for recorder in self.recorders:
+            recorder.close_stats_file()
+
+    def call_devices(self, groups, method):
+        '''Calls the method `method` of the devices of each of `groups`, a
+        list of device lists, in order. The devices of a group are called in
+        parallel, see :func:`~sock_cond.devices.call_devices_parallel`, and
+        their latencies are stored in :attr:`device_latencies`. It returns
+        the exceptions of the devices that failed.
+        '''
+        latencies = self.device_latencies = {}
+        errors = []
+        for devs in groups:
+            for result in call_devices_parallel(
+                    devs, method, timeout=self.device_timeout or None,
+                    retries=self.device_retries):
+                latencies[result.name] = result.latency
+                if result.exception is not None:
+                    errors.append(result.exception)
+        return errors
+
     def start_devices(self):
-        for dev in [self.server, self.ftdi_chan] + self.players:
-            dev.start_channel()
+        '''Called from the internal thread. It starts the server, then the
+        FTDI chain and every camera in parallel.
+        '''
+        errors = self.call_devices(
+            [[self.server], [self.ftdi_chan] + self.players],
+            'start_channel')
+        if errors:
+            raise errors[0]
 
     def finish_start_devices(self, *largs):
         self._finished_init = True
@@ -248,6 +1021,21 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
             event)
         Clock.schedule_once(callback)
 
+    def call_from_sequencer(self, f, *largs, **kwargs):
+        '''Called from the :attr:`sequencer` thread to call the device method
+        `f` with the arguments. The simulation devices are backed by widgets,
+        so they are instead called from the kivy thread, and the event's times
+        are recorded when it's called there. Otherwise, it's called holding
+        the :attr:`state_batcher` lock, since the batcher writes to the same
+        devices from the kivy thread.
+        '''
+        app = App.get_running_app()
+        if app.simulate and not app.headless:
+            Clock.schedule_once(self.sequencer.defer(f, *largs, **kwargs))
+        else:
+            with self.state_batcher.lock:
+                f(*largs, **kwargs)
+
     def stop_devices(self):
         odor_dev = self.odor_dev
         pin_dev = self.ftdi_pin_dev
@@ -256,23 +1044,32 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
         server = self.server
 
         unschedule = Clock.unschedule
+        if self._routed_btn is not None:
+            self._routed_btn.funbind('state', self._route_next_animal)
+            self._routed_btn = None
+        # the pending stimuli events are dropped, so whatever the stage, the
+        # stimuli are turned off. They're sent with the states requested this
+        # tick, e.g. by the stopped stages, while the devices still run
+        self.sequencer.stop(join=True)
+        chambers = moas.chambers
+        if chambers is not None:
+            for chamber in chambers.stages:
+                chamber.verify.stop_stimuli()
+        self.state_batcher.flush()
         for dev in [odor_dev, pin_dev] + players:
             if dev is not None:
                 dev.deactivate(self)
-        for writer in self.writers:
-            if writer is not None:
-                writer.add_frame()
-        self.writers = [None, ] * len(self.players)
+        self.stop_frame_pipeline()
 
-        fd = moas.verify._fd
-        if fd is not None:
-            fd.close()
-            moas.verify._fd = None
+        if chambers is not None:
+            for chamber in chambers.stages:
+                chamber.verify.close_logs()
 
         unschedule(self.exception_callback)
         self.clear_events()
         self.stop_thread(join=True)
         if App.get_running_app().simulate:
+            self.state_batcher.clear()
             App.get_running_app().app_state = 'clear'
             return
 
@@ -281,6 +1078,7 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
                 dev.stop_device()
 
         def clear_app(*l):
+            self.state_batcher.clear()
             App.get_running_app().app_state = 'clear'
         self.start_thread()
         self.request_callback(
@@ -290,54 +1088,161 @@ class InitBarstStage(MoaStage, ScheduledEventLoop):
         '''Called from :class:`InitBarstStage` internal thread. It stops
         and clears the states of all the devices.
         '''
-        for dev in [self.odor_dev, self.ftdi_pin_dev, self.ftdi_chan] + \
-            self.players + [self.server]:
-            try:
-                if dev is not None:
-                    dev.stop_channel()
-            except:
-                pass
+        errors = self.call_devices(
+            [[self.odor_dev, self.ftdi_pin_dev] + self.players,
+             [self.ftdi_chan], [self.server]], 'stop_channel')
+        for e in errors:
+            Logger.warning('Barst: stopping a device failed: {}'.format(e))
         self.stop_thread()
 
-    def create_writers(self, filename, num_trials):
+    def create_cam_writers(self):
+        '''Creates the :attr:`cam_writers` for the cameras that are recorded.
+        When :attr:`mux_cameras`, the cameras of each chamber share a writer.
+        '''
         players = self.players
-        names = self.port_names
         record = self.record
-        btn = App.get_running_app().next_animal_btn
-        filedata = {
-            'day': btn.day, 'group': btn.group, 'animal': btn.animal_id,
-            'cycle': btn.cycle, 'trial': '', 'cam': ''}
+        writers = [None, ] * len(players)
+        streams = [0, ] * len(players)
+        FFPyWriterDevice = import_timed(
+            'sock_cond.writer_devices').FFPyWriterDevice
+
+        for recorder in self.recorders:
+            cams = [i for i in recorder.cams if record[i]]
+            if self.mux_cameras and cams:
+                writer = FFPyWriterDevice(
+                    sources=[players[i] for i in cams], cam_ids=cams)
+                for stream, i in enumerate(cams):
+                    writers[i] = writer
+                    streams[i] = stream
+            else:
+                for i in cams:
+                    writers[i] = FFPyWriterDevice(
+                        sources=[players[i]], cam_ids=[i])
 
-        try:
-            writers = []
-            for trial in range(num_trials):
-                filedata['trial'] = trial
-                trial_writers = []
-                for i, player in enumerate(players):
-                    if not record[i]:
-                        trial_writers.append(None)
-                        continue
-                    filedata['cam'] = names[i]
-                    while player.size is None or player.rate is None:
-                        sleep(0.005)
-                    writer = FFPyWriterDevice(
-                        filename.format(**filedata), player.size, player.rate,
-                        player.output_img_fmt)
-                    trial_writers.append(writer)
-                writers.append(trial_writers)
-            self.exp_writers = writers
-        except Exception as e:
-            self.handle_exception(e)
+        self.cam_writers = writers
+        self.cam_streams = streams
 
-    def set_trial_writers(self, trial):
-        self.writers = self.exp_writers[trial]
-        self.base_pts = None
+    def get_unique_writers(self, writers):
+        '''Returns the writers in `writers` that are not None, with writers
+        shared by multiple cameras listed once.
+        '''
+        unique = []
+        for writer in writers:
+            if writer is not None and writer not in unique:
+                unique.append(writer)
+        return unique
+
+    def create_writers(self, filename, num_trials, filedata=None, chamber=0):
+        '''Prepares the writers of the cameras of `chamber` for the trials of
+        its next animal. The files of the first trial are opened immediately,
+        the files of each subsequent trial are opened when the previous trial
+        ends.
+
+        When :attr:`continuous_record`, the session's files are opened and
+        recorded until :meth:`close_session_writers`.
+
+        `filedata` is the dict of the ``day``, ``group``, ``animal``, and
+        ``cycle`` fields of the filename. If None, it's read from the app's
+        next animal button.
+        '''
+        if filedata is None:
+            btn = App.get_running_app().next_animal_btn
+            filedata = {
+                'day': btn.day, 'group': btn.group, 'animal': btn.animal_id,
+                'cycle': btn.cycle}
+        self.recorders[chamber].create_writers(filename, num_trials, filedata)
+
+    def set_trial_writers(self, trial, chamber=0):
+        '''Starts recording `trial` of the animal of `chamber`.
+        '''
+        self.recorders[chamber].set_trial_writers(trial)
 
-    def reset_trial_writers(self):
-        for writer in self.writers:
-            if writer is not None:
-                writer.add_frame()
-        self.writers = [None] * len(self.players)
+    def reset_trial_writers(self, chamber=0):
+        '''Stops recording the current trial of the animal of `chamber`.
+        '''
+        self.recorders[chamber].reset_trial_writers()
+
+    def close_session_writers(self, chamber=0):
+        '''Closes the session's files of `chamber` opened when
+        :attr:`continuous_record`.
+        '''
+        self.recorders[chamber].close_session_writers()
+
+
+class ChamberStage(MoaStage):
+    '''The stages of the animals of a chamber. The ``<ChamberStage>`` rule of
+    ``Experiment.kv`` creates its :attr:`verify` and :attr:`rand_valves`
+    stages, and the stages of its animals.
+
+    The chambers run in parallel, sharing the devices, dispatchers, and
+    writers of the :class:`InitBarstStage`.
+    '''
+
+    chamber_id = NumericProperty(0)
+    '''The index of the chamber. '''
+
+    verify = ObjectProperty(None, allownone=True)
+    '''The :class:`VerifyConfigStage` of the chamber. '''
+
+    rand_valves = ObjectProperty(None, allownone=True)
+    '''The :class:`RandValves` of the chamber. '''
+
+    _null_timer = None
+
+    def get_moa_name(self, name):
+        '''Returns the name of the stage `name` of the chamber, which is
+        suffixed with its :attr:`chamber_id` for all but the first chamber.
+        '''
+        return name if not self.chamber_id else '{}{}'.format(
+            name, self.chamber_id)
+
+    def get_recorder(self):
+        '''Returns the :class:`ChamberRecorder` of the chamber. '''
+        return moas.barst.recorders[self.chamber_id]
+
+    def get_boards(self):
+        '''Returns the index of the first odor board of the chamber and its
+        number of boards, see :meth:`InitBarstStage.get_chamber_boards`.
+        '''
+        return moas.barst.get_chamber_boards()[self.chamber_id]
+
+    def get_next_animal_btn(self):
+        '''Returns the button that describes the next animal of the chamber:
+        the app\'s ``next_animal_btns`` of the chamber if the app has them,
+        otherwise its ``next_animal_btn``.
+        '''
+        app = App.get_running_app()
+        btns = getattr(app, 'next_animal_btns', None)
+        if btns:
+            return btns[self.chamber_id]
+        return app.next_animal_btn
+
+    def get_timer(self):
+        '''Returns the app\'s timer for the first chamber, and a
+        :class:`NullTimer` for the others.
+        '''
+        if not self.chamber_id:
+            return App.get_running_app().timer
+        if self._null_timer is None:
+            self._null_timer = NullTimer()
+        return self._null_timer
+
+
+class ChambersStage(MoaStage):
+    '''Runs a :class:`ChamberStage` for each chamber in parallel. The number
+    of chambers is the number of non-zero :attr:`chamber_boards`, or one.
+    '''
+
+    chamber_boards = ConfigPropertyList(
+        0, 'FTDI_odor', 'chamber_boards', device_config_name, val_type=int)
+    '''See :attr:`InitBarstStage.chamber_boards`. '''
+
+    def __init__(self, **kwargs):
+        super(ChambersStage, self).__init__(**kwargs)
+        self.order = 'parallel'
+        n = max(len([n for n in self.chamber_boards if n > 0]), 1)
+        for i in range(n):
+            self.add_stage(Factory.ChamberStage(chamber_id=i))
 
 
 class VerifyConfigStage(MoaStage):
@@ -353,34 +1258,32 @@ class VerifyConfigStage(MoaStage):
     def __init__(self, **kw):
         super(VerifyConfigStage, self).__init__(**kw)
         self.exclude_attrs = ['finished']
+        self.trial_log = {'trial': 0, 'odor': False, 'shock': False, 'ts': 0}
 
     def step_stage(self, *largs, **kwargs):
         if not super(VerifyConfigStage, self).step_stage(*largs, **kwargs):
             return False
 
         try:
+            chamber = self.chamber
+            self.board_offset, self.num_boards = chamber.get_boards()
+            self.shocker_name = get_shocker_name(chamber.chamber_id)
             self.read_odors()
             app = App.get_running_app()
-            ch = app.simulation_devices.ids.odors.children
-            valve = ch[len(ch) - 1 - int(self.NO_valve[1:])]
-            valve.background_down = 'dark-blue-led-on-th.png'
-            valve.background_normal = 'dark-blue-led-off-th.png'
-            for p in [
-                valve for valves in moas.rand_valves.rand_valves for
-                    valve in valves]:
-                valve = ch[len(ch) - 1 - int(p[1:])]
-                valve.background_down = 'brown-led-on-th.png'
-                valve.background_normal = 'brown-led-off-th.png'
-            N = len(ch)
-            for i, name in enumerate(self.odor_names):
-                ch[N - 1 - i].text = name
+            if not app.headless and not chamber.chamber_id:
+                self.update_odor_widgets()
+            odor_dev = moas.barst.odor_dev
+            self.odor_mask = odor_dev.compile_mask(
+                [self.get_valve_name(self.odor_valve),
+                 self.get_valve_name(self.NO_valve)])
+            chamber.rand_valves.compile_valves(odor_dev)
             clss = self.exp_classes
             for cls in [v for vals in self.animal_cls.values() for v in vals]:
                 if cls not in clss:
                     raise Exception('Protocol {} not recognized'.format(cls))
             for player in moas.barst.players:
                 player.set_state(True)
-            timer = app.timer
+            timer = chamber.get_timer()
             timer.clear_slices()
             elems = (
                 (0, 'Init'), (self.prehab, 'Prehab'),
@@ -397,8 +1300,50 @@ class VerifyConfigStage(MoaStage):
         self.step_stage()
         return True
 
+    def update_odor_widgets(self):
+        '''Colors and names the simulation odor buttons according to the
+        valves' roles.
+        '''
+        ch = App.get_running_app().simulation_devices.ids.odors.children
+        valve = ch[len(ch) - 1 - int(self.NO_valve[1:])]
+        valve.background_down = 'dark-blue-led-on-th.png'
+        valve.background_normal = 'dark-blue-led-off-th.png'
+        for p in [
+            valve for valves in self.chamber.rand_valves.rand_valves for
+                valve in valves]:
+            valve = ch[len(ch) - 1 - int(p[1:])]
+            valve.background_down = 'brown-led-on-th.png'
+            valve.background_normal = 'brown-led-off-th.png'
+        N = len(ch)
+        for i, name in enumerate(self.odor_names):
+            ch[N - 1 - i].text = name
+
+    def get_valve_name(self, name):
+        '''Returns the name of the odor device valve of the chamber's valve
+        `name`, whose number is relative to the first board of the chamber.
+        '''
+        i = int(name[1:])
+        if i >= 8 * self.num_boards:
+            raise Exception('Valve {} is not one of the {} valves of chamber '
+                            '{}'.format(name, 8 * self.num_boards,
+                                        self.chamber.chamber_id))
+        return 'p{}'.format(i + 8 * self.board_offset)
+
+    def latch_animal(self):
+        '''Copies the description of the next animal of the chamber from its
+        next animal button, see :meth:`ChamberStage.get_next_animal_btn`,
+        when the animal is started.
+        '''
+        btn = self.chamber.get_next_animal_btn()
+        self.animal_id = btn.animal_id
+        self.curr_animal_cls = btn.cls
+        self.filedata = {
+            'day': btn.day, 'group': btn.group, 'animal': btn.animal_id,
+            'cycle': btn.cycle}
+        self.chamber.get_recorder().trial_log = self.trial_log
+
     def read_odors(self):
-        N = 8 * moas.barst.num_boards[0]
+        N = 8 * self.num_boards
         odor_name = ['p{}'.format(i) for i in range(N)]
 
         # now read the odor list
@@ -416,76 +1361,234 @@ class VerifyConfigStage(MoaStage):
                 odor_name[i] = name
         self.odor_names = odor_name
 
+    def open_log(self, writer, filename, header=''):
+        '''Returns the :class:`~sock_cond.trial_log.TrialLogWriter` of the
+        log `filename` of the animal, reusing `writer`, the log's current
+        writer, if it's for the same file, otherwise closing it. Returns None
+        if `filename` is empty. If the log has a `header` which differs from
+        the header of the existing file, another file is used, see
+        :func:`~sock_cond.trial_log.get_log_filename`.
+        '''
+        fname = strftime(filename.format(**{'animal': self.animal_id}))
+        if fname and header:
+            fname = get_log_filename(fname, header)
+        if writer is not None:
+            if writer.filename == fname:
+                return writer
+            writer.close(join=False)
+        if not fname:
+            return None
+
+        def handle_exception(e):
+            Clock.schedule_once(
+                partial(App.get_running_app().device_exception, e))
+        return TrialLogWriter(
+            fname, header=header, flush_interval=self.log_flush_interval,
+            fsync=self.log_fsync, exception_callback=handle_exception)
+
+    def close_logs(self):
+        '''Closes the logs opened by :meth:`start_trials`, once their pending
+        lines are written.
+        '''
+        for writer in (self._log_writer, self._record_writer):
+            if writer is not None:
+                writer.close(join=False)
+        self._log_writer = self._record_writer = None
+
     def start_trials(self):
         try:
-            fname = strftime(
-                self.log_filename.format(**{'animal': self.animal_id}))
-            filename = self._filename
-
-            if filename != fname:
-                fd = self._fd
-                if fd is not None:
-                    fd.close()
-                    self._fd = None
-                if not fname:
-                    return
-                fd = self._fd = open(fname, 'a')
-                fd.write('Date,RatID,Trial,Time,Odor?,Shock?\n')
-                self._filename = fname
+            self._log_writer = self.open_log(
+                self._log_writer, self.log_filename,
+                'Date,RatID,Trial,Time,Odor?,Shock?,Seed\n')
+            self._record_writer = self.open_log(
+                self._record_writer, self.record_filename)
         except Exception as e:
             App.get_running_app().device_exception(e)
             return
-        self.odor_trial_count = 0
-        self.shock_trial_count = 0
 
-    def pre_trial(self):
-        self.trial_log['shock'] = self.trial_log['odor'] = False
+        seed = self.schedule_seed
+        if seed < 0:
+            seed = SystemRandom().randint(0, 2 ** 31 - 1)
+        self.schedule = self.compute_schedule(self.curr_animal_cls, seed)
+        self.seed = seed
+        Logger.info('Experiment: Schedule seed of animal "{}" is {}'.format(
+            self.animal_id, seed))
+        writer = self._record_writer
+        if writer is not None:
+            writer.write_record({
+                'type': 'schedule', 'time': time(), 'animal': self.animal_id,
+                'chamber': self.chamber.chamber_id,
+                'cls': self.curr_animal_cls, 'seed': seed,
+                'schedule': [list(trial) for trial in self.schedule]})
+        if self.schedule:
+            # until then, the timeline shows the longest ITI
+            self.chamber.get_timer().update_slice_attrs(
+                'ITI', duration=self.schedule[0][2])
+
+    def compute_schedule(self, cls, seed):
+        '''Returns the schedule of all the trials of an animal of class
+        `cls`, drawn from a random generator seeded with `seed`, so the same
+        seed always gives the same schedule.
+
+        It's a list of ``(odor, shock, iti, start)`` tuples, one for each
+        trial, where ``iti`` is the duration of the trial's ITI, and
+        ``start`` is the time the trial starts, relative to the start of the
+        prehab.
+        '''
+        rng = Random(seed)
+        n = self.num_trials[cls]
+        num_shock = self.num_shock_trials
+        odor_count = shock_count = 0
+        start = self.prehab
+        duration = self.pre_record + self.trial_duration + self.post_record
+        schedule = []
+
+        for _ in range(n):
+            odor = shock = False
+            if cls == 'PsdTrain':
+                odor = (bool(rng.randint(0, 1)) or shock_count == num_shock) \
+                    and odor_count < n - num_shock
+                if odor:
+                    odor_count += 1
+                else:
+                    shock_count += 1
+                    shock = True
+            elif cls == 'StdTrain':
+                odor = shock = True
+            elif cls == 'OdorOnly':
+                odor = True
+
+            iti = rng.uniform(self.iti_min[cls], self.iti_max[cls])
+            schedule.append((odor, shock, iti, start))
+            start += duration + iti
+        return schedule
 
-        cls = self.curr_animal_cls
-        if cls == 'NoOdor':
+    def pre_trial(self):
+        log = self.trial_log
+        self._trial_timing_start = len(
+            self.chamber.get_recorder().timing_log.records)
+        log['odor'], log['shock'], self.trial_iti, _ = \
+            self.schedule[log['trial']]
+        self.chamber.get_timer().update_slice_attrs(
+            'ITI', duration=self.trial_iti)
+
+    def schedule_stimuli(self):
+        '''When :attr:`sequence_stimuli`, computes the odor and shock timeline
+        of the trial from its start time, ``trial_log['ts']``, and passes it
+        to the :attr:`InitBarstStage.sequencer`. Must be called after
+        :meth:`pre_trial`.
+        '''
+        if not self.sequence_stimuli:
             return
-        elif cls == 'PsdTrain':
-            self.trial_log['odor'] = has_odor = ((
-                bool(randint(0, 1)) or
-                self.shock_trial_count == self.num_shock_trials) and
-                self.odor_trial_count <
-                self.num_trials['PsdTrain'] - self.num_shock_trials)
-            if has_odor:
-                self.odor_trial_count += 1
-            else:
-                self.shock_trial_count += 1
-                self.trial_log['shock'] = True
-        elif cls == 'StdTrain':
-            self.trial_log['shock'] = self.trial_log['odor'] = True
-        elif cls == 'OdorOnly':
-            self.trial_log['odor'] = True
+        barst = moas.barst
+        log = self.trial_log
+        call = barst.call_from_sequencer
+        onset, shock_onset, offset = self.get_stimulus_times()
+        odor_dev = barst.odor_dev
+        pin_dev = barst.ftdi_pin_dev
+        shocker = self.shocker_name
+
+        timeline = []
+        if log['odor']:
+            timeline.append((onset, 'odor_on', partial(
+                call, odor_dev.set_mask, self.odor_mask, 0)))
+        if log['shock']:
+            timeline.append((shock_onset, 'shock_on', partial(
+                call, pin_dev.set_state, high=[shocker])))
+            timeline.append((offset, 'shock_off', partial(
+                call, pin_dev.set_state, low=[shocker])))
+        if log['odor']:
+            timeline.append((offset, 'odor_off', partial(
+                call, odor_dev.set_mask, 0, self.odor_mask)))
+        barst.sequencer.schedule(
+            timeline, timing_log=self.chamber.get_recorder().timing_log)
+
+    def get_stimulus_times(self):
+        '''Returns the times the odor onset, shock onset, and the odor and
+        shock offset of the trial are intended for, from its start time,
+        ``trial_log['ts']``.
+        '''
+        onset = self.trial_log['ts'] + self.pre_record
+        offset = onset + self.trial_duration
+        return onset, offset - self.shock_duration, offset
 
     def set_odor(self, state):
-        if not self.trial_log['odor']:
+        '''Turns the odor of the trial on or off. It's always turned off, even
+        when :attr:`sequence_stimuli` or the trial has no odor, so that it's
+        never left on, but it's only recorded in the timing log when it was
+        turned on here.
+        '''
+        timed = self.trial_log['odor'] and not self.sequence_stimuli
+        if state and not timed:
             return
         dev = moas.barst.odor_dev
+        timing_log = self.chamber.get_recorder().timing_log
+        onset, _, offset = self.get_stimulus_times()
         if state:
-            dev.set_state(high=[self.odor_valve, self.NO_valve])
+            moas.barst.state_batcher.set_mask(
+                dev, high_mask=self.odor_mask, name='odor_on',
+                requested=onset, timing_log=timing_log)
         else:
-            dev.set_state(low=[self.odor_valve, self.NO_valve])
+            moas.barst.state_batcher.set_mask(
+                dev, low_mask=self.odor_mask,
+                name='odor_off' if timed else None, requested=offset,
+                timing_log=timing_log)
 
     def set_shock(self, state):
-        if not self.trial_log['shock']:
+        '''Like :meth:`set_odor`, but for the shock of the trial. '''
+        timed = self.trial_log['shock'] and not self.sequence_stimuli
+        if state and not timed:
             return
         dev = moas.barst.ftdi_pin_dev
+        timing_log = self.chamber.get_recorder().timing_log
+        _, onset, offset = self.get_stimulus_times()
         if state:
-            dev.set_state(high=['shocker'])
+            moas.barst.state_batcher.set_state(
+                dev, high=[self.shocker_name], name='shock_on',
+                requested=onset, timing_log=timing_log)
         else:
-            dev.set_state(low=['shocker'])
+            moas.barst.state_batcher.set_state(
+                dev, low=[self.shocker_name],
+                name='shock_off' if timed else None, requested=offset,
+                timing_log=timing_log)
+
+    def stop_stimuli(self):
+        '''Requests that the odor and shocker of the chamber be turned off,
+        e.g. when the experiment is stopped during a trial, after the
+        :attr:`InitBarstStage.sequencer` dropped their pending events.
+        '''
+        barst = moas.barst
+        if barst.odor_dev is not None and self.odor_mask:
+            barst.state_batcher.set_mask(
+                barst.odor_dev, low_mask=self.odor_mask)
+        if barst.ftdi_pin_dev is not None:
+            barst.state_batcher.set_state(
+                barst.ftdi_pin_dev, low=[self.shocker_name])
 
     def post_trial(self):
-        fd = self._fd
-        if fd is None:
+        log = self.trial_log
+        writer = self._log_writer
+        if writer is not None:
+            writer.write('{},{},{trial},{ts},{odor},{shock},{}\n'.format(
+                strftime('%m/%d/%Y %I:%M:%S %p'), self.animal_id, self.seed,
+                **log))
+
+        writer = self._record_writer
+        if writer is None:
             return
-        val = '{},{},{trial},{ts},{odor},{shock}'.format(
-            strftime('%m/%d/%Y %I:%M:%S %p'), self.animal_id, **self.trial_log)
-        fd.write(val)
-        fd.write('\n')
+        names = moas.barst.port_names
+        recorder = self.chamber.get_recorder()
+        events = recorder.timing_log.records[self._trial_timing_start:]
+        writer.write_record({
+            'time': time(), 'animal': self.animal_id,
+            'chamber': self.chamber.chamber_id,
+            'cls': self.curr_animal_cls, 'trial': log['trial'],
+            'odor': log['odor'], 'shock': log['shock'], 'ts': log['ts'],
+            'end': clock(),
+            'events': [list(event) for event in events],
+            'videos': list(recorder.trial_filenames),
+            'cams': [names[i] for i in recorder.cams],
+            'frames': list(recorder.trial_frames)})
 
     num_trials = ConfigPropertyDict(
         {'StdTrain': 10, 'PsdTrain': 20, 'OdorOnly': 10, 'NoOdor': 10},
@@ -495,6 +1598,23 @@ class VerifyConfigStage(MoaStage):
     num_shock_trials = ConfigParserProperty(
         1, 'Trial', 'num_shock_trials', exp_config_name, val_type=int)
 
+    chamber = ObjectProperty(None, allownone=True)
+    '''The :class:`ChamberStage` of the stage. '''
+
+    board_offset = 0
+    '''The index of the first odor board of the :attr:`chamber`. '''
+
+    num_boards = 1
+    '''The number of odor boards of the :attr:`chamber`. '''
+
+    shocker_name = 'shocker'
+    '''The pin device channel of the shocker of the :attr:`chamber`. '''
+
+    filedata = {}
+    '''The ``day``, ``group``, ``animal``, and ``cycle`` fields of the
+    filenames of the current animal, see :meth:`latch_animal`.
+    '''
+
     odor_valve = ConfigParserProperty(
         'p1', 'Odor', 'odor_valve', exp_config_name,
         val_type=verify_valve_name)
@@ -508,6 +1628,11 @@ class VerifyConfigStage(MoaStage):
 
     odor_names = ListProperty([])
 
+    odor_mask = 0
+    '''The valve mask of the :attr:`odor_valve` and :attr:`NO_valve`, compiled
+    when the stage is run.
+    '''
+
     pre_record = ConfigParserProperty(
         3, 'Video', 'pre_record', exp_config_name, val_type=float)
 
@@ -520,6 +1645,24 @@ class VerifyConfigStage(MoaStage):
     shock_duration = ConfigParserProperty(
         1, 'Trial', 'shock_duration', exp_config_name, val_type=float)
 
+    schedule_seed = ConfigParserProperty(
+        -1, 'Trial', 'schedule_seed', exp_config_name, val_type=int)
+    '''The seed of the random schedule of the trials of each animal, see
+    :meth:`compute_schedule`. If negative, a new seed is drawn for each
+    animal. The seed used is logged, added to each trial in the
+    :attr:`log_filename` log, and written with the schedule in the
+    :attr:`record_filename` log, so a session can be repeated by setting it
+    here.
+    '''
+
+    sequence_stimuli = ConfigParserProperty(
+        False, 'Trial', 'sequence_stimuli', exp_config_name, val_type=to_bool)
+    '''Whether the odor and shock of each trial are set by the
+    :attr:`InitBarstStage.sequencer` at their precomputed times, see
+    :meth:`schedule_stimuli`, rather than by the trial's ``Delay`` stages on
+    the kivy clock.
+    '''
+
     iti_min = ConfigPropertyDict(
         {'StdTrain': 50, 'PsdTrain': 106, 'OdorOnly': 50, 'NoOdor': 50},
         'Trial', 'iti_min', exp_config_name, val_type=float,
@@ -556,12 +1699,45 @@ class VerifyConfigStage(MoaStage):
         'RatO1D{day}G{group}R{animal}C{cycle}Trial{trial}Cam{cam}.avi',
         'Video', 'video_filename', exp_config_name, val_type=unicode_type)
 
+    session_video_filename = ConfigParserProperty(
+        'RatO1D{day}G{group}R{animal}C{cycle}Cam{cam}.avi',
+        'Video', 'session_video_filename', exp_config_name,
+        val_type=unicode_type)
+    '''The filename of the videos when :attr:`InitBarstStage.continuous_record`
+    is True. It's the same as :attr:`video_filename`, except the ``trial``
+    field is empty.
+    '''
+
     log_filename = ConfigParserProperty('', 'Experiment', 'log_filename',
                                         exp_config_name, val_type=unicode_type)
 
-    trial_log = {'trial': 0, 'odor': False, 'shock': False, 'ts': 0}
+    record_filename = ConfigParserProperty(
+        '', 'Experiment', 'record_filename', exp_config_name,
+        val_type=unicode_type)
+    '''The filename of the log to which a json record of each trial is
+    appended, with its chamber, class, stimuli, the
+    :attr:`ChamberRecorder.timing_log` records of its stimuli, and its video
+    files and frame counts. Before the trials of each animal, a record with
+    the ``'schedule'`` ``type`` and its :attr:`schedule` and :attr:`seed` is
+    appended. If empty, it's not written. See
+    :func:`~sock_cond.trial_log.read_trial_records`.
+    '''
 
-    exp_classes = ['StdTrain', 'PsdTrain', 'OdorOnly', 'NoOdor']
+    log_flush_interval = ConfigParserProperty(
+        1., 'Experiment', 'log_flush_interval', exp_config_name,
+        val_type=float)
+    '''How often, in seconds, the logs are flushed to disk. If zero, each
+    line is flushed when written.
+    '''
+
+    log_fsync = ConfigParserProperty(
+        True, 'Experiment', 'log_fsync', exp_config_name, val_type=to_bool)
+    '''Whether the logs are also fsynced when flushed. '''
+
+    trial_log = {}
+    '''The trial number, start time, and stimuli of the current trial. '''
+
+    exp_classes = exp_classes
 
     max_t = NumericProperty(0)
 
@@ -569,12 +1745,28 @@ class VerifyConfigStage(MoaStage):
 
     offset_t = NumericProperty(0)
 
+    animal_id = NumericProperty(-1)
+    '''The id of the current animal of the :attr:`chamber`. '''
+
     curr_animal_cls = StringProperty(exp_classes[0])
+    '''The class of the current animal of the :attr:`chamber`. '''
+
+    schedule = []
+    '''The schedule of the trials of the current animal, computed when its
+    trials start, see :meth:`compute_schedule`.
+    '''
 
-    odor_trial_count = 0
-    shock_trial_count = 0
-    _filename = ''
-    _fd = None
+    seed = 0
+    '''The seed of the :attr:`schedule`. '''
+
+    trial_iti = NumericProperty(0)
+    '''The duration of the ITI of the current trial, from the
+    :attr:`schedule`.
+    '''
+
+    _log_writer = None
+    _record_writer = None
+    _trial_timing_start = 0
 
 
 class RandValves(Delay):
@@ -582,7 +1774,7 @@ class RandValves(Delay):
     def __init__(self, **kwargs):
         super(RandValves, self).__init__(**kwargs)
         self.high = []
-        self.low = [list(set(valves)) for valves in self.rand_valves]
+        self.low = []
         self.delay_type = 'random'
         self.max = self.valve_rand_max
         self.min = self.valve_rand_min
@@ -600,13 +1792,35 @@ class RandValves(Delay):
         self.low = lnew + l[len(hnew):]
         self.high = hnew + h[len(lnew):]
 
-        moas.barst.odor_dev.set_state(
-            low=[l for lows in self.low for l in lows],
-            high=[h for highs in self.high for h in highs])
+        high_mask = low_mask = 0
+        for mask in self.high:
+            high_mask |= mask
+        for mask in self.low:
+            low_mask |= mask
+        moas.barst.state_batcher.set_mask(
+            moas.barst.odor_dev, high_mask=high_mask, low_mask=low_mask,
+            name='rand_valves',
+            timing_log=self.chamber.get_recorder().timing_log)
         return True
 
+    def compile_valves(self, odor_dev):
+        '''Compiles each group of :attr:`rand_valves` into a valve mask of
+        `odor_dev`, mapping the valves to the boards of the :attr:`chamber`.
+        All the groups start low.
+        '''
+        get_name = self.chamber.verify.get_valve_name
+        self.high = []
+        self.low = [odor_dev.compile_mask(set(map(get_name, valves)))
+                    for valves in self.rand_valves]
+
+    chamber = ObjectProperty(None, allownone=True)
+    '''The :class:`ChamberStage` of the stage. '''
+
     high = []
+    '''The masks of the :attr:`rand_valves` groups currently high. '''
+
     low = []
+    '''The masks of the :attr:`rand_valves` groups currently low. '''
 
     rand_valves = ConfigPropertyList(
         'p0', 'Odor', 'rand_valves', exp_config_name,
@@ -0,0 +1,36 @@
+import json
+from struct import Struct
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('moa')
+
+from sock_cond.export import get_session_tables
+
+# see sock_cond.devices.frame_timestamp_struct
+frame_timestamp_struct = Struct('<QqQQ')
+
+
+def test_export_cams_and_frames(tmp_path):
+    video = str(tmp_path / 'Trial0Cam0.avi')
+    with open(video + '.timestamps', 'wb') as fh:
+        for i in range(3):
+            fh.write(frame_timestamp_struct.pack(
+                (10 + i) * 10 ** 9, i * 5 * 10 ** 8, i, 0))
+
+    records = str(tmp_path / 'Records.jsonl')
+    with open(records, 'w') as fh:
+        fh.write(json.dumps({
+            'time': 0., 'animal': 10, 'cls': 'StdTrain', 'trial': 0,
+            'odor': True, 'shock': True, 'ts': 1., 'end': 2.,
+            'events': [['odor_on', 1., 1., 1.001, None]],
+            'videos': [video], 'cams': ['0', '1'], 'frames': [3, 4]}) + '\n')
+
+    tables = get_session_tables([records])
+    assert list(tables['cam_name']) == ['0', '1']
+    assert list(tables['cam_frames']) == [3, 4]
+    assert list(tables['video_file']) == [0]
+    assert list(tables['frame_file']) == [0, 0, 0]
+    assert np.allclose(tables['frame_pts'], [0, .5, 1.])
+    assert np.allclose(tables['frame_time'], [10, 11, 12])
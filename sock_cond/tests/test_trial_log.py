@@ -0,0 +1,69 @@
+from time import sleep
+
+import pytest
+
+pytest.importorskip('moa')
+
+import sock_cond.trial_log
+from sock_cond.trial_log import (
+    TrialLogWriter, get_log_filename, read_trial_records)
+
+
+class SlowFile(object):
+    '''Delays the first write, so that the next lines are written while the
+    thread is busy writing.
+    '''
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.delayed = False
+
+    def write(self, line):
+        if not self.delayed:
+            self.delayed = True
+            sleep(0.1)
+        self.fd.write(line)
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+
+def test_zero_flush_interval_writes_all_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        sock_cond.trial_log, 'open',
+        lambda *largs: SlowFile(open(*largs)), raising=False)
+    filename = str(tmp_path / 'log.jsonl')
+    writer = TrialLogWriter(filename, flush_interval=0, fsync=False)
+    monkeypatch.undo()
+    try:
+        writer.write_record({'trial': 0})
+        sleep(0.05)
+        for i in range(1, 5):
+            writer.write_record({'trial': i})
+        for _ in range(100):
+            sleep(0.01)
+            if len(read_trial_records(filename)) == 5:
+                break
+        assert [r['trial'] for r in read_trial_records(filename)] == \
+            list(range(5))
+    finally:
+        writer.close()
+
+
+def test_log_filename_with_other_header(tmp_path):
+    header = 'Date,Trial,Seed\n'
+    filename = str(tmp_path / 'log.csv')
+    assert get_log_filename(filename, header) == filename
+
+    with open(filename, 'w') as fh:
+        fh.write(header)
+    assert get_log_filename(filename, header) == filename
+
+    with open(filename, 'w') as fh:
+        fh.write('Date,Trial\n')
+    other = str(tmp_path / 'log-1.csv')
+    assert get_log_filename(filename, header) == other
+
+    writer = TrialLogWriter(other, header=header, fsync=False)
+    writer.close()
+    assert get_log_filename(filename, header) == other
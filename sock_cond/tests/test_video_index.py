@@ -0,0 +1,81 @@
+from struct import pack, unpack
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from sock_cond.video_index import (
+    build_avi_index, write_frame_index, VideoFrameReader)
+
+
+def chunk(fourcc, data):
+    return fourcc + pack('<I', len(data)) + data + b'\0' * (len(data) & 1)
+
+
+def write_avi(filename, frames, width, height, compression, bit_count):
+    '''Writes a minimal AVI file of one video stream with `frames`, each
+    followed by an empty chunk, like the ones ffmpeg writes.
+    '''
+    strf = pack('<IiiHHI', 40, width, height, 1, bit_count, compression)
+    strl = b'strl' + chunk(b'strh', b'vids' + b'\0' * 52) + \
+        chunk(b'strf', strf + b'\0' * 20)
+    hdrl = b'hdrl' + chunk(b'avih', b'\0' * 56) + chunk(b'LIST', strl)
+    movi = b'movi' + b''.join(
+        chunk(b'00db', frame) + chunk(b'00db', b'') for frame in frames)
+    with open(filename, 'wb') as fh:
+        fh.write(chunk(b'RIFF', b'AVI ' + chunk(b'LIST', hdrl) +
+                       chunk(b'LIST', movi)))
+
+
+def test_index_skips_empty_chunks(tmp_path):
+    filename = str(tmp_path / 'video.avi')
+    w, h, n = 4, 2, 20
+    frames = [bytes(bytearray([i] * (w * h))) for i in range(n)]
+    write_avi(filename, frames, w, h, 0, 8)
+
+    assert len(build_avi_index(filename)) == n
+    assert write_frame_index(filename, filename + '.frameidx') == n
+
+    reader = VideoFrameReader(filename)
+    try:
+        assert reader.get_num_frames() == n
+        for i in range(n):
+            frame = reader.get_frame(i)
+            assert frame.shape == (h, w)
+            assert (frame == i).all()
+    finally:
+        reader.close()
+
+
+def test_read_yuv420p_frames(tmp_path):
+    filename = str(tmp_path / 'video.avi')
+    w, h = 3, 2
+    # a white and a red frame, the chroma planes are 2x1
+    colors = [(235, 128, 128), (81, 90, 240)]
+    frames = [
+        bytes(bytearray([y] * (w * h) + [u] * 2 + [v] * 2))
+        for y, u, v in colors]
+    write_avi(filename, frames, w, h, unpack('<I', b'I420')[0], 12)
+
+    reader = VideoFrameReader(filename)
+    try:
+        white, red = reader.get_frames(0)
+        assert white.shape == red.shape == (h, w, 3)
+        assert (white >= 253).all()
+        assert (np.abs(red.astype(int) - [255, 0, 0]) <= 2).all()
+    finally:
+        reader.close()
+
+
+def test_compressed_frames_raise(tmp_path):
+    filename = str(tmp_path / 'video.avi')
+    write_avi(filename, [b'\xff\xd8data'], 2, 2,
+              unpack('<I', b'MJPG')[0], 24)
+
+    reader = VideoFrameReader(filename)
+    try:
+        with pytest.raises(ValueError):
+            reader.get_frame(0)
+        assert reader.get_frame_data(0).tobytes() == b'\xff\xd8data'
+    finally:
+        reader.close()
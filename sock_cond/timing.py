@@ -0,0 +1,134 @@
+'''The time source of the experiment.
+
+All the experiment timestamps, e.g. the trial times logged by
+:class:`~sock_cond.stages.VerifyConfigStage`, come from :func:`clock`, which
+by default returns the real, monotonic, time.
+
+When simulating, a :class:`VirtualClock` can be installed instead. Once
+installed, the kivy :class:`~kivy.clock.Clock`, and therefore all the
+``Delay`` stages, including :class:`~sock_cond.stages.RandValves`, also use the
+virtual time, so that a whole session can be simulated in a fraction of its
+real duration.
+'''
+
+__all__ = ('clock', 'real_clock', 'VirtualClock', 'get_time_source')
+
+try:
+    from time import perf_counter as real_clock
+except ImportError:
+    from time import clock as real_clock
+
+import kivy
+import kivy.clock as kivy_clock
+
+_time_source = real_clock
+
+
+def clock():
+    '''Returns the current experiment time, in seconds, from the installed
+    time source.
+    '''
+    return _time_source()
+
+
+def get_time_source():
+    '''Returns the installed :class:`VirtualClock`, or None if the real time
+    is used.
+    '''
+    source = _time_source
+    return getattr(source, '__self__', None)
+
+
+class VirtualClock(object):
+    '''A time source that runs faster than the real time.
+
+    In the default mode, the time advances :attr:`speed` times faster than the
+    real time. If :attr:`step` is non-zero, the time instead only advances by
+    :attr:`step` seconds each time :meth:`advance` is called, e.g. once per
+    kivy clock tick, skipping the time between the events.
+
+    Threads that are paced by the real time, e.g. the cameras, are not
+    affected.
+
+    Kivy has no public API to replace the time of its clock, so
+    :meth:`install` replaces the private ``kivy.clock._default_time``, and the
+    ``_max_fps`` and ``_last_tick`` of the clock, as in kivy 1.9. It raises
+    an exception if the installed kivy doesn't have them.
+    '''
+
+    speed = 1.
+    '''How many times faster than the real time the time advances. '''
+
+    step = 0.
+    '''If non-zero, the time advanced by each :meth:`advance`. '''
+
+    _real_start = 0.
+    _start = 0.
+    _time = 0.
+    _installed = None
+
+    def __init__(self, speed=1., step=0., **kwargs):
+        super(VirtualClock, self).__init__(**kwargs)
+        self.speed = speed
+        self.step = step
+        self._real_start = self._start = self._time = real_clock()
+
+    def time(self):
+        '''Returns the current virtual time, in seconds.
+        '''
+        if self.step:
+            return self._time
+        return self._start + (real_clock() - self._real_start) * self.speed
+
+    def advance(self):
+        '''Advances the time by :attr:`step`, when non-zero.
+        '''
+        if self.step:
+            self._time += self.step
+
+    def install(self):
+        '''Makes this the time source of :func:`clock` and of the kivy clock.
+        '''
+        global _time_source
+        if self._installed is not None:
+            return
+        Clock = kivy_clock.Clock
+        missing = [
+            name for obj, name in (
+                (kivy_clock, '_default_time'), (Clock, '_max_fps'),
+                (Clock, '_last_tick')) if not hasattr(obj, name)]
+        if missing:
+            raise Exception(
+                'The time of the clock of kivy {} cannot be replaced, it has '
+                'no {}'.format(kivy.__version__, ', '.join(missing)))
+        self._installed = (
+            _time_source, kivy_clock._default_time, Clock.__dict__.get('time'),
+            Clock._max_fps)
+
+        _time_source = self.time
+        kivy_clock._default_time = self.time
+        if hasattr(Clock, 'time'):
+            Clock.time = self.time
+        if self.step:
+            # the clock would wait forever for the time to pass between frames
+            Clock._max_fps = 0
+        Clock._last_tick = self.time()
+
+    def uninstall(self):
+        '''Restores the time source replaced by :meth:`install`.
+        '''
+        global _time_source
+        if self._installed is None:
+            return
+        Clock = kivy_clock.Clock
+        source, default_time, clock_time, max_fps = self._installed
+        self._installed = None
+
+        _time_source = source
+        kivy_clock._default_time = default_time
+        if clock_time is None:
+            Clock.__dict__.pop('time', None)
+        else:
+            Clock.time = clock_time
+        Clock._max_fps = max_fps
+        Clock._last_tick = default_time()
@@ -0,0 +1,166 @@
+'''The logs of the trials.
+
+The logs are written by :class:`TrialLogWriter` from a background thread, so
+that writing them never blocks the stages. The files are only appended to, one
+complete line per record, and are flushed, and optionally fsynced, every
+:attr:`TrialLogWriter.flush_interval`, so after a crash at most the records of
+the last interval are lost and at most the last line is truncated.
+:func:`read_trial_records` skips such a line.
+'''
+
+__all__ = ('TrialLogWriter', 'get_log_filename', 'read_trial_records')
+
+import os
+import json
+from threading import Thread, Condition
+from os.path import isfile, getsize, splitext
+
+from moa.logger import Logger
+
+
+class TrialLogWriter(object):
+    '''Appends lines or records to :attr:`filename` from a background thread.
+
+    :meth:`write` takes a line of text, :meth:`write_record` a dict that is
+    written as a line of json by the thread.
+    '''
+
+    filename = ''
+    '''The file appended to. '''
+
+    flush_interval = 1.
+    '''How often, in seconds, the written lines are flushed to the file. If
+    zero, they are flushed as soon as they are written.
+    '''
+
+    fsync = True
+    '''Whether the file is also fsynced each time it's flushed, so that the
+    lines survive a crash of the system, not only of the process.
+    '''
+
+    exception_callback = None
+    '''If not None, called from the thread with the exception raised when
+    writing.
+    '''
+
+    _fd = None
+    _lines = []
+    _closing = False
+    _cond = None
+    _thread = None
+
+    def __init__(self, filename, header='', flush_interval=1., fsync=True,
+                 exception_callback=None, **kwargs):
+        super(TrialLogWriter, self).__init__(**kwargs)
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.exception_callback = exception_callback
+        self._lines = []
+        self._cond = Condition()
+
+        new = not isfile(filename) or not getsize(filename)
+        self._fd = open(filename, 'a')
+        if header and new:
+            self._lines.append(header)
+
+        self._thread = Thread(
+            target=self._write_lines, name='Trial log {}'.format(filename))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, line):
+        '''Appends the text `line`, which should end with a newline.
+        '''
+        with self._cond:
+            self._lines.append(line)
+            if not self.flush_interval:
+                self._cond.notify()
+
+    def write_record(self, record):
+        '''Appends the dict `record` as a line of json.
+        '''
+        self.write(record)
+
+    def close(self, join=True):
+        '''Writes the remaining lines and closes the file. If `join`, it
+        waits until it's closed.
+        '''
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if join:
+            self._thread.join()
+
+    def _write_lines(self):
+        fd = self._fd
+        cond = self._cond
+        while True:
+            with cond:
+                if self.flush_interval:
+                    if not self._closing:
+                        cond.wait(self.flush_interval)
+                else:
+                    # lines written while the last ones were written didn't
+                    # wait for a notify
+                    while not self._lines and not self._closing:
+                        cond.wait()
+                lines = self._lines
+                self._lines = []
+                closing = self._closing
+
+            try:
+                if lines:
+                    for line in lines:
+                        if isinstance(line, dict):
+                            line = json.dumps(line, sort_keys=True) + '\n'
+                        fd.write(line)
+                    fd.flush()
+                    if self.fsync:
+                        os.fsync(fd.fileno())
+            except Exception as e:
+                Logger.error('Trial log: {}'.format(e))
+                if self.exception_callback is not None:
+                    self.exception_callback(e)
+            if closing:
+                fd.close()
+                return
+
+
+def get_log_filename(filename, header):
+    '''Returns the filename to which the log `filename`, whose first line is
+    `header`, is appended. It's `filename`, unless it already has a different
+    header, e.g. from when the log had other columns. Then it's the first of
+    ``name-1.ext``, ``name-2.ext``, etc., that is new or has `header`.
+    '''
+    root, ext = splitext(filename)
+    fname = filename
+    n = 0
+    while isfile(fname) and getsize(fname):
+        with open(fname, 'r') as fh:
+            if fh.readline() == header:
+                break
+        n += 1
+        fname = '{}-{}{}'.format(root, n, ext)
+
+    if fname != filename:
+        Logger.warning(
+            'Trial log: {} has a different header, logging to {}'.format(
+                filename, fname))
+    return fname
+
+
+def read_trial_records(filename):
+    '''Returns the list of the records written with
+    :meth:`TrialLogWriter.write_record` to `filename`. A truncated last line,
+    e.g. from a crash, is skipped.
+    '''
+    records = []
+    with open(filename, 'r') as fh:
+        for line in fh:
+            if not line.endswith('\n'):
+                break
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
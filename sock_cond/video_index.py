@@ -0,0 +1,293 @@
+'''Indexes the frames of the recorded AVI files, so that any frame can be
+read directly, without decoding the file from the start.
+
+:func:`write_frame_index` is called by
+:class:`~sock_cond.writer_devices.FFPyWriterDevice` when it closes a file. It
+walks the chunk headers of the AVI file, so it doesn't read the frames
+themselves, and writes a row of :data:`frame_index_struct` for each frame to
+the index file. :class:`VideoFrameReader` then memory maps the video and
+returns the uncompressed frames, e.g. of the ``'rawvideo'`` codec, as numpy
+arrays, e.g.::
+
+    reader = VideoFrameReader('RatO1DhabG1R10C0Trial3Cam0.avi')
+    frames = reader.get_frames(90, 120)
+
+The index module itself only uses the standard library, the reader requires
+numpy.
+'''
+
+__all__ = ('frame_index_struct', 'build_avi_index', 'read_avi_streams',
+           'write_frame_index', 'VideoFrameReader')
+
+from struct import Struct
+from os.path import isfile, getsize
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+frame_index_struct = Struct('<QQQ')
+'''The little endian row of a frame index file for each frame: the offset of
+the frame's data in the video file, its size in bytes, and its stream.
+'''
+
+_chunk_header = Struct('<4sI')
+_bitmap_header = Struct('<IiiHHI')
+_fourcc = Struct('<I')
+# the compression of uncompressed frames, RGB (0) or gray fourccs
+_raw_compressions = (0, ) + tuple(
+    _fourcc.unpack(cc)[0] for cc in (b'Y800', b'Y8  ', b'GREY', b'RAW '))
+# the planar yuv420p fourccs, the default of the 'rawvideo' codec
+_i420_compressions = tuple(
+    _fourcc.unpack(cc)[0] for cc in (b'I420', b'IYUV'))
+_yv12_compression = _fourcc.unpack(b'YV12')[0]
+
+
+def _iter_chunks(fh, start, end):
+    # yields the fourcc, data offset, and size of the chunks in start-end
+    pos = start
+    while pos + 8 <= end:
+        fh.seek(pos)
+        data = fh.read(8)
+        if len(data) < 8:
+            return
+        fourcc, size = _chunk_header.unpack(data)
+        yield fourcc, pos + 8, size
+        # chunks are padded to an even size
+        pos += 8 + size + (size & 1)
+
+
+def _iter_riff(fh):
+    # yields the fourcc, data offset, and end of the top level lists of the
+    # RIFF chunks, including the OpenDML AVIX chunks of files over 1GB
+    fh.seek(0, 2)
+    file_end = fh.tell()
+    for fourcc, pos, size in _iter_chunks(fh, 0, file_end):
+        if fourcc != b'RIFF':
+            break
+        fh.seek(pos)
+        form = fh.read(4)
+        if form not in (b'AVI ', b'AVIX'):
+            raise ValueError('{} is not an AVI file'.format(fh.name))
+        # a file that was not closed properly may have a wrong size
+        end = min(pos + size, file_end) if size else file_end
+        for item in _iter_chunks(fh, pos + 4, end):
+            if item[0] != b'LIST':
+                continue
+            fh.seek(item[1])
+            yield fh.read(4), item[1] + 4, min(item[1] + item[2], end)
+
+
+def _index_movi(fh, start, end, frames):
+    for fourcc, pos, size in _iter_chunks(fh, start, end):
+        if fourcc == b'LIST':
+            # 'rec ' lists group the chunks of the streams
+            _index_movi(fh, pos + 4, min(pos + size, end), frames)
+        elif fourcc[2:] in (b'db', b'dc') and fourcc[:2].isdigit() and \
+                size:
+            # ffmpeg writes empty chunks, e.g. for padding, which are not
+            # frames
+            frames.append((pos, size, int(fourcc[:2])))
+
+
+def build_avi_index(filename):
+    '''Returns a list of ``(offset, size, stream)`` tuples, one for each frame
+    of the AVI file `filename`, in file order. Empty chunks are skipped, so
+    the i'th frame of a stream is its i'th frame written.
+    '''
+    frames = []
+    with open(filename, 'rb') as fh:
+        for name, start, end in _iter_riff(fh):
+            if name == b'movi':
+                _index_movi(fh, start, end, frames)
+    return frames
+
+
+def read_avi_streams(filename):
+    '''Returns a list with a dict for each stream of the AVI file `filename`,
+    with its ``type``, e.g. ``'vids'``, and for video streams its
+    ``width``, ``height`` (negative if the rows are stored top down),
+    ``bit_count``, and ``compression`` fourcc, which is 0 for uncompressed
+    RGB.
+    '''
+    streams = []
+    with open(filename, 'rb') as fh:
+        for name, start, end in _iter_riff(fh):
+            if name != b'hdrl':
+                continue
+            for fourcc, pos, size in _iter_chunks(fh, start, end):
+                if fourcc != b'LIST':
+                    continue
+                fh.seek(pos)
+                if fh.read(4) != b'strl':
+                    continue
+                stream = {}
+                for cc, p, s in _iter_chunks(fh, pos + 4, pos + size):
+                    fh.seek(p)
+                    if cc == b'strh':
+                        stream['type'] = fh.read(4).decode('latin-1')
+                    elif cc == b'strf' and s >= _bitmap_header.size:
+                        _, w, h, _, bits, comp = _bitmap_header.unpack(
+                            fh.read(_bitmap_header.size))
+                        stream.update({
+                            'width': w, 'height': h, 'bit_count': bits,
+                            'compression': comp})
+                streams.append(stream)
+            break
+    return streams
+
+
+def write_frame_index(filename, index_filename):
+    '''Writes the frame index of the AVI file `filename`, see
+    :func:`build_avi_index`, to `index_filename`. Returns the number of
+    frames.
+    '''
+    pack = frame_index_struct.pack
+    frames = build_avi_index(filename)
+    with open(index_filename, 'wb') as fh:
+        fh.write(b''.join(pack(*frame) for frame in frames))
+    return len(frames)
+
+
+class VideoFrameReader(object):
+    '''Reads the frames of an AVI file, indexed by its frame index file, from
+    a memory map of the file.
+
+    Uncompressed RGB and gray frames, e.g. of the ``'rawvideo'`` codec, are
+    returned by :meth:`get_frame` as ``(height, width)`` or ``(height, width,
+    bytes per pixel)`` arrays viewing the file, with the rows top down.
+    Planar yuv420p frames (``I420``, ``IYUV``, or ``YV12``) are converted to
+    ``(height, width, 3)`` RGB arrays. Compressed frames can only be read
+    with :meth:`get_frame_data` as the encoded bytes, which, for intra frame
+    codecs such as ``'mjpeg'`` or ``'ffv1'``, can each be decoded on their
+    own.
+    '''
+
+    filename = ''
+    '''The video file. '''
+
+    streams = []
+    '''See :func:`read_avi_streams`. '''
+
+    index = None
+    '''The structured array of the ``offset``, ``size``, and ``stream`` of
+    each frame of the file.
+    '''
+
+    _data = None
+    _stream_rows = {}
+
+    def __init__(self, filename, index_suffix='.frameidx', **kwargs):
+        super(VideoFrameReader, self).__init__(**kwargs)
+        if np is None:
+            raise ImportError('numpy is required to read the frames')
+        self.filename = filename
+        self.streams = read_avi_streams(filename)
+        self._stream_rows = {}
+
+        dtype = np.dtype(
+            [('offset', '<u8'), ('size', '<u8'), ('stream', '<u8')])
+        index_filename = filename + index_suffix
+        if index_suffix and isfile(index_filename) and \
+                getsize(index_filename) >= dtype.itemsize:
+            self.index = np.memmap(
+                index_filename, dtype=dtype, mode='r',
+                shape=(getsize(index_filename) // dtype.itemsize, ))
+        else:
+            self.index = np.array(build_avi_index(filename), dtype=dtype)
+        self._data = np.memmap(filename, dtype='u1', mode='r')
+
+    def get_stream_rows(self, stream=0):
+        '''Returns the rows of :attr:`index` of the frames of `stream`.
+        '''
+        rows = self._stream_rows.get(stream)
+        if rows is None:
+            rows = self._stream_rows[stream] = np.nonzero(
+                self.index['stream'] == stream)[0]
+        return rows
+
+    def get_num_frames(self, stream=0):
+        return len(self.get_stream_rows(stream))
+
+    def get_frame_data(self, i, stream=0):
+        '''Returns the data of the `i`'th frame of `stream`, as stored in the
+        file, as a 1 dimensional array viewing the file.
+        '''
+        row = self.index[self.get_stream_rows(stream)[i]]
+        offset, size = int(row['offset']), int(row['size'])
+        return self._data[offset:offset + size]
+
+    def get_frame(self, i, stream=0):
+        '''Returns the `i`'th frame of `stream` as an image array. Raises a
+        `ValueError` if the frames of the stream are compressed, or don't
+        match its size, see :meth:`get_frame_data`.
+        '''
+        data = self.get_frame_data(i, stream)
+        size = len(data)
+        info = self.streams[stream] if stream < len(self.streams) else {}
+        w, h = abs(info.get('width', 0)), info.get('height', 0)
+        bpp = info.get('bit_count', 0) // 8
+        compression = info.get('compression')
+        if not w or not h:
+            raise ValueError('Stream {} of {} is not a video stream'.format(
+                stream, self.filename))
+
+        if compression in _i420_compressions or \
+                compression == _yv12_compression:
+            return self._get_rgb_from_yuv420(
+                data, w, abs(h), compression == _yv12_compression)
+
+        if compression not in _raw_compressions or not bpp:
+            raise ValueError(
+                'The frames of stream {} of {} are compressed ({}), use '
+                'get_frame_data to read their data'.format(
+                    stream, self.filename, _fourcc.pack(
+                        compression or 0).decode('latin-1')))
+        if size % abs(h) or size // abs(h) < w * bpp:
+            raise ValueError(
+                'Frame {} of stream {} of {} has {} bytes, which is not a '
+                '{}x{} frame'.format(i, stream, self.filename, size, w, h))
+
+        # rows may be padded, e.g. to 4 bytes
+        image = data.reshape(abs(h), size // abs(h))[:, :w * bpp]
+        if h > 0 and info.get('compression') == 0:
+            # bottom up RGB
+            image = image[::-1]
+        if bpp == 1:
+            return image
+        return image.reshape(abs(h), w, bpp)
+
+    def _get_rgb_from_yuv420(self, data, w, h, yv12):
+        cw, ch = (w + 1) // 2, (h + 1) // 2
+        if len(data) < w * h + 2 * cw * ch:
+            raise ValueError(
+                '{} bytes is not a {}x{} yuv420p frame of {}'.format(
+                    len(data), w, h, self.filename))
+        y = data[:w * h].reshape(h, w)
+        u = data[w * h:w * h + cw * ch].reshape(ch, cw)
+        v = data[w * h + cw * ch:w * h + 2 * cw * ch].reshape(ch, cw)
+        if yv12:
+            u, v = v, u
+
+        # upsample the chroma planes and convert with BT.601, the swscale
+        # default
+        y = (y.astype(np.float32) - 16.) * 1.164
+        u = u.repeat(2, 0).repeat(2, 1)[:h, :w].astype(np.float32) - 128.
+        v = v.repeat(2, 0).repeat(2, 1)[:h, :w].astype(np.float32) - 128.
+        rgb = np.empty((h, w, 3), dtype=np.float32)
+        rgb[:, :, 0] = y + 1.596 * v
+        rgb[:, :, 1] = y - 0.392 * u - 0.813 * v
+        rgb[:, :, 2] = y + 2.017 * u
+        return np.clip(np.rint(rgb), 0, 255).astype(np.uint8)
+
+    def get_frames(self, start, end=None, stream=0):
+        '''Returns a list of the frames `start` until `end` of `stream`, see
+        :meth:`get_frame`. If `end` is None, it's until the last frame.
+        '''
+        n = self.get_num_frames(stream)
+        end = n if end is None else min(end, n)
+        return [self.get_frame(i, stream) for i in range(start, end)]
+
+    def close(self):
+        self._data = self.index = None
+        self._stream_rows = {}
@@ -0,0 +1,421 @@
+'''The device that writes the camera frames to disk. It, and the cplcom
+device module it builds on, are only imported when the writers are created,
+see :func:`~sock_cond.lazy.import_timed`.
+'''
+
+__all__ = ('FFPyWriterDevice', )
+
+from threading import Thread
+from collections import deque
+from heapq import heappush, heappop
+from time import sleep
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import clock
+
+from moa.compat import unicode_type
+from moa.base import MoaBase
+from moa.utils import ConfigPropertyList
+from moa.logger import Logger
+
+from kivy.properties import (
+    ConfigParserProperty, ListProperty, NumericProperty, StringProperty)
+
+from cplcom import exp_config_name
+from cplcom.device import DeviceStageInterface
+
+from sock_cond.lazy import import_timed
+from sock_cond.devices import (
+    FrameQueue, frame_timestamp_struct, get_cam_value, percentiles,
+    verify_codec, verify_queue_unit, verify_queue_overflow,
+    default_codec_fmt)
+
+
+class FFPyWriterDevice(MoaBase, DeviceStageInterface):
+    '''Device that writes the frames of a camera to files on a secondary
+    thread.
+
+    A single writer and thread is used for a camera throughout the experiment.
+    Each trial's file is opened with :meth:`open_file` and closed with
+    :meth:`close_file`, and the frames added with :meth:`add_frame` in between
+    are written to it. The file is opened and closed in the writer's thread,
+    so the caller is never blocked.
+
+    When more than one camera is in :attr:`sources`, each camera is written
+    as a separate stream of the same file, and frames are interleaved by pts
+    before they are written.
+
+    Frames are passed to the thread through a bounded
+    :class:`~sock_cond.devices.FrameQueue` configured from the ``Video``
+    section of the config. The frames are also encoded in that thread, using
+    the codec configured for each camera.
+
+    A :data:`~sock_cond.devices.frame_timestamp_struct` row is appended for
+    each frame written to a timestamp file named after the video file with
+    :attr:`timestamps_suffix` appended, so that the frames can be aligned to
+    the trial events, and drops detected from gaps in the frame index, without
+    decoding the video.
+
+    When a file is closed, its frame index, see
+    :func:`~sock_cond.video_index.write_frame_index`, is written to a file
+    named after it with :attr:`frame_index_suffix` appended, from which
+    :class:`~sock_cond.video_index.VideoFrameReader` reads any of its frames.
+    '''
+
+    _frame_queue = None
+    _thread = None
+    _writer = None
+    _stopping = False
+    _filename = ''
+    _index_fd = None
+    _timestamps_fd = None
+    # the id of the file being written by the writer's thread
+    _writer_file_id = 0
+
+    file_id = 0
+    '''The id of the file last opened with :meth:`open_file`. It's passed to
+    :meth:`add_frame` so frames added after the file was closed are dropped.
+    '''
+
+    _stream_written = []
+    _latencies = None
+
+    frames_enqueued = NumericProperty(0)
+    '''The number of frames added to the queue by :meth:`add_frame`. '''
+
+    frames_dropped = NumericProperty(0)
+    '''The number of frames dropped because the queue was full. '''
+
+    frames_written = NumericProperty(0)
+    '''The number of frames written to the files. '''
+
+    queue_depth = NumericProperty(0)
+    '''The size, in :attr:`queue_size_unit`, of the queue. '''
+
+    queue_high_water = NumericProperty(0)
+    '''The largest size, in :attr:`queue_size_unit`, the queue has reached.
+    '''
+
+    write_latency = ListProperty([0, 0, 0])
+    '''The 50th, 90th, and 99th percentile, in ms, of the time from when
+    recent frames were added with :meth:`add_frame` until they were written.
+    '''
+
+    queue_size = ConfigParserProperty(
+        150, 'Video', 'queue_size', exp_config_name, val_type=int)
+    '''The capacity of the frame queue, in :attr:`queue_size_unit`. If zero,
+    the queue is unbounded.
+    '''
+
+    queue_size_unit = ConfigParserProperty(
+        'frames', 'Video', 'queue_size_unit', exp_config_name,
+        val_type=verify_queue_unit)
+    '''Whether :attr:`queue_size` is in ``'frames'`` or ``'bytes'``. '''
+
+    queue_overflow = ConfigParserProperty(
+        'drop_oldest', 'Video', 'queue_overflow', exp_config_name,
+        val_type=verify_queue_overflow)
+    '''See :attr:`~sock_cond.devices.FrameQueue.overflow`. '''
+
+    queue_timeout = ConfigParserProperty(
+        1., 'Video', 'queue_timeout', exp_config_name, val_type=float)
+    '''See :attr:`~sock_cond.devices.FrameQueue.timeout`. '''
+
+    sources = ListProperty([])
+    '''The players whose frames are written, one stream per player. Their
+    ``size``, ``rate`` and ``output_img_fmt`` are used to configure the file
+    when opened.
+    '''
+
+    cam_ids = ListProperty([])
+    '''The index of the camera of each of the :attr:`sources`. It selects the
+    camera's value from the per-camera config lists.
+    '''
+
+    index_suffix = StringProperty('.trials.csv')
+    '''The suffix appended to the filename of the open file to get the
+    filename of its trial index written by :meth:`add_index`.
+    '''
+
+    timestamps_suffix = ConfigParserProperty(
+        '.timestamps', 'Video', 'timestamps_suffix', exp_config_name,
+        val_type=unicode_type)
+    '''The suffix appended to the filename of the open file to get the
+    filename of its frame timestamps file. If empty, it's not written.
+    '''
+
+    frame_index_suffix = ConfigParserProperty(
+        '.frameidx', 'Video', 'frame_index_suffix', exp_config_name,
+        val_type=unicode_type)
+    '''The suffix appended to the filename of a closed file to get the
+    filename of its frame index. If empty, it's not written. Only AVI files
+    are indexed.
+    '''
+
+    interleave_size = NumericProperty(30)
+    '''When writing multiple streams, the maximum number of frames held back
+    waiting for the other streams' frames, so that frames are written in pts
+    order.
+    '''
+
+    codec = ConfigPropertyList(
+        'rawvideo', 'Video', 'codec', exp_config_name, val_type=verify_codec)
+    '''The codec used to encode each camera, e.g. ``'rawvideo'``,
+    ``'libx264'``, ``'ffv1'`` (lossless), or ``'mjpeg'``.
+    '''
+
+    codec_preset = ConfigPropertyList(
+        '', 'Video', 'codec_preset', exp_config_name, val_type=unicode_type)
+    '''The encoder preset for each camera, e.g. ``'ultrafast'`` for
+    ``'libx264'``. If empty, the codec's default is used.
+    '''
+
+    codec_crf = ConfigPropertyList(
+        -1, 'Video', 'codec_crf', exp_config_name, val_type=int)
+    '''The constant rate factor for each camera, for codecs that support it.
+    If negative, the codec's default is used.
+    '''
+
+    pix_fmt_out = ConfigPropertyList(
+        '', 'Video', 'pix_fmt_out', exp_config_name, val_type=unicode_type)
+    '''The pixel format in which each camera is encoded. If empty, a format
+    suitable for the codec is used.
+    '''
+
+    def __init__(self, **kwargs):
+        super(FFPyWriterDevice, self).__init__(**kwargs)
+        self._frame_queue = FrameQueue(
+            max_size=self.queue_size, unit=self.queue_size_unit,
+            overflow=self.queue_overflow, timeout=self.queue_timeout)
+        self._stream_written = [0, ] * len(self.sources)
+        self._latencies = deque(maxlen=1000)
+        self._thread = Thread(
+            target=self._record_frames, name='Save frames')
+        self._thread.start()
+
+    def update_stats(self):
+        '''Updates the counter properties, e.g. :attr:`frames_written`, from
+        the writer's thread. It must be called from the kivy thread.
+        '''
+        queue = self._frame_queue
+        self.frames_enqueued = queue.enqueued
+        self.frames_dropped = queue.dropped
+        self.queue_depth = queue.size
+        self.queue_high_water = queue.high_water
+        self.frames_written = sum(self._stream_written)
+        self.write_latency = [
+            v * 1000. for v in percentiles(list(self._latencies),
+                                            (50, 90, 99))]
+
+    def get_stream_written(self, stream):
+        '''Returns the number of frames written so far to `stream`.
+        '''
+        return self._stream_written[stream]
+
+    def get_cam_value(self, values, idx):
+        '''See :func:`~sock_cond.devices.get_cam_value`.
+        '''
+        return get_cam_value(values, idx)
+
+    def open_file(self, filename):
+        '''Opens `filename` for writing. Subsequent frames are written to it,
+        until :meth:`close_file` is called.
+        '''
+        self.file_id += 1
+        self._frame_queue.put(('open', filename, self.file_id), force=True)
+
+    def close_file(self):
+        '''Closes the file opened with :meth:`open_file`.
+        '''
+        self._frame_queue.put(('close', ), force=True)
+
+    def add_index(self, trial, start_pts, end_pts, odor, shock):
+        '''Adds a trial to the index of the open file. The index is written
+        to a csv file named after the open file, with
+        :attr:`index_suffix` appended.
+        '''
+        self._frame_queue.put(
+            ('index', trial, start_pts, end_pts, odor, shock), force=True)
+
+    def add_frame(self, frame=None, pts=0, stream=0, file_id=None):
+        '''Adds a :class:`~sock_cond.devices.SharedFrame` to be written to
+        `stream` of the open file. The writer acquires a reference to the
+        frame, which is released once written. If `frame` is None, the open
+        file is closed and the writer's thread exits.
+
+        If `file_id` is not None, the frame is dropped unless the open file
+        is the one whose :attr:`file_id` it is.
+        '''
+        queue = self._frame_queue
+        if frame is None:
+            self._stopping = True
+            queue.put(('eof', ), force=True)
+            return
+
+        frame.acquire()
+        queue.put(('frame', frame, pts, stream, clock(), file_id))
+
+    def join(self, timeout=None):
+        '''Waits for the writer's thread to exit after :meth:`add_frame` was
+        called with None.
+        '''
+        self._thread.join(timeout)
+
+    def _open_writer(self, filename):
+        sources = self.sources
+        # the players may not have received their first frame yet
+        while any(s.size is None or s.rate is None for s in sources):
+            if self._stopping:
+                return None
+            sleep(0.005)
+
+        streams = []
+        lib_opts = []
+        for source, idx in zip(sources, self.cam_ids):
+            size = source.size
+            ifmt = source.output_img_fmt
+            codec = self.get_cam_value(self.codec, idx)
+            ofmt = self.get_cam_value(self.pix_fmt_out, idx) or \
+                default_codec_fmt(codec, ifmt)
+            streams.append({
+                'pix_fmt_in': ifmt, 'width_in': size[0], 'height_in': size[1],
+                'codec': codec, 'frame_rate': source.rate,
+                'pix_fmt_out': ofmt})
+
+            opts = {}
+            preset = self.get_cam_value(self.codec_preset, idx)
+            if preset:
+                opts['preset'] = preset
+            crf = self.get_cam_value(self.codec_crf, idx)
+            if crf >= 0:
+                opts['crf'] = str(crf)
+            lib_opts.append(opts)
+
+        if len(streams) == 1:
+            lib_opts = lib_opts[0]
+        MediaWriter = import_timed('ffpyplayer.writer').MediaWriter
+        return MediaWriter(filename, streams, lib_opts=lib_opts)
+
+    def _close_writer(self):
+        writer = self._writer
+        self._writer = None
+        if writer is not None:
+            # the file is finalized once the writer is closed or freed
+            if hasattr(writer, 'close'):
+                writer.close()
+            del writer
+            self._write_frame_index()
+
+        fd = self._index_fd
+        if fd is not None:
+            self._index_fd = None
+            fd.close()
+        fd = self._timestamps_fd
+        if fd is not None:
+            self._timestamps_fd = None
+            fd.close()
+
+    def _write_frame_index(self):
+        filename = self._filename
+        suffix = self.frame_index_suffix
+        if not suffix or not filename.lower().endswith('.avi'):
+            return
+        try:
+            # it imports numpy
+            write_frame_index = import_timed(
+                'sock_cond.video_index').write_frame_index
+            write_frame_index(filename, filename + suffix)
+        except Exception as e:
+            Logger.warning(
+                'Failed to index the frames of {}: {}'.format(filename, e))
+
+    def _write_index(self, trial, start_pts, end_pts, odor, shock):
+        if self._writer is None:
+            return
+        fd = self._index_fd
+        if fd is None:
+            fd = self._index_fd = open(self._filename + self.index_suffix, 'a')
+            fd.write('Trial,Start pts,End pts,Odor?,Shock?\n')
+        fd.write('{},{},{},{},{}\n'.format(
+            trial, start_pts, end_pts, odor, shock))
+        # it's read while the session is recorded, so keep it up to date
+        fd.flush()
+
+    def _write_frames(self, pending, counts, flush=False):
+        '''Writes the frames in the `pending` heap in pts order. Unless
+        `flush`, a frame is only written once every stream has a frame pending
+        or too many frames are held back.
+        '''
+        writer = self._writer
+        ts_fd = self._timestamps_fd
+        pack = frame_timestamp_struct.pack
+        max_size = self.interleave_size * len(counts)
+        while pending and (
+                flush or all(counts) or len(pending) > max_size):
+            pts, _, stream, frame, t = heappop(pending)
+            counts[stream] -= 1
+            if writer is None:
+                frame.release()
+                continue
+            try:
+                writer.write_frame(frame.image, pts, stream)
+                self._stream_written[stream] += 1
+                self._latencies.append(clock() - t)
+                if ts_fd is not None:
+                    ts_fd.write(pack(
+                        int(frame.t * 1e9), int(round(pts * 1e9)),
+                        frame.index, stream))
+            except Exception as e:
+                Logger.warning('{}: {}'.format(e, pts))
+            finally:
+                frame.release()
+
+    def _record_frames(self):
+        queue = self._frame_queue
+        counts = [0, ] * len(self.sources)
+        pending = []
+        # keeps frames with equal pts in the order they were added
+        seq = 0
+
+        try:
+            while True:
+                item = queue.get()
+                cmd = item[0]
+                if cmd == 'frame':
+                    frame, pts, stream, t, file_id = item[1:]
+                    if self._writer is None or file_id is not None and \
+                            file_id != self._writer_file_id:
+                        frame.release()
+                        continue
+                    heappush(pending, (pts, seq, stream, frame, t))
+                    seq += 1
+                    counts[stream] += 1
+                    self._write_frames(pending, counts)
+                    continue
+
+                if cmd == 'index':
+                    self._write_index(*item[1:])
+                    continue
+
+                self._write_frames(pending, counts, flush=True)
+                if cmd == 'open':
+                    self._close_writer()
+                    try:
+                        self._writer = self._open_writer(item[1])
+                        self._filename = item[1]
+                        self._writer_file_id = item[2]
+                        if self._writer is not None and \
+                                self.timestamps_suffix:
+                            self._timestamps_fd = open(
+                                item[1] + self.timestamps_suffix, 'wb')
+                    except Exception as e:
+                        self.handle_exception(e)
+                elif cmd == 'close':
+                    self._close_writer()
+                elif cmd == 'eof':
+                    self._close_writer()
+                    return
+        except Exception as e:
+            self._close_writer()
+            self.handle_exception(e)